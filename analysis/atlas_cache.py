@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Cache of FreeSurfer label atlases resampled into a subject's FA grid."""
+from __future__ import annotations
+
+from pathlib import Path
+import hashlib
+import os
+
+import numpy as np
+import nibabel as nib
+
+# Resampled atlases are stored in this directory next to the source atlas.
+CACHE_DIRNAME = ".atlas_cache"
+
+LABEL_DTYPE = np.uint16
+
+_HASHES = {}
+
+
+def file_sha256(path, chunk_size=1 << 20) -> str:
+    path = Path(path)
+    st = path.stat()
+    memo_key = (str(path), st.st_size, st.st_mtime_ns)
+    if memo_key not in _HASHES:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                digest.update(block)
+        _HASHES[memo_key] = digest.hexdigest()
+    return _HASHES[memo_key]
+
+
+def cache_key(atlas_path, shape, affine) -> str:
+    """Source file hash plus the target grid (shape and affine)."""
+    digest = hashlib.sha256(file_sha256(atlas_path).encode())
+    digest.update(np.asarray(shape[:3], dtype=np.int64).tobytes())
+    digest.update(np.round(np.asarray(affine, dtype=np.float64), 6).tobytes())
+    return digest.hexdigest()
+
+
+def cache_path(atlas_path, shape, affine, cache_dir=None) -> Path:
+    if cache_dir is None:
+        cache_dir = Path(atlas_path).parent / CACHE_DIRNAME
+    stem = Path(atlas_path).name.split(".")[0]
+    return Path(cache_dir) / f"{stem}_{cache_key(atlas_path, shape, affine)[:16]}.nii"
+
+
+def resampled_atlas(atlas_path, target, cache_dir=None):
+    """Return ``atlas_path`` resampled (nearest neighbour) onto ``target``'s grid.
+
+    The result is stored once as an uncompressed uint16 NIfTI under
+    ``cache_dir`` (default: ``.atlas_cache/`` next to the atlas) and loaded
+    from there on later calls with the same source file and target grid.
+    """
+    out_path = cache_path(atlas_path, target.shape, target.affine, cache_dir)
+    if out_path.exists():
+        return nib.load(str(out_path))
+
+    from nibabel.processing import resample_from_to
+
+    atlas = nib.load(str(atlas_path))
+    resampled = resample_from_to(atlas, (target.shape[:3], target.affine), order=0)
+    labels = np.rint(np.asanyarray(resampled.dataobj))
+    if labels.size and (labels.min() < 0 or labels.max() > np.iinfo(LABEL_DTYPE).max):
+        raise ValueError(f"Labels in {atlas_path} do not fit in {np.dtype(LABEL_DTYPE).name}")
+    img = nib.Nifti1Image(labels.astype(LABEL_DTYPE), target.affine)
+    img.set_data_dtype(LABEL_DTYPE)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f"{out_path.stem}.tmp{os.getpid()}.nii")
+    nib.save(img, str(tmp_path))
+    os.replace(tmp_path, out_path)
+    return nib.load(str(out_path))
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Time the analysis hot paths on a synthetic cohort.
+
+Generates (or reuses) a cohort with ``synthetic_cohort.generate`` and, for
+each benchmark, reports the best and median wall time over ``--repeat`` runs
+plus the peak traced allocation of one extra run under ``tracemalloc``. Each
+invocation appends one JSON line per benchmark to the history file so
+results can be compared across commits and cohort sizes.
+
+    python analysis/benchmarks.py --subjects 16 --shape 96 96 64
+    python analysis/benchmarks.py --root /tmp/cohort --only tdi-projection
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import synthetic_cohort
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+HISTORY_PATH = os.path.join(PROJECT_ROOT, "results", "benchmark_history.jsonl")
+
+
+@contextlib.contextmanager
+def _patched(module, **values):
+    """Temporarily point a script's module-level paths/subjects at the cohort."""
+    saved = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def _bench_tract_stats(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import compute_tract_stats as cts
+
+    def run():
+        with _patched(cts, RESULTS_DIR=str(root / "results"), SUBJECTS=subjects, _RESULTS_INDEX=None):
+            rows, failures = cts._collect_subject_metrics(use_cache=False)
+        if failures:
+            raise RuntimeError(f"tract-stats failed for {sorted(failures)}")
+        return rows
+
+    return run
+
+
+def _bench_fa_summary(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import tract_fa_summary
+    from results_index import ResultsIndex
+
+    def run():
+        index = ResultsIndex(str(root / "results")).refresh(save=False)
+        return tract_fa_summary.collect_metrics(index=index)
+
+    return run
+
+
+def _bench_tract_profiles(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import tract_profiles
+
+    def run():
+        with _patched(tract_profiles, RESULTS_DIR=str(root / "results"), SUBJECTS=subjects):
+            rows, failures = tract_profiles.collect_profiles()
+        if failures:
+            raise RuntimeError(f"tract-profiles failed for {sorted(failures)}")
+        return rows
+
+    return run
+
+
+def _bench_cc_roi(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import cc_freesurfer_stats as ccs
+
+    meta = synthetic_cohort.subject_metadata(len(subjects))
+    rows = [
+        {"id": s, "age_group": m["age_group"], "gender": m["sex"], "age_bin": m["age_bin"]}
+        for s, m in meta.items()
+    ]
+
+    def run():
+        with _patched(ccs, RESULTS=root / "results", SUBJECTS=rows):
+            samples = ccs.collect_roi_values()
+            return ccs.compute_stats(samples), ccs.compute_metric_stats(samples)
+
+    return run
+
+
+def _bench_cc_roi_store(root: Path, subjects: List[str]) -> Callable[[], object]:
+    # Same work read through volume_store; the first (untimed-best) run converts.
+    import volume_store
+
+    cc_roi = _bench_cc_roi(root, subjects)
+    store_dir = str(root / "volume_store")
+
+    def run():
+        saved = os.environ.get(volume_store.ENV_VAR)
+        volume_store.configure(store_dir)
+        try:
+            return cc_roi()
+        finally:
+            if saved is None:
+                del os.environ[volume_store.ENV_VAR]
+            else:
+                os.environ[volume_store.ENV_VAR] = saved
+
+    return run
+
+
+def _bench_slice_scoring(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import nibabel as nib
+    from slice_scoring import slice_with_max_roi_mean
+
+    fa = nib.load(str(root / "results" / f"{subjects[0]}_ses-01_dti.fib.gz.fa.nii.gz"))
+    volume = fa.get_fdata(dtype=np.float32)
+    mask = volume > 0.4
+
+    def run():
+        return [slice_with_max_roi_mean(volume, axis, mask) for axis in range(3)]
+
+    return run
+
+
+def _bench_tdi_build(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import nibabel as nib
+    import tdi_builder
+
+    tract = synthetic_cohort.SLF_TRACTS[0]
+    shape = nib.load(str(root / "results" / f"{subjects[0]}_ses-01_dti.fib.gz.fa.nii.gz")).shape
+    tt_paths = [
+        str(root / "results" / f"{subject}_tracts" / tract / f"{subject}_ses-01_dti.{tract}.tt.gz")
+        for subject in subjects
+    ]
+
+    def run():
+        return [tdi_builder.tdi_volume([path], shape) for path in tt_paths]
+
+    return run
+
+
+def _bench_tdi_projection(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import plot_slf_tdi
+
+    def run():
+        with _patched(plot_slf_tdi, RESULTS=root / "results"):
+            paths = [
+                plot_slf_tdi.tdi_path(subject, tract)
+                for subject in subjects
+                for tract in plot_slf_tdi.TRACTS.values()
+            ]
+            return plot_slf_tdi.project_tdi(paths)
+
+    return run
+
+
+def _bench_voxel_glm(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import voxel_glm
+    from results_index import ResultsIndex
+
+    meta = synthetic_cohort.subject_metadata(len(subjects))
+    ResultsIndex(str(root / "results")).refresh()
+    with _patched(voxel_glm, RESULTS_DIR=str(root / "results"), SUBJECT_METADATA=meta):
+        design = voxel_glm.design_matrix(subjects)
+        images = voxel_glm._fa_images(subjects)
+
+    def run():
+        return voxel_glm.run_glm(design, images, n_perm=1000)
+
+    return run
+
+
+def _bench_cohort_query(root: Path, subjects: List[str]) -> Callable[[], object]:
+    import cohort_stack
+    from results_index import ResultsIndex
+
+    index = ResultsIndex(str(root / "results")).refresh()
+    stack_dir = str(root / "cohort_fa_stack")
+    cohort_stack.build_stack(subjects, [index.fa_map(s) for s in subjects], stack_dir)
+    stack = cohort_stack.CohortStack(stack_dir)
+    rng = np.random.default_rng(0)
+    voxels = [tuple(int(rng.integers(n)) for n in stack.shape) for _ in range(100)]
+    mask = np.zeros(stack.shape, dtype=bool)
+    centre = [n // 2 for n in stack.shape]
+    mask[tuple(slice(c - 8, c + 8) for c in centre)] = True
+
+    def run():
+        return [stack.voxel(v) for v in voxels], stack.summary(stack.mask(mask))
+
+    return run
+
+
+# name -> factory(root, subjects) returning the zero-argument callable to time.
+BENCHMARKS: Dict[str, Callable[[Path, List[str]], Callable[[], object]]] = {
+    "tract-stats": _bench_tract_stats,
+    "fa-summary": _bench_fa_summary,
+    "tract-profiles": _bench_tract_profiles,
+    "cc-roi": _bench_cc_roi,
+    "cc-roi-store": _bench_cc_roi_store,
+    "slice-scoring": _bench_slice_scoring,
+    "voxel-glm": _bench_voxel_glm,
+    "cohort-query": _bench_cohort_query,
+    "tdi-build": _bench_tdi_build,
+    "tdi-projection": _bench_tdi_projection,
+}
+
+
+def measure(func: Callable[[], object], repeat: int = 3) -> Dict[str, float]:
+    """Best/median wall time over ``repeat`` runs, then one traced run for memory."""
+    times = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "best_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_traced_mb": peak / 2**20,
+        # ru_maxrss is in KiB on Linux; it only grows, so it is process-wide.
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_ROOT, capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def run_benchmarks(root: Path, subjects: List[str], names, repeat: int = 3) -> List[Dict[str, object]]:
+    records = []
+    for name in names:
+        func = BENCHMARKS[name](root, subjects)
+        records.append({"benchmark": name, **measure(func, repeat)})
+    return records
+
+
+def _print_table(records: List[Dict[str, object]]) -> None:
+    print(f"{'benchmark':<16}{'best (s)':>10}{'median (s)':>12}{'peak (MB)':>11}{'maxrss (MB)':>13}")
+    for rec in records:
+        print(
+            f"{rec['benchmark']:<16}{rec['best_s']:>10.4f}{rec['median_s']:>12.4f}"
+            f"{rec['peak_traced_mb']:>11.1f}{rec['max_rss_mb']:>13.1f}"
+        )
+
+
+def _append_history(path: str, records: List[Dict[str, object]], context: Dict[str, object]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps({**context, **rec}, sort_keys=True) + "\n")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subjects", type=int, default=4, help="Synthetic cohort size.")
+    parser.add_argument(
+        "--shape", type=int, nargs=3, default=synthetic_cohort.DEFAULT_SHAPE, metavar=("X", "Y", "Z"),
+        help="FA/TDI grid; the FreeSurferSeg atlas is twice this in each axis.",
+    )
+    parser.add_argument(
+        "--root", default=None,
+        help="Cohort root. Generated there if it has no results/ yet (default: a temporary directory).",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark.")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--history", default=HISTORY_PATH, help="JSON-lines file results are appended to.")
+    parser.add_argument("--no-history", action="store_true")
+    args = parser.parse_args(argv)
+
+    with contextlib.ExitStack() as stack:
+        if args.root is None:
+            root = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="synthetic_cohort_")))
+        else:
+            root = Path(args.root)
+        if (root / "results").is_dir():
+            subjects = synthetic_cohort.subject_ids(args.subjects)
+        else:
+            print(f"Generating {args.subjects} subjects at {tuple(args.shape)} under {root} ...")
+            subjects = synthetic_cohort.generate(
+                root, n_subjects=args.subjects, shape=args.shape, diffusivities=True, seed=args.seed
+            )
+        records = run_benchmarks(root, subjects, args.only, repeat=args.repeat)
+
+    _print_table(records)
+    if not args.no_history:
+        context = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "subjects": args.subjects,
+            "shape": list(args.shape),
+            "repeat": args.repeat,
+        }
+        _append_history(args.history, records, context)
+        print(f"Appended {len(records)} records to {args.history}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
-"""Compute corpus callosum FA using FreeSurfer atlas warped to subject space."""
+"""Compute corpus callosum FA using FreeSurfer atlas warped to subject space.
+
+Also summarises FA/AD/MD/RD per CC segment in one long table.
+"""
 from __future__ import annotations
 
 from pathlib import Path
+import argparse
 import json
 
 import numpy as np
-import nibabel as nib
-from nibabel.processing import resample_from_to
-import matplotlib.pyplot as plt
 import pandas as pd
 
+from columnar import OUTPUT_FORMATS, melt_rows, wants_csv, wants_parquet, write_long_table
+import profiling
+from prefetch import PREFETCH_DEPTH, prefetch
+from render_farm import RenderJob, render, report
+from roi_stats import DEFAULT_PERCENTILES, label_stats, label_stats_array
+import volume_store
+
 ROOT = Path(__file__).resolve().parents[1]
 RESULTS = ROOT / "results"
 
@@ -24,42 +32,164 @@ SUBJECTS = [
 ]
 
 
-def load_pair(subj_id: str):
-    fa = nib.load(str(RESULTS / f"{subj_id}_ses-01_dti.fib.gz.fa.nii.gz"))
-    atlas = nib.load(str(RESULTS / f"{subj_id}_ses-01_FreeSurferSeg.nii.gz"))
+# DSI Studio exports every diffusion metric next to the FA map.
+METRICS = ("fa", "ad", "md", "rd")
+
+# FreeSurfer names of the corpus callosum segments; "CC" is their union.
+CC_LABEL_NAMES = {
+    251: "CC_Posterior",
+    252: "CC_Mid_Posterior",
+    253: "CC_Central",
+    254: "CC_Mid_Anterior",
+    255: "CC_Anterior",
+}
+
+ID_COLUMNS = ["id", "age_group", "gender", "age_bin"]
+
+
+def metric_path(subj_id: str, metric: str) -> Path:
+    return RESULTS / f"{subj_id}_ses-01_dti.fib.gz.{metric}.nii.gz"
+
+
+def _load_atlas(subj_id: str, fa):
+    from atlas_cache import resampled_atlas
+
+    atlas_path = RESULTS / f"{subj_id}_ses-01_FreeSurferSeg.nii.gz"
+    atlas = volume_store.load(atlas_path)
     if fa.shape != atlas.shape:
-        atlas = resample_from_to(atlas, fa, order=0)
-    return fa.get_fdata(), atlas.get_fdata()
+        with profiling.span("resample_atlas", subject=subj_id):
+            atlas = resampled_atlas(atlas_path, fa)
+    with profiling.span("load_atlas", subject=subj_id):
+        return atlas.get_fdata()
+
+
+def load_pair(subj_id: str):
+    fa = volume_store.load(metric_path(subj_id, "fa"))
+    atlas_data = _load_atlas(subj_id, fa)
+    with profiling.span("load_fa", subject=subj_id):
+        fa_data = fa.get_fdata()
+    return fa_data, atlas_data
+
+
+def roi_values(subj_id: str, metrics=METRICS):
+    """CC voxel labels and per-metric values of one subject, in one pass.
+
+    The atlas is loaded (and resampled) once and its CC voxels are found
+    once; each metric map is then decompressed, gathered at those flat
+    indices and released before the next is read. Returns ``(labels,
+    values)`` with ``values[metric]`` aligned to ``labels``. FA is required;
+    other metrics without a map are left out.
+    """
+    fa = volume_store.load(metric_path(subj_id, "fa"))
+    atlas = _load_atlas(subj_id, fa)
+    with profiling.span("cc_index", subject=subj_id):
+        flat_atlas = atlas.ravel()
+        index = np.flatnonzero(np.isin(flat_atlas, ATLAS_LABELS))
+        labels = np.rint(flat_atlas[index]).astype(np.int64)
+    del atlas, flat_atlas
+
+    shape = fa.shape[:3]
+    with profiling.span("load_fa", subject=subj_id):
+        values = {"fa": volume_store.flat_values(fa, index)}
+    del fa
+    for metric in dict.fromkeys(metrics):
+        path = metric_path(subj_id, metric)
+        if metric == "fa" or not path.exists():
+            continue
+        img = volume_store.load(path)
+        if img.shape[:3] != shape:
+            raise ValueError(f"{path.name} grid {img.shape[:3]} does not match FA {shape}")
+        with profiling.span(f"load_{metric}", subject=subj_id):
+            values[metric] = volume_store.flat_values(img, index)
+        del img
+    return labels, values
+
 
+def iter_roi_values(metrics=METRICS, depth=PREFETCH_DEPTH):
+    """``(subject, labels, values)`` for every ``SUBJECTS`` entry, in order.
 
-def compute_stats():
+    Up to ``depth`` later subjects are decoded on background threads while
+    the caller works on the current one (see ``prefetch``).
+    """
+    for subj, (labels, values) in prefetch(SUBJECTS, lambda s: roi_values(s["id"], metrics), depth):
+        yield subj, labels, values
+
+
+def collect_roi_values(metrics=METRICS, depth=PREFETCH_DEPTH):
+    """``iter_roi_values`` as a list, for tables built from the same samples."""
+    return list(iter_roi_values(metrics, depth))
+
+
+def compute_stats(samples=None):
+    """Whole-CC FA table (one row per subject) from ``iter_roi_values`` output."""
+    if samples is None:
+        samples = iter_roi_values(("fa",))
     rows = []
-    for subj in SUBJECTS:
-        fa, atlas = load_pair(subj["id"])
-        mask = np.isin(atlas, ATLAS_LABELS)
-        roi_vals = fa[mask]
-        mean = float(np.mean(roi_vals))
-        median = float(np.median(roi_vals))
-        std = float(np.std(roi_vals))
+    for subj, labels, values in samples:
+        with profiling.span("cc_roi", subject=subj["id"]):
+            roi_vals = values["fa"]
+            mean = float(np.mean(roi_vals))
+            median = float(np.median(roi_vals))
+            std = float(np.std(roi_vals))
         rows.append({
             **subj,
             "mean_fa": mean,
             "median_fa": median,
             "std_fa": std,
-            "voxel_count": int(mask.sum()),
+            "voxel_count": int(labels.size),
         })
     return pd.DataFrame(rows)
 
 
-def plot_bar(df: pd.DataFrame):
-    order = ["Young", "Older"]
-    genders = ["F", "M"]
+def compute_metric_stats(samples=None, percentiles=DEFAULT_PERCENTILES):
+    """Long ``id, ..., metric, roi, stat, value`` table for each CC segment and the whole CC.
+
+    Every metric is summarised from the same gathered voxels, so the segment
+    and whole-CC rows of a subject always describe the same voxel set.
+    """
+    if samples is None:
+        samples = collect_roi_values()
+    frames = []
+    for subj, labels, values in samples:
+        with profiling.span("metric_stats", subject=subj["id"]):
+            for metric, vals in values.items():
+                # Each segment, then the whole CC as a single label 0.
+                for roi_labels in (labels, np.zeros_like(labels)):
+                    ids, names, table = label_stats_array(
+                        vals, roi_labels, percentiles=percentiles, include_background=True
+                    )
+                    rois = [CC_LABEL_NAMES.get(int(i), "CC") for i in ids]
+                    frame = pd.DataFrame({
+                        "metric": metric,
+                        "roi": np.repeat(rois, len(names)),
+                        "stat": np.tile(names, len(ids)),
+                        "value": table.ravel(),
+                    })
+                    for column in reversed(ID_COLUMNS):
+                        frame.insert(0, column, subj[column])
+                    frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def compute_label_stats(percentiles=DEFAULT_PERCENTILES):
+    """Long-format stats for every atlas label, one sort per subject."""
+    frames = []
+    for subj, (fa, atlas) in prefetch(SUBJECTS, lambda s: load_pair(s["id"])):
+        with profiling.span("label_stats", subject=subj["id"]):
+            df = label_stats(fa, atlas, percentiles=percentiles)
+        df.insert(0, "subject", subj["id"])
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _render_bar(out_path, order, genders, vals_by_gender, dpi=300):
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(6, 4))
     width = 0.35
     x = np.arange(len(order))
     for i, gender in enumerate(genders):
-        vals = [df[(df.age_group == age) & (df.gender == gender)]["mean_fa"].mean() for age in order]
-        ax.bar(x + (i - 0.5) * width, vals, width=width, label=f"{gender}")
+        ax.bar(x + (i - 0.5) * width, vals_by_gender[gender], width=width, label=f"{gender}")
     ax.set_xticks(x)
     ax.set_xticklabels(order)
     ax.set_ylabel("Corpus callosum mean FA")
@@ -67,21 +197,104 @@ def plot_bar(df: pd.DataFrame):
     ax.set_ylim(0, 0.5)
     ax.legend(title="Gender")
     fig.tight_layout()
+    fig.savefig(out_path, dpi=dpi)
+    plt.close(fig)
+
+
+def plot_bar(df: pd.DataFrame, force=False):
+    order = ["Young", "Older"]
+    genders = ["F", "M"]
+    vals_by_gender = {
+        gender: [float(df[(df.age_group == age) & (df.gender == gender)]["mean_fa"].mean()) for age in order]
+        for gender in genders
+    }
     out_path = RESULTS / "cc_freesurfer_bar.png"
-    fig.savefig(out_path, dpi=300)
+    job = RenderJob(
+        _render_bar,
+        out_path,
+        kwargs={"order": order, "genders": genders, "vals_by_gender": vals_by_gender},
+    )
+    report(render([job], force=force))
     return out_path
 
 
-def main():
-    df = compute_stats()
-    csv_path = RESULTS / "cc_freesurfer_stats.csv"
-    df.to_csv(csv_path, index=False)
-    json_path = RESULTS / "cc_freesurfer_stats.json"
-    df.to_json(json_path, orient="records", indent=2)
-    fig_path = plot_bar(df)
-    print(f"Saved stats to {csv_path}")
-    print(f"Saved JSON to {json_path}")
-    print(f"Saved bar chart to {fig_path}")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--all-labels",
+        action="store_true",
+        help="Also write count/mean/std/median/percentiles for every atlas label.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Write CSV/JSON tables, metric-partitioned Parquet datasets, or both.",
+    )
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        choices=METRICS,
+        default=list(METRICS),
+        help="Diffusion maps summarised per CC segment (FA is always read).",
+    )
+    parser.add_argument("--force", action="store_true", help="Re-render figures even if unchanged.")
+    volume_store.add_argument(parser)
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    volume_store.configure(args.volume_store)
+    with profiling.session(args.profile, "cc-roi"):
+        if args.all_labels:
+            label_df = compute_label_stats()
+            if wants_csv(args.format):
+                labels_path = RESULTS / "freesurfer_label_stats.csv"
+                label_df.to_csv(labels_path, index=False)
+                print(f"Saved per-label stats to {labels_path}")
+            if wants_parquet(args.format):
+                labels_path = RESULTS / "freesurfer_label_stats.parquet"
+                write_long_table(
+                    str(labels_path),
+                    {name: label_df[name].tolist() for name in label_df.columns},
+                    partition_by=("stat",),
+                    sort_by=("subject", "label"),
+                )
+                print(f"Saved per-label stats to {labels_path}")
+
+        samples = collect_roi_values(args.metrics)
+        df = compute_stats(samples)
+        metric_df = compute_metric_stats(samples)
+        if wants_parquet(args.format):
+            parquet_path = RESULTS / "cc_freesurfer_stats.parquet"
+            write_long_table(
+                str(parquet_path),
+                melt_rows(
+                    df.to_dict("records"),
+                    ID_COLUMNS,
+                    ["mean_fa", "median_fa", "std_fa", "voxel_count"],
+                ),
+                partition_by=("metric",),
+                sort_by=("id",),
+            )
+            print(f"Saved Parquet stats to {parquet_path}")
+            metrics_path = RESULTS / "cc_freesurfer_metric_stats.parquet"
+            write_long_table(
+                str(metrics_path),
+                {name: metric_df[name].tolist() for name in metric_df.columns},
+                partition_by=("metric",),
+                sort_by=("id", "roi"),
+            )
+            print(f"Saved per-metric CC stats to {metrics_path}")
+        if wants_csv(args.format):
+            csv_path = RESULTS / "cc_freesurfer_stats.csv"
+            df.to_csv(csv_path, index=False)
+            json_path = RESULTS / "cc_freesurfer_stats.json"
+            df.to_json(json_path, orient="records", indent=2)
+            metrics_path = RESULTS / "cc_freesurfer_metric_stats.csv"
+            metric_df.to_csv(metrics_path, index=False)
+            print(f"Saved stats to {csv_path}")
+            print(f"Saved JSON to {json_path}")
+            print(f"Saved per-metric CC stats to {metrics_path}")
+        plot_bar(df, force=args.force)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""neuroimaging-practice: one entry point for the analysis stages.
+
+Usage::
+
+    python analysis/cli.py <stage> [stage options]
+    python analysis/cli.py tract-stats --jobs 8
+    python analysis/cli.py fa-summary --no-plot
+    python analysis/cli.py startup-check
+
+Each stage module is imported only when its subcommand runs, and the stage
+modules themselves import matplotlib/nibabel only inside the steps that plot
+or read volumes, so table-only runs start quickly.
+"""
+from __future__ import annotations
+
+import argparse
+import importlib
+import os
+import statistics
+import subprocess
+import sys
+from typing import List, Optional
+
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# subcommand -> (module, one-line help)
+STAGES = {
+    "tract-stats": ("compute_tract_stats", "Aggregate DSI Studio tract stats into tract_metrics CSVs."),
+    "fa-summary": ("tract_fa_summary", "Tract FA comparison table, change rates and bar chart."),
+    "tract-resampling": ("tract_resampling", "Bootstrap CIs and permutation p-values for tract group differences."),
+    "tract-profiles": ("tract_profiles", "Along-tract FA profiles from DSI Studio .tt.gz streamlines."),
+    "cc-roi": ("cc_freesurfer_stats", "FreeSurfer atlas CC ROI statistics on FA/AD/MD/RD maps."),
+    "tdi": ("tdi_builder", "Tract density maps from DSI Studio .tt.gz streamlines."),
+    "voxel-glm": ("voxel_glm", "Voxelwise Young vs Older FA t-maps with permutation FWE."),
+    "cohort-stack": ("cohort_stack", "Chunked 4-D cohort FA stack and voxel/mask/label queries."),
+    "slf-tdi": ("plot_slf_tdi", "SLF tract density projections."),
+    "fa-montage": ("plot_fa_cc", "Young vs older CC FA slice montage."),
+    "fa-montage-2x2": ("plot_fa_cc_2x2", "Age x gender CC FA slice montage and ROI stats."),
+}
+
+# Import-time budget (seconds, median of several fresh interpreters) for
+# stages that must stay usable without plotting/imaging libraries.
+STARTUP_BUDGETS = {
+    "tract-stats": 0.15,
+    "fa-summary": 0.40,
+}
+HEAVY_MODULES = ("matplotlib", "nibabel", "pandas", "scipy", "pyarrow")
+
+_PROBE = """
+import sys, time
+sys.path.insert(0, {analysis_dir!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def run_stage(stage: str, argv: Optional[List[str]] = None) -> None:
+    module_name, _ = STAGES[stage]
+    if ANALYSIS_DIR not in sys.path:
+        sys.path.insert(0, ANALYSIS_DIR)
+    module = importlib.import_module(module_name)
+    module.main(argv or [])
+
+
+def measure_startup(stage: str, repeats: int = 5):
+    """Median import time of ``stage``'s module and the heavy modules it pulled in."""
+    module_name, _ = STAGES[stage]
+    code = _PROBE.format(analysis_dir=ANALYSIS_DIR, module=module_name, heavy=HEAVY_MODULES)
+    times = []
+    loaded: List[str] = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        times.append(float(out[0]))
+        loaded = [m for m in out[1].split(",") if m] if len(out) > 1 else []
+    return statistics.median(times), loaded
+
+
+def startup_check(repeats: int = 5) -> bool:
+    ok = True
+    for stage, budget in STARTUP_BUDGETS.items():
+        elapsed, loaded = measure_startup(stage, repeats)
+        passed = elapsed <= budget and not loaded
+        ok &= passed
+        heavy = f", heavy imports: {', '.join(loaded)}" if loaded else ""
+        print(f"[{'ok' if passed else 'FAIL'}] {stage}: {elapsed * 1000:.0f} ms (budget {budget * 1000:.0f} ms){heavy}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Stage options are forwarded untouched (including --help) to the stage.
+    if argv and argv[0] in STAGES:
+        run_stage(argv[0], argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        prog="neuroimaging-practice",
+        description="Run one analysis stage; options after the stage name go to that stage.",
+    )
+    sub = parser.add_subparsers(dest="stage", required=True, metavar="stage")
+    for stage, (_, help_text) in STAGES.items():
+        sub.add_parser(stage, help=help_text)
+    check = sub.add_parser("startup-check", help="Check table-only stages against their import-time budget.")
+    check.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if not startup_check(args.repeats):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""Cohort FA maps packed into one chunked on-disk 4-D stack for cross-subject queries.
+
+``--build`` packs every subject's FA map (all on one common grid; the
+builder checks shape and affine like ``voxel_glm``) into
+``results/cohort_fa_stack/``:
+
+- ``chunks.npy``: float32 array ``(n_chunks, chunk voxels, n_subjects)``.
+  The grid, padded with NaN to a multiple of ``--chunk``, is cut into
+  blocks stored one after another in C order of the block grid, voxels
+  inside a block in C order, and all subjects of a voxel next to each other.
+- ``stack.json``: grid shape, affine, chunk shape, and per subject its
+  ``tract_fa_summary.SUBJECT_METADATA`` entry plus the FA map's path, size
+  and mtime (a stack with the same sources, grid and chunk shape is not
+  rebuilt).
+
+``CohortStack`` memory-maps the array, so a query reads only the blocks it
+touches, and inside each block only the pages holding its voxels: one voxel
+across the cohort is one contiguous run of ``n_subjects`` floats.
+
+    python analysis/cohort_stack.py --build
+    python analysis/cohort_stack.py --voxel 40 52 30
+    python analysis/cohort_stack.py --atlas template_labels.nii.gz --label 251 --out cc.csv
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from prefetch import prefetch
+import profiling
+from results_index import ResultsIndex
+from tract_fa_summary import SUBJECT_METADATA
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+STACK_DIR = os.path.join(RESULTS_DIR, "cohort_fa_stack")
+
+CHUNK_SHAPE = (16, 16, 16)
+# Decoded FA maps held while packing one block of subjects.
+MAX_MEMORY_MB = 1024
+FORMAT_VERSION = 1
+
+
+def _source_stamp(path: str) -> Dict[str, Any]:
+    st = os.stat(path)
+    return {"source": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _chunk_grid(shape: Sequence[int], chunk_shape: Sequence[int]) -> Tuple[int, ...]:
+    return tuple(-(-int(n) // int(c)) for n, c in zip(shape, chunk_shape))
+
+
+def to_chunks(volume: np.ndarray, chunk_shape: Sequence[int]) -> np.ndarray:
+    """``(n_chunks, chunk voxels)`` blocks of a 3-D volume, NaN-padded."""
+    grid = _chunk_grid(volume.shape, chunk_shape)
+    cx, cy, cz = chunk_shape
+    padded = np.full(tuple(g * c for g, c in zip(grid, chunk_shape)), np.nan, dtype=np.float32)
+    padded[tuple(slice(0, n) for n in volume.shape)] = volume
+    blocks = padded.reshape(grid[0], cx, grid[1], cy, grid[2], cz).transpose(0, 2, 4, 1, 3, 5)
+    return blocks.reshape(int(np.prod(grid)), cx * cy * cz)
+
+
+def is_current(
+    subjects: Sequence[str],
+    fa_paths: Sequence[str],
+    out_dir: str = STACK_DIR,
+    chunk_shape: Sequence[int] = CHUNK_SHAPE,
+    shape: Optional[Sequence[int]] = None,
+    affine: Optional[np.ndarray] = None,
+) -> bool:
+    """Whether ``out_dir`` holds exactly this build: same sources, layout and grid.
+
+    ``shape``/``affine`` are checked when given (``build_stack`` passes the
+    first FA map's).
+    """
+    try:
+        with open(os.path.join(out_dir, "stack.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if meta.get("version") != FORMAT_VERSION or not os.path.exists(os.path.join(out_dir, "chunks.npy")):
+        return False
+    if [int(c) for c in meta.get("chunk_shape", ())] != [int(c) for c in chunk_shape]:
+        return False
+    if shape is not None and [int(n) for n in meta.get("shape", ())] != [int(n) for n in shape[:3]]:
+        return False
+    if affine is not None and not np.allclose(meta.get("affine"), affine, atol=1e-4):
+        return False
+    stored = [(s["id"], s["source"], s["size"], s["mtime_ns"]) for s in meta["subjects"]]
+    wanted = []
+    for subject, path in zip(subjects, fa_paths):
+        stamp = _source_stamp(path)
+        wanted.append((subject, stamp["source"], stamp["size"], stamp["mtime_ns"]))
+    return stored == wanted
+
+
+def build_stack(
+    subjects: Sequence[str],
+    fa_paths: Sequence[str],
+    out_dir: str = STACK_DIR,
+    chunk_shape: Sequence[int] = CHUNK_SHAPE,
+    max_memory_mb: float = MAX_MEMORY_MB,
+    force: bool = False,
+) -> Optional[str]:
+    """Pack ``fa_paths`` into ``out_dir``; returns it, or None if already current.
+
+    Subjects are packed in blocks whose decoded maps fit in ``max_memory_mb``;
+    the next map is decoded while the previous one is cut into chunks.
+    """
+    import nibabel as nib
+
+    if not subjects:
+        raise ValueError("No subjects to pack")
+    reference = nib.load(fa_paths[0])
+    shape = tuple(int(n) for n in reference.shape[:3])
+    chunk_shape = tuple(int(c) for c in chunk_shape)
+    if not force and is_current(subjects, fa_paths, out_dir, chunk_shape, shape, reference.affine):
+        return None
+
+    grid = _chunk_grid(shape, chunk_shape)
+    n_chunks = int(np.prod(grid))
+    chunk_voxels = int(np.prod(chunk_shape))
+    per_subject = n_chunks * chunk_voxels * 4
+    block = max(1, min(len(subjects), int(max_memory_mb * 2**20 // per_subject)))
+
+    def load(item):
+        subject, path = item
+        img = nib.load(path)
+        if img.shape[:3] != shape or not np.allclose(img.affine, reference.affine, atol=1e-4):
+            raise ValueError(f"FA grid of {subject} differs from {subjects[0]}")
+        with profiling.span("load_fa", subject=subject):
+            return to_chunks(img.get_fdata(dtype=np.float32), chunk_shape)
+
+    os.makedirs(out_dir, exist_ok=True)
+    chunks_path = os.path.join(out_dir, "chunks.npy")
+    tmp_path = os.path.join(out_dir, f"chunks.tmp{os.getpid()}.npy")
+    out = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.float32, shape=(n_chunks, chunk_voxels, len(subjects))
+    )
+    pending = np.empty((n_chunks, chunk_voxels, block), dtype=np.float32)
+    start = 0
+    try:
+        for i, (_, blocks) in enumerate(prefetch(list(zip(subjects, fa_paths)), load)):
+            pending[:, :, i - start] = blocks
+            if i + 1 - start == block or i + 1 == len(subjects):
+                with profiling.span("write_chunks", subjects=f"{start}-{i}"):
+                    out[:, :, start:i + 1] = pending[:, :, : i + 1 - start]
+                start = i + 1
+        out.flush()
+    except BaseException:
+        del out
+        os.remove(tmp_path)
+        raise
+    del out
+    os.replace(tmp_path, chunks_path)
+
+    meta = {
+        "version": FORMAT_VERSION,
+        "shape": list(shape),
+        "affine": np.asarray(reference.affine, dtype=np.float64).tolist(),
+        "chunk_shape": list(chunk_shape),
+        "dtype": "float32",
+        "subjects": [
+            {"id": subject, **SUBJECT_METADATA.get(subject, {}), **_source_stamp(path)}
+            for subject, path in zip(subjects, fa_paths)
+        ],
+    }
+    # Written last: the stack is valid once stack.json matches chunks.npy.
+    tmp_meta = os.path.join(out_dir, f"stack.tmp{os.getpid()}.json")
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_meta, os.path.join(out_dir, "stack.json"))
+    return out_dir
+
+
+class CohortStack:
+    """Read-only view of a packed stack.
+
+    Queries return FA as ``(voxels, subjects)`` arrays, or one value per
+    subject for ``voxel`` and ``world``; columns follow ``subjects``.
+    """
+
+    def __init__(self, path: str = STACK_DIR):
+        with open(os.path.join(path, "stack.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.shape = tuple(self.meta["shape"])
+        self.affine = np.asarray(self.meta["affine"], dtype=np.float64)
+        self.chunk_shape = tuple(self.meta["chunk_shape"])
+        self.grid = _chunk_grid(self.shape, self.chunk_shape)
+        self.subjects: List[Dict[str, Any]] = self.meta["subjects"]
+        self.chunks = np.load(os.path.join(path, "chunks.npy"), mmap_mode="r")
+        # Blocks touched by queries so far.
+        self.chunks_read = 0
+
+    @property
+    def subject_ids(self) -> List[str]:
+        return [s["id"] for s in self.subjects]
+
+    def _locate(self, flat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        i, j, k = np.unravel_index(flat, self.shape)
+        cx, cy, cz = self.chunk_shape
+        chunk = ((i // cx) * self.grid[1] + j // cy) * self.grid[2] + k // cz
+        local = ((i % cx) * cy + j % cy) * cz + k % cz
+        return chunk, local
+
+    def values(self, flat: np.ndarray) -> np.ndarray:
+        """``(len(flat), n_subjects)`` FA at flat C-order grid indices."""
+        flat = np.asarray(flat, dtype=np.int64).ravel()
+        out = np.empty((len(flat), len(self.subjects)), dtype=np.float32)
+        if not len(flat):
+            return out
+        chunk, local = self._locate(flat)
+        # Visit blocks in file order, each block's voxels in ascending order.
+        order = np.argsort(chunk * self.chunks.shape[1] + local, kind="stable")
+        chunk, local = chunk[order], local[order]
+        bounds = np.flatnonzero(np.diff(chunk)) + 1
+        for a, b in zip(np.r_[0, bounds], np.r_[bounds, len(chunk)]):
+            out[order[a:b]] = self.chunks[chunk[a]][local[a:b]]
+        self.chunks_read += len(bounds) + 1
+        return out
+
+    def voxel(self, ijk: Sequence[int]) -> np.ndarray:
+        """FA of every subject at voxel ``ijk``."""
+        ijk = tuple(int(v) for v in ijk)
+        if not all(0 <= v < n for v, n in zip(ijk, self.shape)):
+            raise ValueError(f"Voxel {ijk} is outside the grid {self.shape}")
+        return self.values(np.ravel_multi_index(ijk, self.shape))[0]
+
+    def world(self, xyz: Sequence[float]) -> np.ndarray:
+        """FA of every subject at the voxel nearest scanner coordinate ``xyz`` (mm)."""
+        ijk = np.linalg.solve(self.affine, np.r_[np.asarray(xyz, dtype=np.float64), 1.0])[:3]
+        return self.voxel(np.rint(ijk).astype(int))
+
+    def mask(self, mask: np.ndarray) -> np.ndarray:
+        """``(n mask voxels, n_subjects)`` FA, voxels in ``mask[mask]`` order."""
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != self.shape:
+            raise ValueError(f"Mask shape {mask.shape} does not match the stack grid {self.shape}")
+        return self.values(np.flatnonzero(mask))
+
+    def label(self, atlas: np.ndarray, label: int) -> np.ndarray:
+        """FA of the voxels of ``atlas`` (a label volume on the stack grid) equal to ``label``."""
+        return self.mask(np.rint(np.asarray(atlas)) == label)
+
+    def summary(self, values: np.ndarray):
+        """Per-subject metadata with mean/median/std/count of ``values`` (NaN ignored)."""
+        import pandas as pd
+
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(self.subjects))
+        rows = []
+        for s, subject in enumerate(self.subjects):
+            column = values[:, s]
+            column = column[~np.isnan(column)]
+            rows.append({
+                **{k: v for k, v in subject.items() if k not in ("source", "size", "mtime_ns")},
+                "mean_fa": float(column.mean()) if column.size else np.nan,
+                "median_fa": float(np.median(column)) if column.size else np.nan,
+                "std_fa": float(column.std()) if column.size else np.nan,
+                "voxel_count": int(column.size),
+            })
+        return pd.DataFrame(rows)
+
+
+def _load_labels(path: str) -> np.ndarray:
+    import nibabel as nib
+
+    return np.asanyarray(nib.load(path).dataobj)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--build", action="store_true", help="Pack the cohort's FA maps first.")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the sources are unchanged.")
+    parser.add_argument("--chunk", type=int, nargs=3, default=list(CHUNK_SHAPE), metavar=("X", "Y", "Z"))
+    parser.add_argument("--max-memory-mb", type=float, default=MAX_MEMORY_MB,
+                        help="Decoded FA maps held at once while packing.")
+    parser.add_argument("--stack", default=STACK_DIR, help="Stack directory.")
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument("--voxel", type=int, nargs=3, metavar=("I", "J", "K"))
+    query.add_argument("--world", type=float, nargs=3, metavar=("X", "Y", "Z"), help="Scanner mm.")
+    query.add_argument("--mask", help="Binary NIfTI mask on the stack grid.")
+    query.add_argument("--atlas", help="Label NIfTI on the stack grid (with --label).")
+    parser.add_argument("--label", type=int, help="Atlas label to summarise.")
+    parser.add_argument("--out", help="Write the per-subject table to this CSV instead of stdout.")
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    if args.atlas and args.label is None:
+        parser.error("--atlas needs --label")
+
+    with profiling.session(args.profile, "cohort-stack"):
+        if args.build:
+            index = ResultsIndex(RESULTS_DIR).refresh()
+            subjects = [s for s in SUBJECT_METADATA if index.fa_map(s) is not None]
+            built = build_stack(
+                subjects, [index.fa_map(s) for s in subjects], args.stack,
+                args.chunk, args.max_memory_mb, args.force,
+            )
+            if built is None:
+                print(f"{args.stack} is up to date")
+            else:
+                print(f"Packed {len(subjects)} FA maps into {built}")
+
+        if args.voxel or args.world or args.mask or args.atlas:
+            stack = CohortStack(args.stack)
+            with profiling.span("query"):
+                try:
+                    if args.voxel:
+                        values = stack.voxel(args.voxel)
+                    elif args.world:
+                        values = stack.world(args.world)
+                    elif args.mask:
+                        values = stack.mask(_load_labels(args.mask) > 0)
+                    else:
+                        values = stack.label(_load_labels(args.atlas), args.label)
+                except ValueError as exc:
+                    parser.error(str(exc))
+            table = stack.summary(values)
+            print(f"{len(table)} subjects, {stack.chunks_read} chunks read", file=sys.stderr)
+            if args.out:
+                table.to_csv(args.out, index=False)
+                print(f"Saved {args.out}")
+            else:
+                print(table.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
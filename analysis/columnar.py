@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Partitioned Parquet output and queries for tract/ROI metric tables.
+
+Tables are stored in long format (one ``value`` per id columns x metric) as a
+hive-partitioned dataset, e.g. ``tract_metrics.parquet/tract=SLF/metric=mean_fa/``.
+Rows are sorted by subject within each partition so Parquet row-group
+statistics let subject filters skip row groups. Requires ``pyarrow``.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Sequence
+
+OUTPUT_FORMATS = ("csv", "parquet", "both")
+
+DEFAULT_ROW_GROUP_SIZE = 64 * 1024
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError as exc:
+        raise SystemExit("Parquet output requires pyarrow (pip install pyarrow).") from exc
+    return pa, ds
+
+
+def wants_csv(fmt: str) -> bool:
+    return fmt in ("csv", "both")
+
+
+def wants_parquet(fmt: str) -> bool:
+    return fmt in ("parquet", "both")
+
+
+def melt_rows(
+    rows: Iterable[Dict[str, object]],
+    id_columns: Sequence[str],
+    metric_columns: Sequence[str],
+    metric_name: str = "metric",
+) -> Dict[str, List[object]]:
+    """Wide dict rows -> long columns ``id_columns + [metric_name, "value"]``.
+
+    Empty strings and ``None`` become nulls; values are coerced to float.
+    """
+    columns: Dict[str, List[object]] = {name: [] for name in id_columns}
+    columns[metric_name] = []
+    columns["value"] = []
+    for row in rows:
+        for metric in metric_columns:
+            value = row.get(metric)
+            for name in id_columns:
+                columns[name].append(row.get(name))
+            columns[metric_name].append(metric)
+            columns["value"].append(None if value in (None, "") else float(value))
+    return columns
+
+
+def write_long_table(
+    root: str,
+    columns: Dict[str, List[object]],
+    partition_by: Sequence[str] = ("tract", "metric"),
+    sort_by: Sequence[str] = ("subject",),
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+    write_statistics: bool = True,
+    compression: str = "zstd",
+) -> str:
+    """Write long-format ``columns`` as a hive-partitioned Parquet dataset.
+
+    ``value`` is typed float64, id columns holding only ints become int64 and
+    everything else is a string. Existing files in the touched partitions are
+    replaced.
+    """
+    pa, ds = _pyarrow()
+    arrays = {}
+    for name, values in columns.items():
+        present = [v for v in values if v is not None]
+        if name == "value":
+            arrays[name] = pa.array(values, type=pa.float64())
+        elif present and all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+            arrays[name] = pa.array(values, type=pa.int64())
+        else:
+            arrays[name] = pa.array([None if v is None else str(v) for v in values], type=pa.string())
+    table = pa.table(arrays)
+
+    sort_keys = [(name, "ascending") for name in sort_by if name in columns]
+    if sort_keys:
+        table = table.sort_by(sort_keys)
+
+    partition_fields = [table.schema.field(name) for name in partition_by]
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        table,
+        root,
+        format=file_format,
+        partitioning=ds.partitioning(pa.schema(partition_fields), flavor="hive"),
+        file_options=file_format.make_write_options(
+            compression=compression, write_statistics=write_statistics
+        ),
+        max_rows_per_group=row_group_size,
+        min_rows_per_group=min(row_group_size, 1024),
+        existing_data_behavior="delete_matching",
+    )
+    return root
+
+
+def read_long_table(
+    root: str,
+    columns: Optional[Sequence[str]] = None,
+    **filters: Sequence[object],
+):
+    """Read a dataset written by :func:`write_long_table` as a pyarrow Table.
+
+    Keyword filters select values per column, e.g.
+    ``read_long_table(path, tract=["SLF"], metric=["mean_fa"])``. Filters on
+    partition columns skip whole directories; filters on sorted columns such
+    as ``subject`` are pruned against row-group statistics.
+    """
+    _, ds = _pyarrow()
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+    expression = None
+    for name, values in filters.items():
+        if values is None:
+            continue
+        term = ds.field(name).isin(list(values))
+        expression = term if expression is None else expression & term
+    return dataset.to_table(columns=list(columns) if columns else None, filter=expression)
@@ -2,13 +2,22 @@
 """Aggregate DSI Studio tract statistics into CSV summaries."""
 from __future__ import annotations
 
+import argparse
 import csv
-import glob
 import math
 import os
-from collections import defaultdict
-from statistics import mean, stdev
-from typing import Dict, Iterable, List
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from columnar import OUTPUT_FORMATS, wants_csv, wants_parquet
+from online_stats import TractAggregator
+import profiling
+from results_index import ResultsIndex
+from stat_cache import StatCache
+from stat_parser import DEFAULT_WORKERS, StatTable, parse_many
 
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
@@ -42,41 +51,58 @@ STAT_KEYS = {
     "mean_fa": "fa",
 }
 
+SUMMARY_FIELDS = [
+    "tract",
+    "mean_streamlines",
+    "std_streamlines",
+    "mean_fa",
+    "std_fa",
+    "mean_volume_mm3",
+    "std_volume_mm3",
+]
+
+
+_RESULTS_INDEX: Optional[ResultsIndex] = None
+_STAT_CACHE: Optional[StatCache] = None
+# Threads per subject batch; raised only when subjects are not already
+# spread over worker processes.
+_PARSE_THREADS = 1
+
 
-def _parse_stat_file(path: str) -> Dict[str, float]:
-    metrics: Dict[str, float] = {}
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            if "\t" not in line:
-                continue
-            key, value = line.strip().split("\t", 1)
-            try:
-                metrics[key] = float(value)
-            except ValueError:
-                continue
-    return metrics
+def _read_stats(paths: List[str]) -> StatTable:
+    return parse_many(paths, list(STAT_KEYS.values()), workers=_PARSE_THREADS, cache=_STAT_CACHE)
+
+
+def _init_stat_cache(use_cache: bool) -> None:
+    global _STAT_CACHE
+    _STAT_CACHE = StatCache() if use_cache else None
+
+
+def _results_index() -> ResultsIndex:
+    # Pool workers inherit (fork) or reload (spawn) the manifest that the
+    # parent refreshed; they never walk the tree themselves.
+    global _RESULTS_INDEX
+    if _RESULTS_INDEX is None:
+        _RESULTS_INDEX = ResultsIndex(RESULTS_DIR)
+    return _RESULTS_INDEX
 
 
 def _find_stat_files(subject: str, tract_name: str) -> List[str]:
+    hits = _results_index().stat_files(subject, tract_name)
+    if not hits:
+        raise FileNotFoundError(f"No stat files for {subject} {tract_name}")
+    # Stat files directly in the tract folder take precedence over nested ones.
     base = os.path.join(RESULTS_DIR, f"{subject}_tracts", tract_name)
-    patterns = [
-        os.path.join(base, "*.stat.txt"),
-        os.path.join(base, "**", "*.stat.txt"),
-    ]
-    for pattern in patterns:
-        hits = glob.glob(pattern, recursive="**" in pattern)
-        if hits:
-            return sorted(hits)
-    raise FileNotFoundError(f"No stat files for {subject} {tract_name}")
-
-
-def _combine_metrics(stat_paths: Iterable[str]) -> Dict[str, float]:
+    direct = [p for p in hits if os.path.dirname(p) == base]
+    return direct or hits
+
+
+def _combine_metrics(stat_rows: Iterable[Dict[str, float]]) -> Dict[str, float]:
     total_streamlines = 0.0
     total_volume = 0.0
     weighted_fa = 0.0
 
-    for stat_path in stat_paths:
-        stats = _parse_stat_file(stat_path)
+    for stats in stat_rows:
         streamlines = stats.get(STAT_KEYS["streamlines"], 0.0)
         volume = stats.get(STAT_KEYS["volume_mm3"], 0.0)
         fa = stats.get(STAT_KEYS["mean_fa"], math.nan)
@@ -96,42 +122,108 @@ def _combine_metrics(stat_paths: Iterable[str]) -> Dict[str, float]:
     }
 
 
-def _collect_subject_metrics() -> List[Dict[str, object]]:
+def _subject_rows(subject: str) -> List[Dict[str, object]]:
     rows: List[Dict[str, object]] = []
-    for subject in SUBJECTS:
-        # Whole brain summary
-        wholebrain_stat = os.path.join(
-            RESULTS_DIR, f"{subject}_wholebrain.tt.gz.stat.txt"
-        )
-        if not os.path.exists(wholebrain_stat):
-            raise FileNotFoundError(f"Missing wholebrain stat for {subject}")
-        wholebrain_metrics = _parse_stat_file(wholebrain_stat)
+    wholebrain_stat = _results_index().wholebrain_stat(subject)
+    if wholebrain_stat is None:
+        raise FileNotFoundError(f"Missing wholebrain stat for {subject}")
+    group_files: Dict[str, List[str]] = {}
+    for group, tract_list in TRACT_GROUPS.items():
+        group_files[group] = []
+        for tract_name in tract_list:
+            group_files[group].extend(_find_stat_files(subject, tract_name))
+
+    # One batch per subject: the wholebrain file first, then each group's files.
+    table = _read_stats([wholebrain_stat] + [p for files in group_files.values() for p in files])
+    stat_rows = table.rows()
+
+    # Whole brain summary
+    wholebrain_metrics = next(stat_rows)
+    rows.append(
+        {
+            "subject": subject,
+            "tract": "WholeBrain",
+            "streamlines": wholebrain_metrics.get(STAT_KEYS["streamlines"], 0.0),
+            "mean_fa": wholebrain_metrics.get(STAT_KEYS["mean_fa"], math.nan),
+            "volume_mm3": wholebrain_metrics.get(STAT_KEYS["volume_mm3"], 0.0),
+        }
+    )
+
+    # Individual tract groups
+    for group, stat_files in group_files.items():
+        metrics = _combine_metrics(islice(stat_rows, len(stat_files)))
         rows.append(
             {
                 "subject": subject,
-                "tract": "WholeBrain",
-                "streamlines": wholebrain_metrics.get(STAT_KEYS["streamlines"], 0.0),
-                "mean_fa": wholebrain_metrics.get(STAT_KEYS["mean_fa"], math.nan),
-                "volume_mm3": wholebrain_metrics.get(STAT_KEYS["volume_mm3"], 0.0),
+                "tract": group,
+                **metrics,
             }
         )
-
-        # Individual tract groups
-        for group, tract_list in TRACT_GROUPS.items():
-            stat_files: List[str] = []
-            for tract_name in tract_list:
-                stat_files.extend(_find_stat_files(subject, tract_name))
-            metrics = _combine_metrics(stat_files)
-            rows.append(
-                {
-                    "subject": subject,
-                    "tract": group,
-                    **metrics,
-                }
-            )
     return rows
 
 
+def _safe_subject_rows(subject: str) -> Tuple[List[Dict[str, object]], Optional[str]]:
+    # Runs inside pool workers, so failures come back as values instead of
+    # exceptions that would abort the remaining subjects.
+    try:
+        with profiling.span("subject", subject=subject):
+            return _subject_rows(subject), None
+    except (OSError, ValueError) as exc:
+        return [], str(exc)
+    finally:
+        if _STAT_CACHE is not None:
+            _STAT_CACHE.flush()
+
+
+def _collect_subject_metrics(
+    jobs: int = 1,
+    rescan: bool = False,
+    use_cache: bool = True,
+) -> Tuple[List[Dict[str, object]], Dict[str, str]]:
+    """Collect per-subject rows in ``SUBJECTS`` order.
+
+    With ``jobs > 1`` subjects are fanned out across a process pool. Subjects
+    that fail are returned in the second element (subject -> error message)
+    and contribute no rows. ``rescan`` rebuilds the results index from scratch
+    instead of refreshing it from directory mtimes. ``use_cache`` reads parsed
+    stat files through the SQLite stat cache.
+    """
+    global _RESULTS_INDEX, _PARSE_THREADS
+    with profiling.span("results_index.refresh", full=rescan):
+        _RESULTS_INDEX = ResultsIndex(RESULTS_DIR).refresh(full=rescan)
+
+    _init_stat_cache(use_cache)
+    if jobs > 1 and len(SUBJECTS) > 1:
+        chunksize = max(1, len(SUBJECTS) // (jobs * 4))
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_stat_cache, initargs=(use_cache,)
+        ) as pool:
+            if profiling.enabled():
+                results = []
+                for result, events in pool.map(
+                    partial(profiling.collect, _safe_subject_rows), SUBJECTS, chunksize=chunksize
+                ):
+                    profiling.merge(events)
+                    results.append(result)
+            else:
+                results = list(pool.map(_safe_subject_rows, SUBJECTS, chunksize=chunksize))
+    else:
+        _PARSE_THREADS = DEFAULT_WORKERS
+        try:
+            results = [_safe_subject_rows(subject) for subject in SUBJECTS]
+        finally:
+            _PARSE_THREADS = 1
+
+    rows: List[Dict[str, object]] = []
+    failures: Dict[str, str] = {}
+    for subject, (subject_rows, error) in zip(SUBJECTS, results):
+        if error is not None:
+            failures[subject] = error
+            continue
+        rows.extend(subject_rows)
+    return rows, failures
+
+
 def _write_csv(path: str, rows: Iterable[Dict[str, object]]) -> None:
     rows = list(rows)
     if not rows:
@@ -144,52 +236,112 @@ def _write_csv(path: str, rows: Iterable[Dict[str, object]]) -> None:
             writer.writerow(row)
 
 
-def _summarise_by_tract(rows: Iterable[Dict[str, object]]) -> List[Dict[str, object]]:
-    grouped: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
-    for row in rows:
-        tract = str(row["tract"])
-        grouped[tract]["streamlines"].append(float(row["streamlines"]))
-        grouped[tract]["mean_fa"].append(float(row["mean_fa"]))
-        grouped[tract]["volume_mm3"].append(float(row["volume_mm3"]))
+def _write_parquet(
+    rows: Iterable[Dict[str, object]],
+    summary: Iterable[Dict[str, object]],
+) -> None:
+    from columnar import melt_rows, write_long_table
 
-    summary_rows: List[Dict[str, object]] = []
-    for tract, metrics in grouped.items():
-        summary_rows.append(
-            {
-                "tract": tract,
-                "mean_streamlines": mean(metrics["streamlines"]),
-                "std_streamlines": stdev(metrics["streamlines"]) if len(metrics["streamlines"]) > 1 else 0.0,
-                "mean_fa": mean(metrics["mean_fa"]),
-                "std_fa": stdev(metrics["mean_fa"]) if len(metrics["mean_fa"]) > 1 else 0.0,
-                "mean_volume_mm3": mean(metrics["volume_mm3"]),
-                "std_volume_mm3": stdev(metrics["volume_mm3"]) if len(metrics["volume_mm3"]) > 1 else 0.0,
-            }
-        )
-    return summary_rows
+    write_long_table(
+        os.path.join(RESULTS_DIR, "tract_metrics.parquet"),
+        melt_rows(rows, ["subject", "tract"], ["streamlines", "mean_fa", "volume_mm3"]),
+    )
+    write_long_table(
+        os.path.join(RESULTS_DIR, "tract_metrics_summary.parquet"),
+        melt_rows(summary, ["tract"], SUMMARY_FIELDS[1:]),
+    )
+
+
+def _summarise_by_tract(
+    rows: Iterable[Dict[str, object]],
+    aggregator: Optional[TractAggregator] = None,
+) -> List[Dict[str, object]]:
+    # Rows are folded into running (mergeable) states, so ``rows`` may be a
+    # stream; pass a previously loaded ``aggregator`` to extend its states.
+    # Subjects already in a loaded state are not folded again.
+    aggregator = aggregator if aggregator is not None else TractAggregator()
+    skipped = sum(not aggregator.update(row) for row in rows)
+    if skipped:
+        print(f"[state] {skipped} subject/tract rows already in the summary state", file=sys.stderr)
+    return aggregator.summary_rows()
 
 
-def main() -> None:
-    rows = _collect_subject_metrics()
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Worker processes for per-subject aggregation (0 = all CPUs).",
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Rebuild the results index instead of refreshing it incrementally.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Parse every stat file instead of reading the stat cache.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Write CSV tables, tract/metric-partitioned Parquet datasets, or both.",
+    )
+    parser.add_argument(
+        "--summary-state",
+        help=(
+            "JSON file of per-tract running aggregates. An existing state is extended "
+            "with this run's subjects not already in it (e.g. a new cohort batch) and "
+            "written back."
+        ),
+    )
+    profiling.add_argument(parser)
+    return parser.parse_args(argv)
+
+
+def _run(args: argparse.Namespace) -> None:
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    rows, failures = _collect_subject_metrics(
+        jobs=jobs, rescan=args.rescan, use_cache=not args.no_cache
+    )
+    for subject, error in failures.items():
+        print(f"[skip] {subject}: {error}", file=sys.stderr)
+    if not rows:
+        raise SystemExit("No subject metrics collected.")
+    aggregator = None
+    if args.summary_state and os.path.exists(args.summary_state):
+        aggregator = TractAggregator.load(args.summary_state)
+    aggregator = aggregator if aggregator is not None else TractAggregator()
+    with profiling.span("summarise"):
+        summary = _summarise_by_tract(rows, aggregator)
+    if args.summary_state:
+        aggregator.save(args.summary_state)
+
+    if wants_parquet(args.format):
+        with profiling.span("write_parquet"):
+            _write_parquet(rows, summary)
+    if not wants_csv(args.format):
+        return
+
     per_subject_csv = os.path.join(RESULTS_DIR, "tract_metrics.csv")
     _write_csv(per_subject_csv, rows)
 
-    summary = _summarise_by_tract(rows)
     summary_csv = os.path.join(RESULTS_DIR, "tract_metrics_summary.csv")
-    fieldnames = [
-        "tract",
-        "mean_streamlines",
-        "std_streamlines",
-        "mean_fa",
-        "std_fa",
-        "mean_volume_mm3",
-        "std_volume_mm3",
-    ]
     with open(summary_csv, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
         writer.writeheader()
         for row in summary:
             writer.writerow(row)
 
 
+def main(argv: Optional[List[str]] = None) -> None:
+    args = _parse_args(argv)
+    with profiling.session(args.profile, "tract-stats"):
+        _run(args)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Mergeable streaming aggregates for per-tract summary statistics."""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Set
+
+SUMMARY_METRICS = {
+    "streamlines": ("mean_streamlines", "std_streamlines"),
+    "mean_fa": ("mean_fa", "std_fa"),
+    "volume_mm3": ("mean_volume_mm3", "std_volume_mm3"),
+}
+
+
+@dataclass
+class RunningStats:
+    """Welford count/mean/M2 plus min/max; states merge exactly (Chan et al.)."""
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+
+    def update(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "RunningStats") -> "RunningStats":
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def stdev(self) -> float:
+        """Sample standard deviation; 0.0 below two observations."""
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class TractAggregator:
+    """tract -> metric -> RunningStats, fed one row at a time.
+
+    Rows carrying a ``subject`` are folded at most once per tract: the
+    subjects behind each state are kept (and saved), a repeated subject is
+    skipped, and merging states that share a subject raises ``ValueError``.
+    """
+
+    def __init__(self, metrics: Iterable[str] = tuple(SUMMARY_METRICS)):
+        self.metrics = list(metrics)
+        self.states: Dict[str, Dict[str, RunningStats]] = {}
+        self.subjects: Dict[str, Set[str]] = {}
+
+    def update(self, row: Dict[str, object]) -> bool:
+        """Fold ``row`` in; False if its subject is already in the tract's state."""
+        tract = str(row["tract"])
+        subject = row.get("subject")
+        if subject is not None:
+            seen = self.subjects.setdefault(tract, set())
+            if str(subject) in seen:
+                return False
+            seen.add(str(subject))
+        states = self.states.get(tract)
+        if states is None:
+            states = self.states[tract] = {metric: RunningStats() for metric in self.metrics}
+        for metric in self.metrics:
+            states[metric].update(float(row[metric]))
+        return True
+
+    def update_many(self, rows: Iterable[Dict[str, object]]) -> "TractAggregator":
+        for row in rows:
+            self.update(row)
+        return self
+
+    def merge(self, other: "TractAggregator") -> "TractAggregator":
+        for tract, other_subjects in other.subjects.items():
+            overlap = self.subjects.get(tract, set()) & other_subjects
+            if overlap:
+                raise ValueError(
+                    f"States share {len(overlap)} subject(s) for {tract}, e.g. {min(overlap)}"
+                )
+        for tract, other_subjects in other.subjects.items():
+            self.subjects.setdefault(tract, set()).update(other_subjects)
+        for tract, other_states in other.states.items():
+            states = self.states.setdefault(
+                tract, {metric: RunningStats() for metric in self.metrics}
+            )
+            for metric in self.metrics:
+                states[metric].merge(other_states.get(metric, RunningStats()))
+        return self
+
+    def summary_rows(self) -> List[Dict[str, object]]:
+        rows: List[Dict[str, object]] = []
+        for tract, states in self.states.items():
+            row: Dict[str, object] = {"tract": tract}
+            for metric in self.metrics:
+                mean_col, std_col = SUMMARY_METRICS[metric]
+                row[mean_col] = states[metric].mean
+                row[std_col] = states[metric].stdev
+            rows.append(row)
+        return rows
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "metrics": self.metrics,
+            "states": {
+                tract: {metric: asdict(state) for metric, state in states.items()}
+                for tract, states in self.states.items()
+            },
+            "subjects": {tract: sorted(subjects) for tract, subjects in self.subjects.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, payload: Dict[str, object]) -> "TractAggregator":
+        agg = cls(payload["metrics"])
+        for tract, states in payload["states"].items():
+            agg.states[tract] = {metric: RunningStats(**state) for metric, state in states.items()}
+        # States saved before subjects were tracked have no "subjects" key.
+        for tract, subjects in payload.get("subjects", {}).items():
+            agg.subjects[tract] = set(subjects)
+        return agg
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TractAggregator":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Stream per-subject tract_metrics CSVs into mergeable per-tract states."
+    )
+    parser.add_argument("csv_paths", nargs="*", help="tract_metrics.csv-style inputs.")
+    parser.add_argument("--merge", nargs="*", default=[], help="Saved states to fold in.")
+    parser.add_argument("--state", help="Write the combined state to this JSON path.")
+    parser.add_argument("--summary", help="Write the per-tract summary CSV to this path.")
+    args = parser.parse_args()
+
+    agg = TractAggregator()
+    for path in args.merge:
+        agg.merge(TractAggregator.load(path))
+    for path in args.csv_paths:
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            agg.update_many(csv.DictReader(f))
+
+    if args.state:
+        agg.save(args.state)
+    if args.summary:
+        rows = agg.summary_rows()
+        with open(args.summary, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["tract"] + [c for m in agg.metrics for c in SUMMARY_METRICS[m]])
+            writer.writeheader()
+            writer.writerows(rows)
+    for tract, states in agg.states.items():
+        counts = {metric: state.count for metric, state in states.items()}
+        print(f"{tract}: n={max(counts.values(), default=0)}")
+
+
+if __name__ == "__main__":
+    main()
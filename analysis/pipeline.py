@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Make-like runner for the analysis stages.
+
+Each stage declares its input globs and output files. A stage is rebuilt when
+an output is missing or when the signature of its inputs (path, size and
+mtime of every matching file, including the stage's own script and the
+``analysis/`` modules it imports) differs from
+the one recorded after its last successful run. Stages whose inputs include
+another stage's outputs run after it; independent stages run concurrently.
+
+    python analysis/pipeline.py --dry-run
+    python analysis/pipeline.py --jobs 3
+    python analysis/pipeline.py fa-summary --force
+"""
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import glob
+import hashlib
+import os
+import subprocess
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+STAMP_DIR = os.path.join(RESULTS_DIR, ".pipeline")
+CLI = os.path.join(PROJECT_ROOT, "analysis", "cli.py")
+
+FA_MAPS = "results/*_dti.fib.gz.fa.nii.gz"
+TRACT_STATS = "results/*_tracts/**/*.stat.txt"
+
+
+@dataclass
+class Stage:
+    """A ``cli.py`` subcommand with its declared inputs and outputs.
+
+    ``inputs`` are globs and ``outputs`` plain paths, both relative to the
+    project root.
+    """
+
+    name: str
+    inputs: Sequence[str]
+    outputs: Sequence[str]
+    args: Sequence[str] = field(default_factory=list)
+    script: str = ""
+
+    def all_inputs(self) -> List[str]:
+        patterns = list(self.inputs)
+        if self.script:
+            patterns.extend(f"analysis/{name}" for name in script_modules(self.script))
+        return patterns
+
+
+def _imported_names(path: str) -> List[str]:
+    import ast
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (OSError, SyntaxError):
+        return []
+    names = []
+    # ast.walk also reaches the lazy imports inside functions.
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module.split(".")[0])
+    return names
+
+
+def script_modules(script: str, directory: Optional[str] = None) -> List[str]:
+    """``script`` plus every ``analysis/*.py`` it imports, directly or not.
+
+    ``directory`` replaces ``analysis/`` as the place both are looked up.
+    """
+    analysis_dir = directory or os.path.join(PROJECT_ROOT, "analysis")
+    seen = set()
+    stack = [script]
+    while stack:
+        name = stack.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for module in _imported_names(os.path.join(analysis_dir, name)):
+            if os.path.exists(os.path.join(analysis_dir, f"{module}.py")):
+                stack.append(f"{module}.py")
+    return sorted(seen)
+
+
+STAGES = [
+    Stage(
+        "tract-stats",
+        inputs=["results/*_wholebrain.tt.gz.stat.txt", TRACT_STATS],
+        outputs=["results/tract_metrics.csv", "results/tract_metrics_summary.csv"],
+        script="compute_tract_stats.py",
+    ),
+    Stage(
+        "fa-summary",
+        inputs=[TRACT_STATS],
+        outputs=[
+            "results/tract_fa_comparison.csv",
+            "results/tract_fa_change_rates.csv",
+            "analysis/figures/tract_fa_barplot.png",
+        ],
+        script="tract_fa_summary.py",
+    ),
+    Stage(
+        "tract-resampling",
+        inputs=["results/tract_metrics.csv"],
+        outputs=["results/tract_group_resampling.csv"],
+        script="tract_resampling.py",
+    ),
+    Stage(
+        "tract-profiles",
+        inputs=[FA_MAPS, "results/*_tracts/**/*.tt.gz"],
+        outputs=["results/tract_profiles.csv"],
+        script="tract_profiles.py",
+    ),
+    Stage(
+        "cc-roi",
+        inputs=[FA_MAPS, "results/*_dti.fib.gz.[amr]d.nii.gz", "results/*_FreeSurferSeg.nii.gz"],
+        outputs=[
+            "results/cc_freesurfer_stats.csv",
+            "results/cc_freesurfer_stats.json",
+            "results/cc_freesurfer_metric_stats.csv",
+            "results/cc_freesurfer_bar.png",
+        ],
+        script="cc_freesurfer_stats.py",
+    ),
+    Stage(
+        "voxel-glm",
+        inputs=[FA_MAPS],
+        outputs=[
+            "results/voxelwise/fa_age_group_tstat.nii.gz",
+            "results/voxelwise/fa_age_group_p_fwe.nii.gz",
+            "results/voxelwise/fa_age_group_p_unc.nii.gz",
+            "results/voxelwise/fa_age_group.json",
+        ],
+        script="voxel_glm.py",
+    ),
+    Stage(
+        "cohort-stack",
+        inputs=[FA_MAPS],
+        outputs=["results/cohort_fa_stack/stack.json", "results/cohort_fa_stack/chunks.npy"],
+        # The pipeline has already found the stack stale; skip the builder's own check.
+        args=["--build", "--force"],
+        script="cohort_stack.py",
+    ),
+    Stage(
+        "slf-tdi",
+        inputs=["results/*_tracts/Association_SuperiorLongitudinalFasciculus*/*.tdi.nii.gz"],
+        outputs=["analysis/figures/slf_group_comparison.png"],
+        script="plot_slf_tdi.py",
+    ),
+    Stage(
+        "fa-montage",
+        inputs=[FA_MAPS],
+        outputs=["results/fa_cc_comparison.png"],
+        script="plot_fa_cc.py",
+    ),
+    Stage(
+        "fa-montage-2x2",
+        inputs=[FA_MAPS],
+        outputs=["results/fa_cc_comparison_2x2.png", "results/fa_cc_stats.json"],
+        script="plot_fa_cc_2x2.py",
+    ),
+]
+
+
+def _abs(rel_path: str) -> str:
+    return os.path.join(PROJECT_ROOT, rel_path)
+
+
+def dependencies(stages: Sequence[Stage]) -> Dict[str, List[str]]:
+    """stage -> stages producing any file matched by its input globs."""
+    deps: Dict[str, List[str]] = {stage.name: [] for stage in stages}
+    for stage in stages:
+        for other in stages:
+            if other is stage:
+                continue
+            if any(
+                fnmatch.fnmatch(output, pattern)
+                for pattern in stage.inputs
+                for output in other.outputs
+            ):
+                deps[stage.name].append(other.name)
+    return deps
+
+
+def input_signature(stage: Stage) -> Tuple[str, int]:
+    """Hash of (path, size, mtime) over every input file, and the file count."""
+    paths = set()
+    for pattern in stage.all_inputs():
+        paths.update(glob.glob(_abs(pattern), recursive=True))
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest(), len(paths)
+
+
+def _stamp_path(stage: Stage) -> str:
+    return os.path.join(STAMP_DIR, f"{stage.name}.sig")
+
+
+def stale_reason(stage: Stage, signature: str) -> Optional[str]:
+    """Why ``stage`` must be rebuilt, or ``None`` when it is up to date."""
+    missing = [p for p in stage.outputs if not os.path.exists(_abs(p))]
+    if missing:
+        return f"missing {missing[0]}"
+    try:
+        with open(_stamp_path(stage), "r", encoding="utf-8") as f:
+            recorded = f.read().strip()
+    except OSError:
+        return "no record of a previous run"
+    if recorded != signature:
+        return "inputs changed"
+    return None
+
+
+def _record(stage: Stage, signature: str) -> None:
+    os.makedirs(STAMP_DIR, exist_ok=True)
+    with open(_stamp_path(stage), "w", encoding="utf-8") as f:
+        f.write(signature + "\n")
+
+
+def _run_stage(stage: Stage) -> int:
+    cmd = [sys.executable, CLI, stage.name, *stage.args]
+    print(f"[run] {' '.join(cmd[1:])}", flush=True)
+    return subprocess.run(cmd, cwd=PROJECT_ROOT).returncode
+
+
+def _select(stages: Sequence[Stage], targets: Sequence[str], deps: Dict[str, List[str]]) -> List[Stage]:
+    if not targets:
+        return list(stages)
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [t for t in targets if t not in by_name]
+    if unknown:
+        raise SystemExit(f"Unknown stage(s): {', '.join(unknown)}")
+    wanted = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in wanted:
+            wanted.add(name)
+            stack.extend(deps[name])
+    return [stage for stage in stages if stage.name in wanted]
+
+
+def _topological(stages: Sequence[Stage], deps: Dict[str, List[str]]) -> List[Stage]:
+    names = {stage.name for stage in stages}
+    ordered: List[Stage] = []
+    placed: set = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if all(d in placed or d not in names for d in deps[s.name])]
+        if not ready:
+            raise SystemExit(f"Dependency cycle among: {', '.join(s.name for s in remaining)}")
+        for stage in ready:
+            ordered.append(stage)
+            placed.add(stage.name)
+        remaining = [s for s in remaining if s.name not in placed]
+    return ordered
+
+
+def run(
+    targets: Sequence[str] = (),
+    jobs: int = 1,
+    dry_run: bool = False,
+    force: bool = False,
+    stages: Sequence[Stage] = STAGES,
+) -> bool:
+    """Bring ``targets`` (default: every stage) up to date; False if any stage failed."""
+    deps = dependencies(stages)
+    selected = _topological(_select(stages, targets, deps), deps)
+    names = {stage.name for stage in selected}
+
+    plan: Dict[str, Optional[str]] = {}
+    signatures: Dict[str, str] = {}
+    for stage in selected:
+        signatures[stage.name], _ = input_signature(stage)
+        reason = "forced" if force else stale_reason(stage, signatures[stage.name])
+        # Anything downstream of a rebuilt stage is rebuilt as well.
+        if reason is None and any(plan.get(d) for d in deps[stage.name] if d in names):
+            reason = "upstream stage rebuilt"
+        plan[stage.name] = reason
+
+    for stage in selected:
+        reason = plan[stage.name]
+        after = [d for d in deps[stage.name] if d in names]
+        suffix = f" (after {', '.join(after)})" if after else ""
+        print(f"[{'rebuild' if reason else 'up-to-date'}] {stage.name}{': ' + reason if reason else ''}{suffix}")
+    if dry_run:
+        return True
+
+    pending = {stage.name: stage for stage in selected if plan[stage.name]}
+    done = {stage.name for stage in selected if not plan[stage.name]}
+    failed: set = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                stage_deps = [d for d in deps[name] if d in names]
+                if any(d in failed for d in stage_deps):
+                    print(f"[skip] {name}: upstream stage failed")
+                    failed.add(name)
+                    del pending[name]
+                elif all(d in done for d in stage_deps):
+                    running[pool.submit(_run_stage, stage)] = stage
+                    del pending[name]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                if future.result() == 0:
+                    # Re-sign: a stage may rewrite files that other stages read.
+                    _record(stage, input_signature(stage)[0])
+                    done.add(stage.name)
+                else:
+                    print(f"[fail] {stage.name}: exit status {future.result()}")
+                    failed.add(stage.name)
+    return not failed
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("targets", nargs="*", help="Stages to bring up to date (default: all).")
+    parser.add_argument("--jobs", type=int, default=1, help="Stages to run concurrently.")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would be rebuilt and exit.")
+    parser.add_argument("--force", action="store_true", help="Rebuild the selected stages unconditionally.")
+    args = parser.parse_args(argv)
+
+    if not run(args.targets, jobs=args.jobs, dry_run=args.dry_run, force=args.force):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
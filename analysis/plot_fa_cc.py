@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 """Visualize FA slices highlighting the corpus callosum for young vs older subjects."""
 from pathlib import Path
+import argparse
+
 import numpy as np
-import nibabel as nib
-import matplotlib.pyplot as plt
+
+from prefetch import prefetch
+import profiling
+from render_farm import RenderJob, render, report
+from slice_scoring import SLICE_STATS, best_slices
+import volume_store
 
 ROOT = Path(__file__).resolve().parents[1]
 RESULTS = ROOT / "results"
@@ -37,38 +43,30 @@ def central_mask(shape, widths=(48, 48, 32)):
     return mask
 
 
-def slice_with_max_roi_mean(volume, axis, mask):
-    best_idx, best_mean = 0, -np.inf
-    for idx in range(volume.shape[axis]):
-        slicer = [slice(None)] * 3
-        slicer[axis] = idx
-        data_slice = volume[tuple(slicer)]
-        mask_slice = mask[tuple(slicer)]
-        roi_vals = data_slice[mask_slice]
-        if roi_vals.size == 0:
-            continue
-        mean_val = roi_vals.mean()
-        if mean_val > best_mean:
-            best_mean = mean_val
-            best_idx = idx
-    return best_idx
-
-
 def extract_slice(volume, axis, index):
     slicer = [slice(None)] * 3
     slicer[axis] = index
     return volume[tuple(slicer)]
 
 
-def main():
-    fig, axes = plt.subplots(len(SUBJECTS), len(PLANES), figsize=(12, 6))
+def load_fa(subj):
+    with profiling.span("load_fa", subject=subj["id"]):
+        return volume_store.load(subj["fa_path"]).get_fdata()
+
+
+def _render_montage(out_path, subjects, slice_stat="mean", title=None, dpi=300):
+    """One row of best axial/coronal/sagittal slices per subject."""
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(len(subjects), len(PLANES), figsize=(12, 3 * len(subjects)), squeeze=False)
     cmap = "magma"
 
-    for row, subj in enumerate(SUBJECTS):
-        data = nib.load(subj["fa_path"]).get_fdata()
+    # The next subject's FA map is decoded while this one is drawn.
+    for row, (subj, data) in enumerate(prefetch(subjects, load_fa)):
         mask = central_mask(data.shape)
+        best = best_slices(data, mask, slice_stat)
         for col, (plane_name, axis) in enumerate(PLANES):
-            idx = slice_with_max_roi_mean(data, axis, mask)
+            idx = best[axis]
             img = extract_slice(data, axis, idx)
             disp = np.rot90(img)
             ax = axes[row, col]
@@ -77,13 +75,49 @@ def main():
             ax.set_yticks([])
             ax.set_title(f"{subj['label']}\n{plane_name} idx={idx}")
 
-    fig.suptitle("Corpus Callosum FA comparison (young vs older)")
+    if title:
+        fig.suptitle(title)
     cbar = fig.colorbar(im, ax=axes.ravel().tolist(), shrink=0.6, label="FA")
     cbar.set_ticks([0.2, 0.4, 0.6, 0.8])
     fig.tight_layout(rect=[0, 0, 1, 0.97])
-    out_path = RESULTS / "fa_cc_comparison.png"
-    fig.savefig(out_path, dpi=300)
-    print(f"Saved figure to {out_path}")
+    fig.savefig(out_path, dpi=dpi)
+    plt.close(fig)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--slice-stat", choices=SLICE_STATS, default="mean",
+                        help="ROI statistic used to pick the displayed slice per plane.")
+    parser.add_argument("--qc", action="store_true",
+                        help="Also render one montage per subject under results/qc/fa_cc/.")
+    parser.add_argument("--jobs", type=int, default=1, help="Render processes for --qc figures.")
+    parser.add_argument("--force", action="store_true", help="Re-render figures even if unchanged.")
+    volume_store.add_argument(parser)
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    volume_store.configure(args.volume_store)
+    with profiling.session(args.profile, "fa-montage"):
+        jobs = [
+            RenderJob(
+                _render_montage,
+                RESULTS / "fa_cc_comparison.png",
+                kwargs={
+                    "subjects": SUBJECTS,
+                    "slice_stat": args.slice_stat,
+                    "title": "Corpus Callosum FA comparison (young vs older)",
+                },
+            )
+        ]
+        if args.qc:
+            jobs += [
+                RenderJob(
+                    _render_montage,
+                    RESULTS / "qc" / "fa_cc" / f"{subj['id']}.png",
+                    kwargs={"subjects": [subj], "slice_stat": args.slice_stat},
+                )
+                for subj in SUBJECTS
+            ]
+        report(render(jobs, workers=args.jobs, force=args.force))
 
 
 if __name__ == "__main__":
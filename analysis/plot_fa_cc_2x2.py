@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 """Compare CC FA slices and summary stats across a 2x2 age × gender design."""
 from pathlib import Path
+import argparse
 import json
 
 import numpy as np
-import nibabel as nib
-import matplotlib.pyplot as plt
+
+from prefetch import prefetch
+import profiling
+from render_farm import RenderJob, render, report
+from slice_scoring import SLICE_STATS, best_slices
+import volume_store
 
 ROOT = Path(__file__).resolve().parents[1]
 RESULTS = ROOT / "results"
@@ -56,71 +61,87 @@ def central_mask(shape, widths=(48, 48, 32)):
     return mask
 
 
-def slice_with_max_roi_mean(volume, axis, mask):
-    best_idx, best_mean = 0, -np.inf
-    for idx in range(volume.shape[axis]):
-        slicer = [slice(None)] * 3
-        slicer[axis] = idx
-        roi_slice = mask[tuple(slicer)]
-        if not roi_slice.any():
-            continue
-        val_slice = volume[tuple(slicer)][roi_slice]
-        mean_val = val_slice.mean()
-        if mean_val > best_mean:
-            best_mean = mean_val
-            best_idx = idx
-    return best_idx
-
-
 def extract_slice(volume, axis, index):
     slicer = [slice(None)] * 3
     slicer[axis] = index
     return volume[tuple(slicer)]
 
 
-def main():
+def _render_grid(out_path, panels, dpi=300):
+    """Draw ``panels`` (one per subject, each holding per-plane slices) as a 2x2 grid."""
+    import matplotlib.pyplot as plt
+
     rows = {"Young": 0, "Older": 1}
     cols = {"F": 0, "M": 1}
     fig, axes = plt.subplots(2 * len(PLANES), 2, figsize=(8, 10))
-    stats = []
-
-    for subj in SUBJECTS:
-        data = nib.load(subj["fa_path"]).get_fdata()
-        mask = central_mask(data.shape)
-        roi_mean = data[mask].mean()
-        roi_std = data[mask].std()
-        stats.append({
-            "subject": subj["id"],
-            "age_group": subj["age_group"],
-            "gender": subj["gender"],
-            "roi_mean_fa": float(roi_mean),
-            "roi_std_fa": float(roi_std),
-        })
-        base_row = rows[subj["age_group"]] * len(PLANES)
-        col = cols[subj["gender"]]
-        for plane_offset, (plane_name, axis) in enumerate(PLANES):
-            idx = slice_with_max_roi_mean(data, axis, mask)
-            slice_img = extract_slice(data, axis, idx)
+
+    for panel in panels:
+        base_row = rows[panel["age_group"]] * len(PLANES)
+        col = cols[panel["gender"]]
+        for plane_offset, (plane_name, idx, slice_img) in enumerate(panel["slices"]):
             disp = np.rot90(slice_img)
             ax = axes[base_row + plane_offset, col]
             im = ax.imshow(disp, cmap="magma", vmin=0, vmax=1)
             if col == 0:
-                ax.set_ylabel(f"{plane_name}\n{ subj['age_group'] }")
+                ax.set_ylabel(f"{plane_name}\n{ panel['age_group'] }")
             if plane_offset == 0:
-                ax.set_title(f"{subj['gender']}\n{subj['id']} idx={idx}")
+                ax.set_title(f"{panel['gender']}\n{panel['id']} idx={idx}")
             ax.set_xticks([])
             ax.set_yticks([])
 
     plt.tight_layout()
     cbar = fig.colorbar(im, ax=axes.ravel().tolist(), shrink=0.6, label="FA")
-    out_fig = RESULTS / "fa_cc_comparison_2x2.png"
-    fig.savefig(out_fig, dpi=300)
-
-    out_json = RESULTS / "fa_cc_stats.json"
-    with open(out_json, "w", encoding="utf-8") as f:
-        json.dump(stats, f, indent=2)
-    print(f"Saved figure to {out_fig}")
-    print(f"Saved stats to {out_json}")
+    fig.savefig(out_path, dpi=dpi)
+    plt.close(fig)
+
+
+def load_fa(subj):
+    with profiling.span("load_fa", subject=subj["id"]):
+        return volume_store.load(subj["fa_path"]).get_fdata()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--slice-stat", choices=SLICE_STATS, default="mean",
+                        help="ROI statistic used to pick the displayed slice per plane.")
+    parser.add_argument("--force", action="store_true", help="Re-render figures even if unchanged.")
+    volume_store.add_argument(parser)
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    volume_store.configure(args.volume_store)
+    with profiling.session(args.profile, "fa-montage-2x2"):
+        stats = []
+        panels = []
+
+        for subj, data in prefetch(SUBJECTS, load_fa):
+            mask = central_mask(data.shape)
+            roi_mean = data[mask].mean()
+            roi_std = data[mask].std()
+            stats.append({
+                "subject": subj["id"],
+                "age_group": subj["age_group"],
+                "gender": subj["gender"],
+                "roi_mean_fa": float(roi_mean),
+                "roi_std_fa": float(roi_std),
+            })
+            best = best_slices(data, mask, args.slice_stat)
+            panels.append({
+                "id": subj["id"],
+                "age_group": subj["age_group"],
+                "gender": subj["gender"],
+                "slices": [
+                    (plane_name, best[axis], extract_slice(data, axis, best[axis]).copy())
+                    for plane_name, axis in PLANES
+                ],
+            })
+
+        out_fig = RESULTS / "fa_cc_comparison_2x2.png"
+        report(render([RenderJob(_render_grid, out_fig, kwargs={"panels": panels})], force=args.force))
+
+        out_json = RESULTS / "fa_cc_stats.json"
+        with open(out_json, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+        print(f"Saved stats to {out_json}")
 
 
 if __name__ == "__main__":
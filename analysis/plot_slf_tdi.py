@@ -2,13 +2,22 @@
 """Create SLF tract density projection comparing young vs older groups."""
 from __future__ import annotations
 
+import argparse
 import math
+import os
+import sys
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict, Iterable
 
-import matplotlib.pyplot as plt
-import nibabel as nib
 import numpy as np
 
+from prefetch import prefetch
+import profiling
+from results_index import tdi_suffix
+from render_farm import RenderJob, render, report
+from volume_cache import DEFAULT_BUDGET_MB, VolumeCache
+
 ROOT = Path(__file__).resolve().parents[1]
 RESULTS = ROOT / "results"
 FIGURES = ROOT / "analysis" / "figures"
@@ -28,45 +37,231 @@ TRACTS = {
 }
 
 
-def load_tdi(subject: str, tract: str) -> np.ndarray:
-    path = (
+# Plane name -> voxel axis collapsed by the projection.
+PLANE_AXES = {"sagittal": 0, "coronal": 1, "axial": 2}
+
+# Number of slices along the last (slowest-varying on disk) axis read at once.
+SLAB_SIZE = 8
+
+
+@dataclass
+class TdiProjection:
+    shape: tuple
+    max: Dict[str, np.ndarray]
+    mean: Dict[str, np.ndarray]
+
+
+def tdi_path(subject: str, tract: str, upsample: int = 1, built: bool = False) -> Path:
+    """DSI Studio TDI export, or a ``tdi_builder`` map at ``upsample`` x the FA grid."""
+    return (
         RESULTS
         / f"{subject}_tracts"
         / tract
-        / f"{subject}_ses-01_dti.{tract}.tt.gz.tdi.nii.gz"
+        / f"{subject}_ses-01_dti.{tract}.tt.gz{tdi_suffix(upsample, built)}"
     )
-    img = nib.load(str(path))
+
+
+def _plotted_path(subject: str, tract: str, upsample: int, build: bool) -> Path:
+    # After --build, a built native-grid map replaces the export when there is one.
+    built = tdi_path(subject, tract, upsample, built=True)
+    if upsample > 1 or (build and built.exists()):
+        return built
+    return tdi_path(subject, tract)
+
+
+def load_tdi(subject: str, tract: str, upsample: int = 1, built: bool = False) -> np.ndarray:
+    import nibabel as nib
+
+    img = nib.load(str(tdi_path(subject, tract, upsample, built)))
     data = img.get_fdata(dtype=np.float32)
     return data
 
 
-def prepare_projection(volume: np.ndarray) -> np.ndarray:
-    # Sum both hemispheres, normalize, and compute coronal max projection.
-    if volume.max() > 0:
-        volume = volume / volume.max()
-    mip = volume.max(axis=0)  # collapse left-right axis -> coronal view
+def project_tdi(paths: Iterable[Path], slab_size: int = SLAB_SIZE, volumes=None) -> TdiProjection:
+    """Max/mean projections of the voxelwise sum of several TDI volumes.
+
+    The grid comes from the NIfTI headers. Volumes are streamed through their
+    ``dataobj`` proxies slab by slab along the last axis, which is contiguous
+    on disk, so only one slab per tract is resident at a time. Paths found in
+    ``volumes`` (``str(path) -> volume_cache.SharedVolume``) are read from
+    shared memory instead.
+    """
+    import nibabel as nib
+    from volume_cache import attach
+
+    volumes = volumes or {}
+    with profiling.span("project_tdi"):
+        sources = [
+            attach(volumes[str(path)]) if str(path) in volumes
+            else nib.load(str(path), keep_file_open=True).dataobj
+            for path in paths
+        ]
+        return _project_tdi(sources, slab_size)
+
+
+def _project_tdi(sources, slab_size: int) -> TdiProjection:
+    """``sources`` are array-likes sliceable along the last axis (proxies or arrays)."""
+    if not sources:
+        raise ValueError("No TDI volumes to project")
+    shape = tuple(sources[0].shape[:3])
+    for src in sources[1:]:
+        if tuple(src.shape[:3]) != shape:
+            raise ValueError(f"TDI grid mismatch: {src.shape[:3]} vs {shape}")
+
+    nx, ny, nz = shape
+    maxes = {
+        "sagittal": np.full((ny, nz), -np.inf, dtype=np.float32),
+        "coronal": np.empty((nx, nz), dtype=np.float32),
+        "axial": np.full((nx, ny), -np.inf, dtype=np.float32),
+    }
+    sums = {
+        "sagittal": np.zeros((ny, nz), dtype=np.float64),
+        "coronal": np.zeros((nx, nz), dtype=np.float64),
+        "axial": np.zeros((nx, ny), dtype=np.float64),
+    }
+    slab = np.empty((nx, ny, min(slab_size, nz)), dtype=np.float32)
+    for start in range(0, nz, slab_size):
+        stop = min(start + slab_size, nz)
+        block = slab[:, :, : stop - start]
+        block.fill(0)
+        for src in sources:
+            block += np.asarray(src[:, :, start:stop], dtype=np.float32)
+        maxes["sagittal"][:, start:stop] = block.max(axis=0)
+        sums["sagittal"][:, start:stop] = block.sum(axis=0)
+        maxes["coronal"][:, start:stop] = block.max(axis=1)
+        sums["coronal"][:, start:stop] = block.sum(axis=1)
+        np.maximum(maxes["axial"], block.max(axis=2), out=maxes["axial"])
+        sums["axial"] += block.sum(axis=2)
+
+    means = {
+        plane: (total / shape[PLANE_AXES[plane]]).astype(np.float32)
+        for plane, total in sums.items()
+    }
+    return TdiProjection(shape=shape, max=maxes, mean=means)
+
+
+def render_projection(mip: np.ndarray) -> np.ndarray:
+    # Normalize by the volume maximum (= MIP maximum) and enhance contrast.
+    if mip.max() > 0:
+        mip = mip / mip.max()
     mip = np.log1p(mip * 20)  # enhance contrast for visualization
     mip = np.flipud(np.rot90(mip))  # orient superior at top
     return mip
 
 
-def main() -> None:
+def prepare_projection(volume: np.ndarray) -> np.ndarray:
+    # Sum both hemispheres, normalize, and compute coronal max projection.
+    return render_projection(volume.max(axis=0))  # collapse left-right axis
+
+
+def _render_group(out_path: Path, panels, dpi: int = 300, volumes=None) -> None:
+    """2x2 grid of left-right MIPs; ``panels`` is a list of (label, TDI paths)."""
+    import matplotlib.pyplot as plt
+
     fig, axes = plt.subplots(2, 2, figsize=(8, 7))
-    for ax, subj in zip(axes.flatten(), SUBJECTS):
-        combined = np.zeros((128, 128, 88), dtype=np.float32)
-        for tract in TRACTS.values():
-            combined += load_tdi(subj["id"], tract)
-        projection = prepare_projection(combined)
+    # Later subjects are read and projected while earlier panels are drawn.
+    panel_projections = prefetch(panels, lambda panel: project_tdi(panel[1], volumes=volumes))
+    for ax, ((label, _), projections) in zip(axes.flatten(), panel_projections):
+        projection = render_projection(projections.max["sagittal"])
         im = ax.imshow(projection, cmap="inferno", interpolation="nearest")
-        ax.set_title(subj["label"], fontsize=10)
+        ax.set_title(label, fontsize=10)
         ax.axis("off")
 
     fig.suptitle("Superior Longitudinal Fasciculus • Tract Density Projection", fontsize=14)
     fig.tight_layout(rect=[0, 0.02, 1, 0.95])
-    output_path = FIGURES / "slf_group_comparison.png"
-    fig.savefig(output_path, dpi=300)
+    fig.savefig(out_path, dpi=dpi)
     plt.close(fig)
-    print(f"Saved {output_path}")
+
+
+def _render_subject_planes(out_path: Path, label: str, paths, dpi: int = 300, volumes=None) -> None:
+    """Sagittal, coronal and axial MIPs of one subject's summed TDI maps."""
+    import matplotlib.pyplot as plt
+
+    projections = project_tdi(paths, volumes=volumes)
+    fig, axes = plt.subplots(1, len(PLANE_AXES), figsize=(10, 3.5))
+    for ax, plane in zip(axes, PLANE_AXES):
+        ax.imshow(render_projection(projections.max[plane]), cmap="inferno", interpolation="nearest")
+        ax.set_title(plane.capitalize(), fontsize=10)
+        ax.axis("off")
+    fig.suptitle(f"SLF tract density • {label}", fontsize=12)
+    fig.tight_layout(rect=[0, 0.02, 1, 0.92])
+    fig.savefig(out_path, dpi=dpi)
+    plt.close(fig)
+
+
+def _job_paths(job: RenderJob):
+    if "panels" in job.kwargs:
+        return [path for _, paths in job.kwargs["panels"] for path in paths]
+    return list(job.kwargs["paths"])
+
+
+def _share_volumes(cache: VolumeCache, paths) -> Dict[str, object]:
+    """``str(path) -> SharedVolume`` for the maps that fit in the cache budget."""
+    volumes = {}
+    for path in dict.fromkeys(map(str, paths)):
+        try:
+            with profiling.span("share_volume", path=os.path.basename(path)):
+                volumes[path] = cache.acquire(path, "float32")
+        except MemoryError as exc:
+            print(f"[no-share] {exc}", file=sys.stderr)
+    return volumes
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--qc", action="store_true",
+                        help="Also render per-subject projections under results/qc/slf_tdi/.")
+    parser.add_argument("--jobs", type=int, default=1, help="Render processes.")
+    parser.add_argument("--force", action="store_true", help="Re-render figures even if unchanged.")
+    parser.add_argument("--cache-mb", type=float, default=DEFAULT_BUDGET_MB,
+                        help="Shared-memory budget for TDI maps decoded once for all render processes.")
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help=(
+            "Build missing or stale TDI maps from the .tt.gz files first (tdi_builder) "
+            "and plot them in place of the DSI Studio exports."
+        ),
+    )
+    parser.add_argument("--upsample", type=int, default=1,
+                        help="Use TDI maps built at this multiple of the FA grid.")
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    with profiling.session(args.profile, "slf-tdi"):
+        if args.build:
+            import tdi_builder
+
+            _, failures = tdi_builder.build_tdis(
+                [subj["id"] for subj in SUBJECTS], list(TRACTS.values()), args.upsample, args.jobs
+            )
+            for subject, error in failures.items():
+                print(f"[skip] {subject}: {error}", file=sys.stderr)
+        panels = [
+            (
+                subj["label"],
+                [_plotted_path(subj["id"], tract, args.upsample, args.build) for tract in TRACTS.values()],
+            )
+            for subj in SUBJECTS
+        ]
+        jobs = [RenderJob(_render_group, FIGURES / "slf_group_comparison.png", kwargs={"panels": panels})]
+        if args.qc:
+            jobs += [
+                RenderJob(
+                    _render_subject_planes,
+                    RESULTS / "qc" / "slf_tdi" / f"{subj['id']}.png",
+                    kwargs={"label": label, "paths": paths},
+                )
+                for subj, (label, paths) in zip(SUBJECTS, panels)
+            ]
+        with VolumeCache(args.cache_mb) as cache:
+            stale = [job for job in jobs if args.force or not job.is_current()]
+            if args.jobs > 1 and len(stale) > 1:
+                # The group figure and the QC figures read the same maps:
+                # decode each once and let every worker map it.
+                volumes = _share_volumes(cache, [p for job in stale for p in _job_paths(job)])
+                for job in stale:
+                    job.shared = {"volumes": volumes}
+            report(render(jobs, workers=args.jobs, force=args.force))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Load the next subjects' volumes in the background while the current one is processed.
+
+``prefetch(items, load)`` yields ``(item, load(item))`` in input order while
+up to ``depth`` later loads run on a small thread pool. Decompressing a
+``.nii.gz`` spends most of its time in zlib, which releases the GIL, as do
+the large NumPy operations that follow, so subject N+1 is decoded while
+subject N is summarised or drawn. At most ``depth + 1`` loaded results are
+alive at once (the one being consumed and those in flight).
+
+    for subj, (fa, atlas) in prefetch(SUBJECTS, lambda s: load_pair(s["id"])):
+        ...
+
+An exception raised by ``load`` is re-raised when its item is reached, after
+the items before it have been yielded. Closing the generator early cancels
+loads that have not started and waits for the running ones.
+"""
+from __future__ import annotations
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Loads kept in flight ahead of the consumer.
+PREFETCH_DEPTH = 2
+
+
+def prefetch(
+    items: Iterable[T],
+    load: Callable[[T], R],
+    depth: int = PREFETCH_DEPTH,
+    workers: Optional[int] = None,
+) -> Iterator[Tuple[T, R]]:
+    """``(item, load(item))`` pairs in order, loading ahead on ``workers`` threads.
+
+    ``workers`` defaults to ``depth``. ``depth <= 0`` loads each item in the
+    calling thread when it is reached.
+    """
+    if depth <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+
+    items = iter(items)
+    pending = collections.deque()
+    pool = ThreadPoolExecutor(max_workers=workers or depth, thread_name_prefix="prefetch")
+    try:
+        for item in items:
+            pending.append((item, pool.submit(load, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            # Refill before yielding so the next load overlaps the consumer.
+            for next_item in items:
+                pending.append((next_item, pool.submit(load, next_item)))
+                break
+            yield item, result
+            del result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
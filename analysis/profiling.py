@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Opt-in stage/subject instrumentation exported as a Chrome trace.
+
+Scripts accept ``--profile [TRACE]``. While a profiling session is active,
+every ``span(name, **args)`` records wall time, process CPU time, how far
+the process's peak RSS rose while it ran (``ru_maxrss`` at exit minus at
+entry; a span that stays below an earlier peak records 0), bytes read
+(``rchar`` from ``/proc/self/io``) and files opened (counted by an audit
+hook on the ``open`` event). The session writes
+a Chrome-trace JSON (load it in ``chrome://tracing`` or ui.perfetto.dev), a
+per-span summary CSV next to it, and prints the summary table to stderr.
+
+With profiling off, ``span`` costs one global lookup.
+
+Spans recorded inside pool workers are shipped back with ``collect`` and
+added to the parent's trace with ``merge``; they keep their own pid/tid, so
+each worker appears as its own track.
+"""
+from __future__ import annotations
+
+import contextlib
+import csv
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+PROFILE_DIR = os.path.join(PROJECT_ROOT, "results", "profile")
+
+SUMMARY_FIELDS = ["span", "calls", "wall_s", "cpu_s", "maxrss_growth_mb", "bytes_read", "files_opened"]
+
+_EVENTS: Optional[List[Dict[str, Any]]] = None
+_FILES_OPENED = 0
+# The audit hook fires on whichever thread opens the file (e.g. prefetch
+# workers), so the counter's read-modify-write is serialised.
+_FILES_LOCK = threading.Lock()
+_HOOK_INSTALLED = False
+_IO_FD: Optional[Tuple[int, int]] = None  # (pid, fd) of /proc/self/io
+
+
+def _audit(event: str, args) -> None:
+    global _FILES_OPENED
+    if event == "open" and _EVENTS is not None:
+        with _FILES_LOCK:
+            _FILES_OPENED += 1
+
+
+def _bytes_read() -> int:
+    # The fd is opened once per process with os.open before the hook counts,
+    # and re-read with pread, so sampling does not show up as opened files.
+    global _IO_FD
+    pid = os.getpid()
+    if _IO_FD is None or _IO_FD[0] != pid:
+        try:
+            _IO_FD = (pid, os.open("/proc/self/io", os.O_RDONLY))
+        except OSError:
+            _IO_FD = (pid, -1)
+    if _IO_FD[1] < 0:
+        return 0
+    for line in os.pread(_IO_FD[1], 4096, 0).split(b"\n"):
+        if line.startswith(b"rchar:"):
+            return int(line.split()[1])
+    return 0
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux; it is process-wide and never falls.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def enabled() -> bool:
+    return _EVENTS is not None
+
+
+def enable() -> None:
+    """Start recording spans in this process (idempotent)."""
+    global _EVENTS, _HOOK_INSTALLED
+    if _EVENTS is not None:
+        return
+    _bytes_read()
+    if not _HOOK_INSTALLED:
+        # Audit hooks cannot be removed; the hook is a no-op while disabled.
+        sys.addaudithook(_audit)
+        _HOOK_INSTALLED = True
+    _EVENTS = []
+
+
+def disable() -> List[Dict[str, Any]]:
+    """Stop recording and return the recorded events."""
+    global _EVENTS
+    events, _EVENTS = _EVENTS or [], None
+    return events
+
+
+@contextlib.contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """Record the enclosed block as one trace event when profiling is on."""
+    if _EVENTS is None:
+        yield
+        return
+    opened0 = _FILES_OPENED
+    read0 = _bytes_read()
+    maxrss0 = _max_rss_mb()
+    cpu0 = time.process_time()
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        if _EVENTS is not None:
+            _EVENTS.append({
+                "name": name,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {
+                    **{k: str(v) for k, v in args.items()},
+                    "cpu_s": time.process_time() - cpu0,
+                    "maxrss_growth_mb": _max_rss_mb() - maxrss0,
+                    "bytes_read": _bytes_read() - read0,
+                    "files_opened": _FILES_OPENED - opened0,
+                },
+            })
+
+
+def collect(func: Callable[..., Any], *args: Any) -> Tuple[Any, List[Dict[str, Any]]]:
+    """Run ``func(*args)`` in a pool worker and return its result and spans."""
+    enable()
+    # A forked worker inherits the parent's events; only ship its own.
+    _EVENTS.clear()
+    _bytes_read()
+    result = func(*args)
+    events = list(_EVENTS)
+    _EVENTS.clear()
+    return result, events
+
+
+def merge(events: List[Dict[str, Any]]) -> None:
+    if _EVENTS is not None:
+        _EVENTS.extend(events)
+
+
+def summary_rows(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Per span name: calls and summed (inclusive) time, peak-RSS growth and IO."""
+    rows: Dict[str, Dict[str, Any]] = {}
+    for event in events:
+        row = rows.setdefault(event["name"], {
+            "span": event["name"], "calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+            "maxrss_growth_mb": 0.0, "bytes_read": 0, "files_opened": 0,
+        })
+        info = event["args"]
+        row["calls"] += 1
+        row["wall_s"] += event["dur"] / 1e6
+        row["cpu_s"] += info["cpu_s"]
+        row["maxrss_growth_mb"] += info["maxrss_growth_mb"]
+        row["bytes_read"] += info["bytes_read"]
+        row["files_opened"] += info["files_opened"]
+    return sorted(rows.values(), key=lambda r: r["wall_s"], reverse=True)
+
+
+def format_summary(rows: List[Dict[str, Any]]) -> str:
+    width = max([len("span")] + [len(r["span"]) for r in rows])
+    lines = [
+        f"{'span':<{width}} {'calls':>6} {'wall (s)':>9} {'cpu (s)':>9} "
+        f"{'peak +RSS (MB)':>15} {'read (MB)':>10} {'opened':>7}"
+    ]
+    for r in rows:
+        lines.append(
+            f"{r['span']:<{width}} {r['calls']:>6} {r['wall_s']:>9.3f} {r['cpu_s']:>9.3f} "
+            f"{r['maxrss_growth_mb']:>15.1f} {r['bytes_read'] / 2**20:>10.1f} {r['files_opened']:>7}"
+        )
+    return "\n".join(lines)
+
+
+def write_trace(path: str, events: List[Dict[str, Any]], process_name: str = "") -> None:
+    """Chrome trace-event JSON; each pid is labelled ``process_name`` (+ worker)."""
+    meta = []
+    main_pid = os.getpid()
+    for pid in sorted({e["pid"] for e in events}):
+        label = process_name if pid == main_pid else f"{process_name} worker {pid}"
+        meta.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": label}})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
+
+
+def add_argument(parser) -> None:
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="TRACE",
+        help=(
+            "Record per-stage/per-subject wall, CPU, peak-RSS growth and I/O. Writes a "
+            "Chrome-trace JSON (default: results/profile/<stage>.trace.json) and a summary."
+        ),
+    )
+
+
+@contextlib.contextmanager
+def session(trace_path: Optional[str], name: str) -> Iterator[None]:
+    """Profile the enclosed run as span ``name`` when ``trace_path`` is not None."""
+    if trace_path is None:
+        yield
+        return
+    trace_path = trace_path or os.path.join(PROFILE_DIR, f"{name}.trace.json")
+    enable()
+    try:
+        with span(name):
+            yield
+    finally:
+        events = disable()
+        write_trace(trace_path, events, process_name=name)
+        rows = summary_rows(events)
+        stem = trace_path[: -len(".trace.json")] if trace_path.endswith(".trace.json") else os.path.splitext(trace_path)[0]
+        summary_path = stem + ".summary.csv"
+        with open(summary_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(format_summary(rows), file=sys.stderr)
+        print(f"Wrote trace to {trace_path} and summary to {summary_path}", file=sys.stderr)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Headless, process-parallel figure rendering that skips unchanged outputs.
+
+Each output gets a ``<figure>.sha256`` sidecar holding a hash of the render
+function (its name, and the source of its module and of the sibling modules
+that module imports), its plot parameters and its input data. A job whose
+hash matches the sidecar (and whose figure exists) is not rendered again.
+"""
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import profiling
+
+HASH_SUFFIX = ".sha256"
+
+
+def _update(digest, part) -> None:
+    if isinstance(part, Path):
+        # Files are identified by path, size and mtime rather than re-read.
+        try:
+            st = part.stat()
+        except OSError:
+            digest.update(f"missing:{part}".encode())
+        else:
+            digest.update(f"file:{part.resolve()}:{st.st_size}:{st.st_mtime_ns}".encode())
+    elif hasattr(part, "__array__") and hasattr(part, "dtype"):
+        import numpy as np
+
+        arr = np.ascontiguousarray(part)
+        digest.update(f"array:{arr.dtype.str}:{arr.shape}".encode())
+        digest.update(arr.tobytes())
+    elif hasattr(part, "to_numpy") and hasattr(part, "columns"):
+        _update(digest, [list(map(str, part.columns)), part.to_numpy()])
+    elif isinstance(part, dict):
+        digest.update(b"dict")
+        for key in sorted(part, key=str):
+            _update(digest, str(key))
+            _update(digest, part[key])
+    elif isinstance(part, (list, tuple)):
+        digest.update(f"seq:{len(part)}".encode())
+        for item in part:
+            _update(digest, item)
+    else:
+        digest.update(json.dumps(part, default=repr).encode())
+
+
+def content_hash(*parts: Any) -> str:
+    """Stable hash of arrays, DataFrames, files (by identity) and JSON-like values."""
+    digest = hashlib.sha256()
+    for part in parts:
+        _update(digest, part)
+    return digest.hexdigest()
+
+
+def code_digest(func: Callable[..., Any]) -> str:
+    """Hash of the source of ``func``'s module and the sibling modules it imports.
+
+    The helpers that decide the pixels (``project_tdi``, ``best_slices`` ...)
+    live there, so editing any of them re-renders the figures drawn with
+    ``func``. Falls back to ``func``'s bytecode and constants when it has no
+    source file.
+    """
+    from pipeline import script_modules
+
+    try:
+        source_file = inspect.getsourcefile(func)
+    except TypeError:
+        source_file = None
+    if not source_file or not Path(source_file).is_file():
+        code = func.__code__
+        return hashlib.sha256(code.co_code + repr(code.co_consts).encode()).hexdigest()
+    path = Path(source_file)
+    digest = hashlib.sha256()
+    for name in script_modules(path.name, str(path.parent)):
+        digest.update(f"{name}:".encode())
+        digest.update((path.parent / name).read_bytes())
+    return digest.hexdigest()
+
+
+@dataclass
+class RenderJob:
+    """``func(out_path, **kwargs)`` must be a module-level (picklable) function.
+
+    ``inputs`` only feeds the hash; pass file paths there when the worker loads
+    the data itself, so unchanged figures are skipped without reading inputs.
+    ``shared`` is passed to ``func`` like ``kwargs`` but not hashed; it is for
+    handles to data the hashed arguments already identify, such as
+    ``volume_cache.SharedVolume`` views of input files.
+    """
+
+    func: Callable[..., Any]
+    out_path: Path
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    inputs: Any = None
+    shared: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def digest(self) -> str:
+        # The defining file, not __module__, so "__main__" runs hash the same.
+        name = f"{Path(self.func.__code__.co_filename).name}:{self.func.__qualname__}"
+        return content_hash(name, code_digest(self.func), self.kwargs, self.inputs)
+
+    @property
+    def hash_path(self) -> Path:
+        return self.out_path.with_name(self.out_path.name + HASH_SUFFIX)
+
+    def is_current(self, digest: Optional[str] = None) -> bool:
+        if not self.out_path.exists() or not self.hash_path.exists():
+            return False
+        digest = digest if digest is not None else self.digest
+        return self.hash_path.read_text(encoding="utf-8").strip() == digest
+
+
+def use_headless_backend() -> None:
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def _run(job: RenderJob) -> Path:
+    use_headless_backend()
+    with profiling.span("render", figure=job.out_path.name):
+        job.func(job.out_path, **job.kwargs, **job.shared)
+    return job.out_path
+
+
+def render(jobs: Iterable[RenderJob], workers: int = 1, force: bool = False) -> List[Tuple[Path, str]]:
+    """Render stale jobs (all of them with ``force``) and return ``(path, status)``.
+
+    Status is ``"rendered"``, ``"skipped"`` or ``"failed: <error>"``; a failing
+    figure does not stop the others.
+    """
+    jobs = list(jobs)
+    digests = [job.digest for job in jobs]
+    status: Dict[int, str] = {}
+    pending = []
+    for i, (job, digest) in enumerate(zip(jobs, digests)):
+        if not force and job.is_current(digest):
+            status[i] = "skipped"
+        else:
+            job.out_path.parent.mkdir(parents=True, exist_ok=True)
+            pending.append(i)
+
+    def finish(i: int, error: Optional[Exception] = None) -> None:
+        if error is not None:
+            status[i] = f"failed: {error}"
+            return
+        jobs[i].hash_path.write_text(digests[i] + "\n", encoding="utf-8")
+        status[i] = "rendered"
+
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_headless_backend) as pool:
+            if profiling.enabled():
+                futures = {i: pool.submit(profiling.collect, _run, jobs[i]) for i in pending}
+            else:
+                futures = {i: pool.submit(_run, jobs[i]) for i in pending}
+            for i, future in futures.items():
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    finish(i, exc)
+                else:
+                    if profiling.enabled():
+                        profiling.merge(result[1])
+                    finish(i)
+    else:
+        for i in pending:
+            try:
+                _run(jobs[i])
+            except Exception as exc:
+                finish(i, exc)
+            else:
+                finish(i)
+
+    return [(job.out_path, status[i]) for i, job in enumerate(jobs)]
+
+
+def report(results: Iterable[Tuple[Path, str]]) -> None:
+    for path, status in results:
+        print(f"[{status}] {path}")
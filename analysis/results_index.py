@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Persistent manifest of DSI Studio outputs under ``results/``.
+
+The tree is walked once and every directory listing is cached together with
+the directory mtime. Later refreshes only re-list directories whose mtime
+changed, so an unchanged tree costs one ``stat`` per directory instead of a
+recursive glob per subject and tract.
+
+Expected layout::
+
+    results/{subject}_wholebrain.tt.gz.stat.txt
+    results/{subject}_ses-01_dti.fib.gz.fa.nii.gz
+    results/{subject}_tracts/{tract}/**/*.stat.txt
+    results/{subject}_tracts/{tract}/**/*.tdi.nii.gz
+    results/{subject}_tracts/{tract}/**/*.tt.gz
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from typing import Dict, List, Optional
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+
+INDEX_FILENAME = ".results_index.json"
+INDEX_VERSION = 2
+
+TRACTS_DIR_SUFFIX = "_tracts"
+WHOLEBRAIN_SUFFIX = "_wholebrain.tt.gz.stat.txt"
+FA_SUFFIX = ".fib.gz.fa.nii.gz"
+STAT_SUFFIX = ".stat.txt"
+TDI_SUFFIX = ".tdi.nii.gz"
+BUILT_TDI_SUFFIX = ".tdi_built.nii.gz"
+TRACT_SUFFIX = ".tt.gz"
+
+
+def tdi_suffix(upsample: int = 1, built: bool = False) -> str:
+    """Suffix of a TDI map next to its ``.tt.gz``.
+
+    ``.tdi.nii.gz`` is DSI Studio's own export. Maps written by
+    ``tdi_builder`` get ``.tdi_built.nii.gz`` (``.tdi_built2x.nii.gz`` ... at
+    ``upsample`` x the FA grid), so they never replace an export; only
+    exports are indexed.
+    """
+    if upsample == 1 and not built:
+        return TDI_SUFFIX
+    return BUILT_TDI_SUFFIX if upsample == 1 else f".tdi_built{upsample}x.nii.gz"
+
+
+def _new_subject_entry() -> Dict[str, object]:
+    return {"wholebrain_stat": None, "fa": None, "tracts": {}}
+
+
+class ResultsIndex:
+    """Subject -> tract -> stat/TDI/tract/FA paths, refreshed from directory mtimes."""
+
+    def __init__(self, results_dir: str = RESULTS_DIR, index_path: Optional[str] = None):
+        self.results_dir = results_dir
+        self.index_path = index_path or os.path.join(results_dir, INDEX_FILENAME)
+        self._dirs: Dict[str, Dict[str, object]] = {}
+        self._subjects: Dict[str, Dict[str, object]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return
+        if payload.get("version") != INDEX_VERSION:
+            return
+        self._dirs = payload.get("dirs", {})
+        self._subjects = payload.get("subjects", {})
+
+    def save(self) -> None:
+        payload = {
+            "version": INDEX_VERSION,
+            "dirs": self._dirs,
+            "subjects": self._subjects,
+        }
+        tmp_path = f"{self.index_path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, self.index_path)
+
+    def refresh(self, full: bool = False, save: bool = True) -> "ResultsIndex":
+        """Re-list directories whose mtime changed and rebuild the manifest.
+
+        ``full`` ignores the cached listings and re-lists every directory.
+        """
+        cached = {} if full else self._dirs
+        dirs: Dict[str, Dict[str, object]] = {}
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = os.path.join(self.results_dir, rel_dir) if rel_dir else self.results_dir
+            try:
+                mtime_ns = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue
+            entry = cached.get(rel_dir)
+            if entry is None or entry.get("mtime_ns") != mtime_ns:
+                entry = self._list_dir(abs_dir, mtime_ns)
+            dirs[rel_dir] = entry
+            for name in entry["subdirs"]:
+                stack.append(os.path.join(rel_dir, name) if rel_dir else name)
+
+        self._dirs = dirs
+        self._subjects = self._build_manifest(dirs)
+        if save:
+            self.save()
+        return self
+
+    @staticmethod
+    def _list_dir(abs_dir: str, mtime_ns: int) -> Dict[str, object]:
+        files: List[str] = []
+        subdirs: List[str] = []
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                # Hidden entries are skipped, matching glob("**") semantics.
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith((STAT_SUFFIX, TDI_SUFFIX, TRACT_SUFFIX, FA_SUFFIX)):
+                    files.append(entry.name)
+        return {"mtime_ns": mtime_ns, "files": sorted(files), "subdirs": sorted(subdirs)}
+
+    @staticmethod
+    def _build_manifest(dirs: Dict[str, Dict[str, object]]) -> Dict[str, Dict[str, object]]:
+        subjects: Dict[str, Dict[str, object]] = {}
+        for rel_dir in sorted(dirs):
+            files = dirs[rel_dir]["files"]
+            if not rel_dir:
+                for name in files:
+                    if not name.startswith("sub-"):
+                        continue
+                    subject = name.split("_")[0]
+                    if name.endswith(WHOLEBRAIN_SUFFIX):
+                        subjects.setdefault(subject, _new_subject_entry())["wholebrain_stat"] = name
+                    elif name.endswith(FA_SUFFIX):
+                        subjects.setdefault(subject, _new_subject_entry())["fa"] = name
+                continue
+
+            parts = rel_dir.split(os.sep)
+            if len(parts) < 2 or not parts[0].endswith(TRACTS_DIR_SUFFIX):
+                continue
+            subject = parts[0][: -len(TRACTS_DIR_SUFFIX)]
+            tract = parts[1]
+            tracts = subjects.setdefault(subject, _new_subject_entry())["tracts"]
+            tract_entry = tracts.setdefault(tract, {"stat": [], "tdi": [], "tt": []})
+            for name in files:
+                rel_path = os.path.join(rel_dir, name)
+                if name.endswith(STAT_SUFFIX):
+                    tract_entry["stat"].append(rel_path)
+                elif name.endswith(TDI_SUFFIX):
+                    tract_entry["tdi"].append(rel_path)
+                elif name.endswith(TRACT_SUFFIX):
+                    tract_entry["tt"].append(rel_path)
+
+        for entry in subjects.values():
+            for tract_entry in entry["tracts"].values():
+                tract_entry["stat"].sort()
+                tract_entry["tdi"].sort()
+                tract_entry["tt"].sort()
+        return subjects
+
+    def _abs(self, rel_path: Optional[str]) -> Optional[str]:
+        if rel_path is None:
+            return None
+        return os.path.join(self.results_dir, rel_path)
+
+    def subjects(self) -> List[str]:
+        return sorted(self._subjects)
+
+    def tracts(self, subject: str) -> List[str]:
+        return sorted(self._subjects.get(subject, {}).get("tracts", {}))
+
+    def wholebrain_stat(self, subject: str) -> Optional[str]:
+        return self._abs(self._subjects.get(subject, {}).get("wholebrain_stat"))
+
+    def fa_map(self, subject: str) -> Optional[str]:
+        return self._abs(self._subjects.get(subject, {}).get("fa"))
+
+    def stat_files(self, subject: str, tract: str) -> List[str]:
+        """All ``*.stat.txt`` below ``{subject}_tracts/{tract}``, sorted."""
+        tract_entry = self._subjects.get(subject, {}).get("tracts", {}).get(tract, {})
+        return [self._abs(p) for p in tract_entry.get("stat", [])]
+
+    def tdi_files(self, subject: str, tract: str) -> List[str]:
+        tract_entry = self._subjects.get(subject, {}).get("tracts", {}).get(tract, {})
+        return [self._abs(p) for p in tract_entry.get("tdi", [])]
+
+    def tract_files(self, subject: str, tract: str) -> List[str]:
+        """DSI Studio ``*.tt.gz`` streamline files for ``subject``/``tract``."""
+        tract_entry = self._subjects.get(subject, {}).get("tracts", {}).get(tract, {})
+        return [self._abs(p) for p in tract_entry.get("tt", [])]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--full", action="store_true", help="Re-list every directory.")
+    args = parser.parse_args()
+
+    index = ResultsIndex(args.results_dir).refresh(full=args.full)
+    subjects = index.subjects()
+    n_tracts = sum(len(index.tracts(s)) for s in subjects)
+    print(f"Indexed {len(subjects)} subjects, {n_tracts} subject-tract entries -> {index.index_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Single-pass ROI statistics for every label of an integer atlas volume."""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_PERCENTILES = (5, 25, 75, 95)
+
+
+def _percentile_name(q) -> str:
+    return f"p{q:02g}" if float(q).is_integer() else f"p{q:g}"
+
+
+def stat_names(percentiles=DEFAULT_PERCENTILES):
+    return ["count", "mean", "std", "min", "median", "max"] + [
+        _percentile_name(q) for q in percentiles
+    ]
+
+
+def label_stats_array(values, labels, percentiles=DEFAULT_PERCENTILES, include_background=False):
+    """Per-label statistics from one sort of the voxels by (label, value).
+
+    Returns ``(label_ids, names, table)`` where ``table`` has one row per label
+    and one column per entry of ``names``. Non-finite values are ignored, std
+    uses ``ddof=0`` and percentiles use linear interpolation, matching the
+    NumPy defaults used by ``cc_freesurfer_stats.compute_stats``.
+    """
+    values = np.asarray(values).ravel()
+    labels = np.rint(np.asarray(labels)).astype(np.int64, copy=False).ravel()
+    if values.shape != labels.shape:
+        raise ValueError(f"Value/label size mismatch: {values.shape} vs {labels.shape}")
+
+    keep = np.isfinite(values)
+    if not include_background:
+        keep &= labels != 0
+    values = values[keep].astype(np.float64, copy=False)
+    labels = labels[keep]
+
+    names = stat_names(percentiles)
+    if values.size == 0:
+        return np.empty(0, dtype=np.int64), names, np.empty((0, len(names)))
+
+    order = np.lexsort((values, labels))
+    values = values[order]
+    labels = labels[order]
+
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    counts = np.diff(np.r_[starts, labels.size])
+    label_ids = labels[starts]
+
+    means = np.add.reduceat(values, starts) / counts
+    dev = values - np.repeat(means, counts)
+    stds = np.sqrt(np.add.reduceat(dev * dev, starts) / counts)
+
+    def quantile(q):
+        pos = starts + (counts - 1) * (q / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+    columns = [
+        counts.astype(np.float64),
+        means,
+        stds,
+        values[starts],
+        quantile(50),
+        values[starts + counts - 1],
+    ] + [quantile(q) for q in percentiles]
+    return label_ids, names, np.column_stack(columns)
+
+
+def label_stats(values, labels, percentiles=DEFAULT_PERCENTILES, include_background=False) -> pd.DataFrame:
+    """Long-format ``label, stat, value`` table for every label in ``labels``."""
+    label_ids, names, table = label_stats_array(
+        values, labels, percentiles=percentiles, include_background=include_background
+    )
+    return pd.DataFrame(
+        {
+            "label": np.repeat(label_ids, len(names)),
+            "stat": np.tile(names, len(label_ids)),
+            "value": table.ravel(),
+        }
+    )
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Vectorized per-slice ROI scoring used to pick display slices."""
+from __future__ import annotations
+
+import warnings
+
+import numpy as np
+
+SLICE_STATS = ("mean", "median", "sum", "max", "count")
+
+
+def _plane_reductions(volume, mask, stat):
+    """Per-slice scores for axes 0, 1 and 2.
+
+    Sum-like statistics reduce the volume to the (x, y) plane once and reuse
+    it for axes 0 and 1, so the three planes cost two passes over the volume.
+    """
+    counts_xy = mask.sum(axis=2)
+    counts = (counts_xy.sum(axis=1), counts_xy.sum(axis=0), mask.sum(axis=(0, 1)))
+    if stat == "count":
+        return counts, counts
+    if stat in ("mean", "sum"):
+        sums_xy = np.sum(volume, axis=2, where=mask, dtype=np.float64)
+        sums = (sums_xy.sum(axis=1), sums_xy.sum(axis=0),
+                np.sum(volume, axis=(0, 1), where=mask, dtype=np.float64))
+        if stat == "sum":
+            return sums, counts
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return tuple(s / np.maximum(c, 1) for s, c in zip(sums, counts)), counts
+    if stat == "max":
+        max_xy = np.max(volume, axis=2, where=mask, initial=-np.inf)
+        return (max_xy.max(axis=1), max_xy.max(axis=0),
+                np.max(volume, axis=(0, 1), where=mask, initial=-np.inf)), counts
+    if stat == "median":
+        masked = np.where(mask, volume, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return (np.nanmedian(masked, axis=(1, 2)),
+                    np.nanmedian(masked, axis=(0, 2)),
+                    np.nanmedian(masked, axis=(0, 1))), counts
+    raise ValueError(f"Unknown slice stat {stat!r}; expected one of {SLICE_STATS}")
+
+
+def slice_scores(volume, mask, stat="mean"):
+    """Score every slice of every plane of a 3-D ``volume`` within ``mask``.
+
+    Returns a tuple of three float arrays (one per axis). Slices without mask
+    voxels, or whose score is NaN, score ``-inf`` so they are never selected.
+    """
+    volume = np.asarray(volume)
+    mask = np.asarray(mask, dtype=bool)
+    if volume.ndim != 3 or volume.shape != mask.shape:
+        raise ValueError(f"Expected matching 3-D volume and mask, got {volume.shape} and {mask.shape}")
+    scores, counts = _plane_reductions(volume, mask, stat)
+    out = []
+    for score, count in zip(scores, counts):
+        score = np.asarray(score, dtype=np.float64).copy()
+        score[(count == 0) | np.isnan(score)] = -np.inf
+        out.append(score)
+    return tuple(out)
+
+
+def best_slices(volume, mask, stat="mean"):
+    """Index of the highest-scoring slice for each axis, as ``{axis: index}``.
+
+    Ties resolve to the lowest index; an axis with no mask voxels yields 0.
+    """
+    return {axis: int(np.argmax(score)) for axis, score in enumerate(slice_scores(volume, mask, stat))}
+
+
+def slice_with_max_roi_mean(volume, axis, mask):
+    return best_slices(volume, mask, "mean")[axis]
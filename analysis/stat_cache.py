@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""SQLite cache of parsed DSI Studio ``*.stat.txt`` metrics.
+
+Entries are keyed on the file path and validated against its size and
+mtime, so reruns only parse files that are new or have been rewritten.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+from typing import Callable, Dict, Optional
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+DEFAULT_CACHE_PATH = os.path.join(RESULTS_DIR, ".stat_cache.sqlite")
+
+# Uncommitted writes are flushed after this many parses.
+COMMIT_EVERY = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stat_metrics (
+    path TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    metrics TEXT NOT NULL,
+    PRIMARY KEY (path, variant)
+)
+"""
+
+
+class StatCache:
+    """Path/size/mtime-keyed store of parsed key -> float metrics.
+
+    ``variant`` separates entries produced by different parsers (e.g. a parser
+    that only extracts selected keys) for the same file.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = -1
+        self._pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # A connection inherited through fork must not be reused by the child.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(_SCHEMA)
+            self._pid = os.getpid()
+            self._pending = 0
+        return self._conn
+
+    def lookup(self, path: str, variant: str = "all") -> Optional[Dict[str, float]]:
+        """Cached metrics for ``path`` if its size and mtime still match."""
+        st = os.stat(path)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, metrics FROM stat_metrics WHERE path = ? AND variant = ?",
+            (path, variant),
+        ).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            self.hits += 1
+            return json.loads(row[2])
+        self.misses += 1
+        return None
+
+    def store(self, path: str, variant: str, metrics: Dict[str, float]) -> None:
+        st = os.stat(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO stat_metrics VALUES (?, ?, ?, ?, ?)",
+            (path, variant, st.st_size, st.st_mtime_ns, json.dumps(metrics)),
+        )
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.flush()
+
+    def parse(
+        self,
+        path: str,
+        parser: Callable[[str], Dict[str, float]],
+        variant: str = "all",
+    ) -> Dict[str, float]:
+        metrics = self.lookup(path, variant)
+        if metrics is None:
+            metrics = parser(path)
+            self.store(path, variant, metrics)
+        return metrics
+
+    def flush(self) -> None:
+        if self._conn is not None and self._pid == os.getpid() and self._pending:
+            self._conn.commit()
+            self._pending = 0
+
+    def prune(self) -> int:
+        """Drop entries whose file is gone or no longer matches size/mtime."""
+        stale = []
+        for path, variant, size, mtime_ns in self.conn.execute(
+            "SELECT path, variant, size, mtime_ns FROM stat_metrics"
+        ):
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append((path, variant))
+                continue
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                stale.append((path, variant))
+        self.conn.executemany(
+            "DELETE FROM stat_metrics WHERE path = ? AND variant = ?", stale
+        )
+        self.conn.commit()
+        return len(stale)
+
+    def clear(self) -> None:
+        self.conn.execute("DELETE FROM stat_metrics")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM stat_metrics").fetchone()[0]
+
+    def close(self) -> None:
+        self.flush()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SQLite cache path.")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--prune", action="store_true", help="Drop stale or missing entries.")
+    action.add_argument("--clear", action="store_true", help="Drop every entry.")
+    args = parser.parse_args()
+
+    cache = StatCache(args.cache)
+    if args.prune:
+        print(f"Pruned {cache.prune()} stale entries")
+    elif args.clear:
+        cache.clear()
+        print("Cleared stat cache")
+    print(f"{len(cache)} cached entries in {cache.db_path}")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
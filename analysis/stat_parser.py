@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Shared parser for DSI Studio ``*.stat.txt`` files.
+
+Stat files are ``key<TAB>value`` lines. Lines are stripped before the key
+is split off, and when a key occurs more than once its last numeric value
+wins. Callers usually need only a few keys, so ``parse_stat_file`` can be
+given the keys to extract; each is then found with one compiled regex scan
+of the file instead of a per-line Python loop. ``parse_many`` does the same
+for a batch of files on a thread pool (the work is mostly file I/O) and
+returns a ``StatTable``: one ``array('d')`` column per key, NaN where a file
+lacks the key.
+"""
+from __future__ import annotations
+
+import math
+import os
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def _parse_all(data: bytes) -> Dict[str, float]:
+    metrics: Dict[str, float] = {}
+    # splitlines() breaks on \n, \r\n and \r, like reading in text mode.
+    for line in data.splitlines():
+        if b"\t" not in line:
+            continue
+        key, value = line.strip().split(b"\t", 1)
+        try:
+            metrics[key.decode("utf-8")] = float(value)
+        except ValueError:
+            continue
+    return metrics
+
+
+@lru_cache(maxsize=None)
+def _key_pattern(key: bytes) -> "re.Pattern[bytes]":
+    # A line start, then the whitespace strip() would remove, then the key.
+    return re.compile(rb"(?:^|(?<=\r))[ \t\x0b\x0c]*" + re.escape(key) + rb"\t([^\r\n]*)", re.M)
+
+
+def _last_number(values: List[bytes]) -> Optional[float]:
+    for value in reversed(values):
+        try:
+            return float(value)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_stat_file(path: str, keys: Optional[Sequence[str]] = None) -> Dict[str, float]:
+    """``key -> float`` for ``keys`` (every numeric line when ``keys`` is None).
+
+    Requested keys that are missing or never numeric are left out.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if keys is None:
+        return _parse_all(data)
+
+    found: Dict[str, float] = {}
+    for key in keys:
+        value = _last_number(_key_pattern(key.encode("utf-8")).findall(data))
+        if value is not None:
+            found[key] = value
+    return found
+
+
+def cache_variant(keys: Optional[Sequence[str]]) -> str:
+    """``StatCache`` variant name for a key selection."""
+    # "keys2": entries from the earlier first-match parser are not reused.
+    return "all" if keys is None else "keys2:" + ",".join(sorted(keys))
+
+
+@dataclass
+class StatTable:
+    """Columnar result of ``parse_many``: ``columns[key][i]`` belongs to ``paths[i]``."""
+
+    paths: List[str]
+    columns: Dict[str, array]
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def column(self, key: str) -> array:
+        return self.columns[key]
+
+    def row(self, i: int) -> Dict[str, float]:
+        """Metrics of ``paths[i]`` as a dict, without the keys it lacks."""
+        return {
+            key: col[i] for key, col in self.columns.items() if not math.isnan(col[i])
+        }
+
+    def rows(self) -> Iterator[Dict[str, float]]:
+        return (self.row(i) for i in range(len(self.paths)))
+
+
+def parse_many(
+    paths: Sequence[str],
+    keys: Sequence[str],
+    workers: int = DEFAULT_WORKERS,
+    cache=None,
+) -> StatTable:
+    """Parse ``keys`` from every file in ``paths`` into a ``StatTable``.
+
+    With a ``StatCache``, files whose size and mtime match a cached entry are
+    not read; the rest are parsed on ``workers`` threads and stored back.
+    """
+    paths = list(paths)
+    keys = list(keys)
+    results: List[Optional[Dict[str, float]]] = [None] * len(paths)
+    variant = cache_variant(keys)
+    misses = list(range(len(paths)))
+    if cache is not None:
+        misses = []
+        for i, path in enumerate(paths):
+            results[i] = cache.lookup(path, variant)
+            if results[i] is None:
+                misses.append(i)
+
+    def parse(i: int) -> Dict[str, float]:
+        return parse_stat_file(paths[i], keys)
+
+    if workers > 1 and len(misses) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parsed = list(pool.map(parse, misses))
+    else:
+        parsed = [parse(i) for i in misses]
+    for i, metrics in zip(misses, parsed):
+        results[i] = metrics
+        if cache is not None:
+            cache.store(paths[i], variant, metrics)
+
+    nan = math.nan
+    columns = {key: array("d", (r.get(key, nan) for r in results)) for key in keys}
+    return StatTable(paths=paths, columns=columns)
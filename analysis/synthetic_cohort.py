@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Generate a synthetic ds000221-style results tree for benchmarking.
+
+Writes, per subject, DSI Studio-style ``*.stat.txt`` files (wholebrain and
+per tract), an FA map (plus AD/MD/RD on request), SLF TDI maps, ``*.tt.gz``
+streamline files and a FreeSurferSeg label volume at twice the FA
+resolution, using the same file names the analysis scripts expect under
+``<root>/results``.
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+
+from compute_tract_stats import TRACT_GROUPS
+
+TRACTS = [tract for tracts in TRACT_GROUPS.values() for tract in tracts]
+SLF_TRACTS = [t for t in TRACTS if "SuperiorLongitudinalFasciculus" in t]
+
+DEFAULT_SHAPE = (128, 128, 88)
+VOXEL_SIZE_MM = 2.0
+
+# A representative subset of FreeSurfer aseg/aparc labels, including the
+# corpus callosum segments 251-255 used by cc_freesurfer_stats.
+FREESURFER_LABELS = np.array(
+    [0, 2, 4, 5, 7, 8, 10, 11, 12, 13, 14, 15, 16, 17, 18, 24, 26, 28, 31,
+     41, 43, 44, 46, 47, 49, 50, 51, 52, 53, 54, 58, 60, 63, 77, 85,
+     251, 252, 253, 254, 255]
+    + list(range(1001, 1036))
+    + list(range(2001, 2036))
+)
+
+# Keys in the order DSI Studio writes them to tract statistics files.
+STAT_TEMPLATE = [
+    ("number of tracts", 1000, 300000),
+    ("tract length mean(mm)", 40, 120),
+    ("tract length sd(mm)", 10, 30),
+    ("span(mm)", 30, 110),
+    ("curl", 1.0, 2.0),
+    ("elongation", 2.0, 10.0),
+    ("diameter(mm)", 10, 40),
+    ("volume(mm^3)", 5000, 150000),
+    ("trunk volume(mm^3)", 2000, 80000),
+    ("branch volume(mm^3)", 1000, 50000),
+    ("total surface area(mm^2)", 10000, 90000),
+    ("total radius of end regions(mm)", 10, 60),
+    ("total area of end regions(mm^2)", 500, 5000),
+    ("irregularity", 1.0, 10.0),
+    ("total volume(mm^3)", 5000, 150000),
+    ("qa", 0.1, 0.4),
+    ("nqa", 0.2, 0.6),
+    ("fa", 0.3, 0.7),
+    ("ad", 0.001, 0.002),
+    ("md", 0.0006, 0.001),
+    ("rd", 0.0003, 0.0008),
+]
+
+
+def subject_ids(n_subjects: int):
+    return [f"sub-9{i:05d}" for i in range(n_subjects)]
+
+
+def subject_metadata(n_subjects: int, seed: int = 0):
+    """Balanced age group x sex metadata keyed by subject id."""
+    rng = np.random.default_rng(seed)
+    meta = {}
+    for i, subject in enumerate(subject_ids(n_subjects)):
+        young = i % 2 == 0
+        lo = 20 if young else 65
+        start = lo + 5 * int(rng.integers(0, 2))
+        meta[subject] = {
+            "age_bin": f"{start}-{start + 5}",
+            "age_group": "Young" if young else "Older",
+            "sex": "F" if (i // 2) % 2 == 0 else "M",
+        }
+    return meta
+
+
+def _write_stat(path: Path, rng) -> None:
+    lines = ["Tract Name\tsynthetic"]
+    for key, lo, hi in STAT_TEMPLATE:
+        lines.append(f"{key}\t{rng.uniform(lo, hi):.6g}")
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def _smooth_field(shape, rng, block=8):
+    coarse = rng.random(tuple(-(-s // block) for s in shape)).astype(np.float32)
+    return np.kron(coarse, np.ones((block,) * 3, dtype=np.float32))[tuple(slice(0, s) for s in shape)]
+
+
+def _mat4(name: str, data: np.ndarray, precision: int) -> bytes:
+    header = struct.pack("<5i", precision * 10, 1, data.size, 0, len(name) + 1)
+    return header + name.encode("ascii") + b"\0" + data.tobytes()
+
+
+def write_tt(path: Path, streamlines, dimension) -> None:
+    """Write voxel-space ``(n_i, 3)`` streamlines as a DSI Studio ``.tt.gz``.
+
+    Consecutive points must be less than 4 voxels apart (int8 deltas of 1/32).
+    """
+    records = []
+    for line in streamlines:
+        fixed = np.rint(np.asarray(line) * 32).astype(np.int32)
+        deltas = np.diff(fixed, axis=0)
+        if np.abs(deltas).max(initial=0) > 127:
+            raise ValueError("Streamline step too large for .tt.gz encoding")
+        records.append(struct.pack("<I", fixed.size) + fixed[0].astype("<i4").tobytes()
+                       + deltas.astype(np.int8).tobytes())
+    track = np.frombuffer(b"".join(records), dtype=np.uint8)
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        f.write(_mat4("dimension", np.asarray(dimension, dtype="<i4"), 2))
+        f.write(_mat4("voxel_size", np.full(3, VOXEL_SIZE_MM, dtype="<f4"), 1))
+        f.write(_mat4("track", track, 5))
+
+
+def _streamlines(shape, rng, n: int, axis: int):
+    """Gently curved streamlines running along ``axis`` through the brain box."""
+    shape = np.asarray(shape, dtype=np.float64)
+    lo, hi = shape / 8, shape - shape / 8 - 1
+    lines = []
+    for _ in range(n):
+        n_points = int(rng.integers(30, 120))
+        t = np.linspace(0.0, 1.0, n_points)
+        start = rng.uniform(lo, hi)
+        pts = np.repeat(start[None, :], n_points, axis=0)
+        pts[:, axis] = lo[axis] + t * (hi[axis] - lo[axis]) * rng.uniform(0.6, 1.0)
+        bend = (axis + 1) % 3
+        pts[:, bend] += np.sin(np.pi * t) * rng.uniform(-4, 4)
+        lines.append(np.clip(pts, lo, hi))
+    return lines
+
+
+def _save(data, affine, path: Path) -> None:
+    nib.save(nib.Nifti1Image(data, affine), str(path))
+
+
+def generate(
+    root,
+    n_subjects: int = 4,
+    shape=DEFAULT_SHAPE,
+    stat_files_per_tract: int = 1,
+    diffusivities: bool = False,
+    volumes: bool = True,
+    streamlines: int = 200,
+    seed: int = 0,
+):
+    """Write a synthetic cohort under ``<root>/results`` and return its subject ids."""
+    rng = np.random.default_rng(seed)
+    results = Path(root) / "results"
+    results.mkdir(parents=True, exist_ok=True)
+    shape = tuple(int(s) for s in shape)
+    affine = np.diag([VOXEL_SIZE_MM] * 3 + [1.0])
+    atlas_shape = tuple(2 * s for s in shape)
+    atlas_affine = np.diag([VOXEL_SIZE_MM / 2] * 3 + [1.0])
+    brain = np.zeros(shape, dtype=bool)
+    brain[tuple(slice(s // 8, s - s // 8) for s in shape)] = True
+
+    subjects = subject_ids(n_subjects)
+    for subject in subjects:
+        _write_stat(results / f"{subject}_wholebrain.tt.gz.stat.txt", rng)
+        for tract in TRACTS:
+            tract_dir = results / f"{subject}_tracts" / tract
+            tract_dir.mkdir(parents=True, exist_ok=True)
+            for chunk in range(stat_files_per_tract):
+                suffix = f".part{chunk}" if stat_files_per_tract > 1 else ""
+                _write_stat(tract_dir / f"{subject}_ses-01_dti.{tract}{suffix}.tt.gz.stat.txt", rng)
+
+        if not volumes:
+            continue
+        fa = (_smooth_field(shape, rng) * 0.6 + rng.random(shape, dtype=np.float32) * 0.2) * brain
+        _save(fa.astype(np.float32), affine, results / f"{subject}_ses-01_dti.fib.gz.fa.nii.gz")
+        if diffusivities:
+            for metric, scale in (("ad", 1.7e-3), ("md", 8e-4), ("rd", 5e-4)):
+                values = (1.0 - fa * 0.5) * scale * brain
+                _save(values.astype(np.float32), affine, results / f"{subject}_ses-01_dti.fib.gz.{metric}.nii.gz")
+
+        coarse = rng.choice(FREESURFER_LABELS, size=tuple(-(-s // 4) for s in atlas_shape))
+        atlas = np.kron(coarse, np.ones((4, 4, 4), dtype=coarse.dtype))[tuple(slice(0, s) for s in atlas_shape)]
+        atlas *= np.kron(brain, np.ones((2, 2, 2), dtype=bool))
+        atlas_img = nib.Nifti1Image(atlas.astype(np.int16), atlas_affine)
+        nib.save(atlas_img, str(results / f"{subject}_ses-01_FreeSurferSeg.nii.gz"))
+
+        for tract in SLF_TRACTS:
+            tdi = rng.poisson(_smooth_field(shape, rng) * 5.0).astype(np.float32) * brain
+            _save(tdi, affine, results / f"{subject}_tracts" / tract / f"{subject}_ses-01_dti.{tract}.tt.gz.tdi.nii.gz")
+
+        if streamlines:
+            for i, tract in enumerate(TRACTS):
+                # Alternate left-right / anterior-posterior / inferior-superior bundles.
+                lines = _streamlines(shape, rng, streamlines, axis=i % 3)
+                write_tt(results / f"{subject}_tracts" / tract / f"{subject}_ses-01_dti.{tract}.tt.gz", lines, shape)
+    return subjects
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="Output project root; files go under <root>/results.")
+    parser.add_argument("--subjects", type=int, default=4)
+    parser.add_argument("--shape", type=int, nargs=3, default=DEFAULT_SHAPE, metavar=("X", "Y", "Z"))
+    parser.add_argument("--stat-files-per-tract", type=int, default=1)
+    parser.add_argument("--diffusivities", action="store_true", help="Also write AD/MD/RD maps.")
+    parser.add_argument("--no-volumes", action="store_true", help="Only write stat files.")
+    parser.add_argument("--streamlines", type=int, default=200, help="Streamlines per .tt.gz tract file (0 = none).")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    subjects = generate(
+        args.root,
+        n_subjects=args.subjects,
+        shape=args.shape,
+        stat_files_per_tract=args.stat_files_per_tract,
+        diffusivities=args.diffusivities,
+        volumes=not args.no_volumes,
+        streamlines=args.streamlines,
+        seed=args.seed,
+    )
+    print(f"Wrote {len(subjects)} synthetic subjects under {os.path.join(args.root, 'results')}")
+
+
+if __name__ == "__main__":
+    main()
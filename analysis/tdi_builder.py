@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Tract density images (TDI) built from DSI Studio ``*.tt.gz`` files.
+
+A TDI voxel holds the number of streamlines passing through it, each
+streamline counted once per voxel. Streamlines are decoded chunk by chunk
+(see ``tract_profiles.TtFile``), mapped onto the subject's FA grid or a grid
+``--upsample`` times finer, and every segment is subdivided so successive
+samples are at most half an output voxel apart. Each chunk yields the
+distinct flat voxel indices of each of its streamlines; these are buffered
+and folded into the count volume with ``np.bincount`` once the buffer holds
+``FLUSH_FRACTION`` of the grid's voxel count, so memory stays bounded by the
+output volume whatever the number of streamlines.
+
+Maps are written next to their ``.tt.gz`` as ``<tract>.tt.gz.tdi_built.nii.gz``
+or ``<tract>.tt.gz.tdi_built<k>x.nii.gz`` for ``--upsample k``, never under
+DSI Studio's own ``.tdi.nii.gz`` export name. Maps newer than their
+``.tt.gz`` are kept unless ``--force`` is given.
+
+    python analysis/tdi_builder.py --tracts Association_SuperiorLongitudinalFasciculusL
+    python analysis/tdi_builder.py --upsample 2 --jobs 4
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from compute_tract_stats import SUBJECTS, TRACT_GROUPS
+import profiling
+from results_index import ResultsIndex, tdi_suffix
+from tract_profiles import CHUNK_BYTES, StreamlineChunk, grid_chunks
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+
+# Largest distance between successive samples, in output voxels.
+MAX_STEP = 0.5
+# Pending voxel indices, as a fraction of the output voxel count, that
+# trigger a bincount flush.
+FLUSH_FRACTION = 0.25
+
+
+def upsampled_affine(affine: np.ndarray, upsample: int) -> np.ndarray:
+    """Affine of a grid ``upsample`` times finer covering the same voxels.
+
+    Output voxel ``j`` is centred on input voxel coordinate
+    ``(j + 0.5) / upsample - 0.5``.
+    """
+    scale = np.eye(4)
+    scale[:3, :3] /= upsample
+    scale[:3, 3] = (1.0 / upsample - 1.0) / 2.0
+    return np.asarray(affine, dtype=np.float64) @ scale
+
+
+def densify(chunk: StreamlineChunk, max_step: float) -> StreamlineChunk:
+    """Subdivide segments longer than ``max_step`` (in ``chunk`` units)."""
+    points = chunk.points
+    offsets = chunk.offsets
+    if len(points) < 2:
+        return chunk
+    # step[i] runs from point i to point i + 1; the last point of each
+    # streamline gets a zero step so nothing joins it to the next one.
+    step = np.zeros_like(points)
+    np.subtract(points[1:], points[:-1], out=step[:-1])
+    step[offsets[1:-1] - 1] = 0
+    length = np.sqrt(np.einsum("ij,ij->i", step, step))
+    # Each point is followed by emitted - 1 interpolated points.
+    emitted = np.maximum(np.ceil(length / max_step), 1).astype(np.int64)
+    if (emitted == 1).all():
+        return chunk
+
+    starts = np.cumsum(emitted) - emitted
+    total = int(starts[-1] + emitted[-1])
+    # np.repeat of whole rows is much cheaper than gathering by index.
+    frac = (np.arange(total) - np.repeat(starts, emitted)).astype(np.float32)
+    frac *= np.repeat((1.0 / emitted).astype(np.float32), emitted)
+    out = np.repeat(points, emitted, axis=0)
+    out += frac[:, None] * np.repeat(step, emitted, axis=0)
+    return StreamlineChunk(points=out, offsets=np.append(starts[offsets[:-1]], total))
+
+
+def streamline_voxels(chunk: StreamlineChunk, shape: Sequence[int], upsample: int = 1) -> np.ndarray:
+    """Flat (C-order) indices into ``shape`` of each streamline's distinct voxels.
+
+    ``chunk`` is in voxel coordinates of the grid ``upsample`` times coarser
+    than ``shape``. Points outside the grid are ignored; a voxel appears once
+    per streamline passing through it.
+    """
+    nx, ny, nz = (int(n) for n in shape[:3])
+    n_points = np.diff(chunk.offsets)
+    owner = np.repeat(np.arange(len(n_points), dtype=np.int64), n_points)
+    vox = np.floor((chunk.points + 0.5) * upsample).astype(np.int32)
+    # As unsigned, negative indices wrap around and fail the upper bound too.
+    inside = (vox.view(np.uint32) < np.array([nx, ny, nz], dtype=np.uint32)).all(axis=1)
+    if not inside.all():
+        vox = vox[inside]
+        owner = owner[inside]
+    if not len(vox):
+        return np.empty(0, dtype=np.int64)
+    key = owner * nx + vox[:, 0]
+    key *= ny
+    key += vox[:, 1]
+    key *= nz
+    key += vox[:, 2]
+    # Successive samples mostly share a voxel: drop those repeats first so
+    # the sort only sees the voxel path of each streamline. Keys are grouped
+    # by streamline already, which keeps the sort cheap (np.unique may hash
+    # instead, which is several times slower here).
+    key = _drop_repeats(key)
+    key.sort()
+    return _drop_repeats(key) % (nx * ny * nz)
+
+
+def _drop_repeats(values: np.ndarray) -> np.ndarray:
+    keep = np.empty(len(values), dtype=bool)
+    keep[:1] = True
+    np.not_equal(values[1:], values[:-1], out=keep[1:])
+    return values[keep]
+
+
+def tdi_volume(
+    tt_paths: Iterable[str],
+    shape: Sequence[int],
+    upsample: int = 1,
+    flip_xy: bool = True,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> np.ndarray:
+    """Streamline counts on the FA grid ``shape`` refined ``upsample`` times.
+
+    See ``tract_profiles.grid_chunks`` for ``flip_xy``.
+    """
+    shape = tuple(int(n) for n in shape[:3])
+    out_shape = tuple(n * upsample for n in shape)
+    n_voxels = int(np.prod(out_shape))
+    counts = np.zeros(n_voxels, dtype=np.uint32)
+    flush_at = max(1, int(n_voxels * FLUSH_FRACTION))
+    pending: List[np.ndarray] = []
+    n_pending = 0
+
+    def flush() -> None:
+        nonlocal n_pending
+        if pending:
+            np.add(counts, np.bincount(np.concatenate(pending), minlength=n_voxels),
+                   out=counts, casting="unsafe")
+            pending.clear()
+            n_pending = 0
+
+    # Finer grids multiply the points per chunk after densify(); shrink the
+    # decoded chunk to match.
+    chunk_bytes = max(1, chunk_bytes // upsample)
+    for path in tt_paths:
+        for chunk in grid_chunks(path, shape, flip_xy, chunk_bytes):
+            voxels = streamline_voxels(densify(chunk, MAX_STEP / upsample), out_shape, upsample)
+            pending.append(voxels)
+            n_pending += len(voxels)
+            if n_pending >= flush_at:
+                flush()
+    flush()
+    return counts.reshape(out_shape).astype(np.float32)
+
+
+def tdi_output_path(tt_path: str, upsample: int = 1) -> str:
+    return tt_path + tdi_suffix(upsample, built=True)
+
+
+def build_tdi(
+    tt_path: str,
+    fa_path: str,
+    upsample: int = 1,
+    flip_xy: bool = True,
+    force: bool = False,
+) -> Optional[str]:
+    """Write the TDI map of ``tt_path`` on ``fa_path``'s grid; None if up to date."""
+    import nibabel as nib
+
+    out_path = tdi_output_path(tt_path, upsample)
+    if not force and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(tt_path):
+        return None
+    fa = nib.load(fa_path)
+    volume = tdi_volume([tt_path], fa.shape, upsample, flip_xy)
+    img = nib.Nifti1Image(volume, upsampled_affine(fa.affine, upsample))
+    img.header.set_xyzt_units(*fa.header.get_xyzt_units())
+    # nibabel picks the format from the extension, so keep ".nii.gz" last.
+    tmp_path = f"{out_path[: -len('.nii.gz')]}.tmp{os.getpid()}.nii.gz"
+    try:
+        nib.save(img, tmp_path)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return out_path
+
+
+def _subject_tdis(
+    subject: str, tracts: Sequence[str], upsample: int, flip_xy: bool, force: bool
+) -> Tuple[List[str], Optional[str]]:
+    # Same contract as tract_profiles._subject_profiles.
+    index = ResultsIndex(RESULTS_DIR)
+    written: List[str] = []
+    try:
+        fa_path = index.fa_map(subject)
+        if fa_path is None:
+            raise FileNotFoundError(f"Missing FA map for {subject}")
+        for tract in tracts:
+            for tt_path in index.tract_files(subject, tract):
+                with profiling.span("build_tdi", subject=subject, tract=tract):
+                    out_path = build_tdi(tt_path, fa_path, upsample, flip_xy, force)
+                if out_path is not None:
+                    written.append(out_path)
+    except (OSError, ValueError) as exc:
+        return written, str(exc)
+    return written, None
+
+
+def build_tdis(
+    subjects: Sequence[str],
+    tracts: Sequence[str],
+    upsample: int = 1,
+    jobs: int = 1,
+    flip_xy: bool = True,
+    force: bool = False,
+) -> Tuple[List[str], Dict[str, str]]:
+    """TDI maps for every subject/tract ``.tt.gz``; written paths and failures."""
+    ResultsIndex(RESULTS_DIR).refresh()
+    args = [(subject, list(tracts), upsample, flip_xy, force) for subject in subjects]
+    if jobs > 1 and len(subjects) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            if profiling.enabled():
+                results = []
+                for result, events in pool.map(partial(profiling.collect, _subject_tdis), *zip(*args)):
+                    profiling.merge(events)
+                    results.append(result)
+            else:
+                results = list(pool.map(_subject_tdis, *zip(*args)))
+    else:
+        results = [_subject_tdis(*a) for a in args]
+
+    written: List[str] = []
+    failures: Dict[str, str] = {}
+    for subject, (paths, error) in zip(subjects, results):
+        if error is not None:
+            failures[subject] = error
+        written.extend(paths)
+    return written, failures
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    all_tracts = [t for tracts in TRACT_GROUPS.values() for t in tracts]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tracts", nargs="+", choices=all_tracts, default=all_tracts, metavar="TRACT")
+    parser.add_argument("--upsample", type=int, default=1, help="Output grid refinement over the FA grid.")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes (0 = all CPUs).")
+    parser.add_argument(
+        "--no-flip",
+        action="store_true",
+        help="Track and FA voxel orders already agree (no DSI Studio x/y flip).",
+    )
+    parser.add_argument("--force", action="store_true", help="Rebuild maps newer than their .tt.gz.")
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    if args.upsample < 1:
+        parser.error("--upsample must be at least 1")
+
+    with profiling.session(args.profile, "tdi"):
+        jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+        written, failures = build_tdis(
+            SUBJECTS, args.tracts, args.upsample, jobs, flip_xy=not args.no_flip, force=args.force
+        )
+        for subject, error in failures.items():
+            print(f"[skip] {subject}: {error}", file=sys.stderr)
+        print(f"Wrote {len(written)} TDI maps")
+
+
+if __name__ == "__main__":
+    main()
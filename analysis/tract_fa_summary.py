@@ -2,13 +2,21 @@
 """Aggregate tract FA metrics and generate comparison outputs."""
 from __future__ import annotations
 
-import glob
+import argparse
+import math
 import os
-from collections import defaultdict
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-import matplotlib.pyplot as plt
+import numpy as np
+
+from columnar import OUTPUT_FORMATS, melt_rows, wants_csv, wants_parquet, write_long_table
+import profiling
+from render_farm import RenderJob, render, report
+from results_index import ResultsIndex
+from stat_cache import StatCache
+from stat_parser import parse_many
 
 SUBJECT_METADATA = {
     "sub-010019": {"age_bin": "20-25", "age_group": "Young", "sex": "F"},
@@ -43,49 +51,30 @@ class TractMetric:
     mean_fa: float
 
 
-def parse_stat_file(path: str) -> Dict[str, float]:
-    metrics: Dict[str, float] = {}
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            if "\t" not in line:
-                continue
-            key, value = line.strip().split("\t", 1)
-            try:
-                metrics[key] = float(value)
-            except ValueError:
-                continue
-    return metrics
-
-
-def identify_subject(path: str) -> str:
-    basename = os.path.basename(path)
-    parts = basename.split(".")
-    for part in parts:
-        if part.startswith("sub-"):
-            return part.split("_")[0]
-    raise ValueError(f"Could not identify subject from {path}")
-
-
-def identify_tract(path: str) -> Tuple[str, str]:
-    for atlas_name, label in TRACT_LABEL_MAP.items():
-        if atlas_name in path:
-            return atlas_name, label
-    return "", ""
-
-
-def collect_metrics() -> List[TractMetric]:
-    metrics: List[TractMetric] = []
-    pattern = os.path.join(RESULTS_DIR, "**", "*.stat.txt")
-    for stat_path in glob.glob(pattern, recursive=True):
-        atlas_name, tract_label = identify_tract(stat_path)
-        if not tract_label:
-            continue
-        stats = parse_stat_file(stat_path)
-        if "fa" not in stats:
-            continue
-        subject = identify_subject(stat_path)
-        metrics.append(TractMetric(subject=subject, tract=tract_label, mean_fa=stats["fa"]))
-    return metrics
+def collect_metrics(
+    index: Optional[ResultsIndex] = None,
+    cache: Optional[StatCache] = None,
+) -> List[TractMetric]:
+    if index is None:
+        with profiling.span("results_index.refresh"):
+            index = ResultsIndex(RESULTS_DIR).refresh()
+    owners: List[Tuple[str, str]] = []
+    paths: List[str] = []
+    for subject in index.subjects():
+        for atlas_name, tract_label in TRACT_LABEL_MAP.items():
+            for stat_path in index.stat_files(subject, atlas_name):
+                owners.append((subject, tract_label))
+                paths.append(stat_path)
+
+    with profiling.span("parse_stats", files=len(paths)):
+        fa = parse_many(paths, ["fa"], cache=cache).column("fa")
+    if cache is not None:
+        cache.flush()
+    return [
+        TractMetric(subject=subject, tract=tract_label, mean_fa=value)
+        for (subject, tract_label), value in zip(owners, fa)
+        if not math.isnan(value)
+    ]
 
 
 def _subject_sort_key(subject: str) -> Tuple[int, str]:
@@ -95,15 +84,52 @@ def _subject_sort_key(subject: str) -> Tuple[int, str]:
     return (group_rank, subject)
 
 
-def to_wide_table(metrics: List[TractMetric]) -> Tuple[List[str], Dict[str, Dict[str, float]]]:
+@dataclass
+class TractMatrix:
+    """Dense subject x tract FA array; NaN marks a missing measurement."""
+
+    subjects: List[str]
+    tracts: List[str]
+    values: np.ndarray
+    subject_index: Dict[str, int] = field(default_factory=dict)
+    tract_index: Dict[str, int] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.subject_index = {subject: i for i, subject in enumerate(self.subjects)}
+        self.tract_index = {tract: j for j, tract in enumerate(self.tracts)}
+
+    def get(self, subject: str, tract: str) -> Optional[float]:
+        value = self.values[self.subject_index[subject], self.tract_index[tract]]
+        return None if np.isnan(value) else float(value)
+
+    def metadata(self, key: str) -> List[str]:
+        return [SUBJECT_METADATA.get(subject, {}).get(key, "") for subject in self.subjects]
+
+
+REFERENCES = ("global", "age_group", "sex")
+
+
+def to_wide_table(metrics: List[TractMetric]) -> TractMatrix:
     subjects = sorted({m.subject for m in metrics}, key=_subject_sort_key)
-    table: Dict[str, Dict[str, float]] = defaultdict(dict)
-    for metric in metrics:
-        table[metric.subject][metric.tract] = metric.mean_fa
-    return subjects, table
+    tracts = sorted(TARGET_LABELS)
+    matrix = TractMatrix(subjects, tracts, np.full((len(subjects), len(tracts)), np.nan))
+    if not metrics:
+        return matrix
+    rows = np.array([matrix.subject_index[m.subject] for m in metrics])
+    cols = np.array([matrix.tract_index[m.tract] for m in metrics])
+    flat = rows * len(tracts) + cols
+    # Keep the last measurement of any duplicated subject/tract pair.
+    _, last = np.unique(flat[::-1], return_index=True)
+    keep = len(flat) - 1 - last
+    matrix.values[rows[keep], cols[keep]] = np.array([m.mean_fa for m in metrics])[keep]
+    return matrix
+
+
+def _metadata_columns(matrix: TractMatrix) -> Dict[str, List[str]]:
+    return {key: matrix.metadata(key) for key in ("age_group", "age_bin", "sex")}
 
 
-def write_comparison_csv(path: str, subjects: List[str], table: Dict[str, Dict[str, float]]):
+def write_comparison_csv(path: str, matrix: TractMatrix):
     import csv
 
     fieldnames = [
@@ -111,52 +137,99 @@ def write_comparison_csv(path: str, subjects: List[str], table: Dict[str, Dict[s
         "age_group",
         "age_bin",
         "sex",
-    ] + sorted(TARGET_LABELS)
+    ] + matrix.tracts
+    meta = _metadata_columns(matrix)
+    values = np.where(np.isnan(matrix.values), None, matrix.values).tolist()
     with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for subject in subjects:
-            meta = SUBJECT_METADATA.get(subject, {})
-            row = {
-                "subject": subject,
-                "age_group": meta.get("age_group", ""),
-                "age_bin": meta.get("age_bin", ""),
-                "sex": meta.get("sex", ""),
-            }
-            for tract in sorted(TARGET_LABELS):
-                row[tract] = table.get(subject, {}).get(tract, "")
-            writer.writerow(row)
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        for i, subject in enumerate(matrix.subjects):
+            writer.writerow(
+                [subject, meta["age_group"][i], meta["age_bin"][i], meta["sex"][i]]
+                + ["" if v is None else v for v in values[i]]
+            )
 
 
-def compute_change_rates(subjects: List[str], table: Dict[str, Dict[str, float]]):
+def write_comparison_parquet(path: str, matrix: TractMatrix):
+    subj_idx, tract_idx = np.nonzero(~np.isnan(matrix.values))
+    meta = _metadata_columns(matrix)
+    write_long_table(
+        path,
+        {
+            "subject": [matrix.subjects[i] for i in subj_idx],
+            "age_group": [meta["age_group"][i] for i in subj_idx],
+            "age_bin": [meta["age_bin"][i] for i in subj_idx],
+            "sex": [meta["sex"][i] for i in subj_idx],
+            "tract": [matrix.tracts[j] for j in tract_idx],
+            "metric": ["mean_fa"] * len(subj_idx),
+            "value": matrix.values[subj_idx, tract_idx].tolist(),
+        },
+    )
+
+
+def reference_means(matrix: TractMatrix, reference: str = "global") -> np.ndarray:
+    """Per-subject reference mean for every tract, NaN-aware.
+
+    ``global`` averages over all subjects; ``age_group``/``sex`` average within
+    the subject's own group. Returns an array shaped like ``matrix.values``.
+    """
+    if reference == "global":
+        codes = np.zeros(len(matrix.subjects), dtype=np.int64)
+    elif reference in REFERENCES:
+        _, codes = np.unique(matrix.metadata(reference), return_inverse=True)
+    else:
+        raise ValueError(f"Unknown reference {reference!r}; expected one of {REFERENCES}")
+    present = ~np.isnan(matrix.values)
+    onehot = np.eye(codes.max() + 1 if codes.size else 1)[codes]
+    sums = onehot.T @ np.where(present, matrix.values, 0.0)
+    counts = onehot.T @ present
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return means[codes]
+
+
+def compute_change_rates(matrix: TractMatrix, reference: str = "global", fmt: str = "csv"):
     import csv
 
-    change_rates: List[Dict[str, object]] = []
-    for tract in sorted(TARGET_LABELS):
-        values = [table.get(sub, {}).get(tract) for sub in subjects]
-        values = [v for v in values if v is not None]
-        if not values:
-            continue
-        mean_val = sum(values) / len(values)
-        for subject in subjects:
-            val = table.get(subject, {}).get(tract)
-            if val is None:
-                continue
-            percent_change = ((val - mean_val) / mean_val) * 100 if mean_val else 0.0
-            meta = SUBJECT_METADATA.get(subject, {})
-            change_rates.append(
-                {
-                    "subject": subject,
-                    "age_group": meta.get("age_group", ""),
-                    "age_bin": meta.get("age_bin", ""),
-                    "sex": meta.get("sex", ""),
-                    "tract": tract,
-                    "mean_fa": val,
-                    "percent_change_from_group_mean": percent_change,
-                }
-            )
+    ref = reference_means(matrix, reference)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        percent = np.where(ref != 0, (matrix.values - ref) / ref * 100, 0.0)
+
+    # Tract-major order, skipping missing measurements.
+    tract_idx, subj_idx = np.nonzero(~np.isnan(matrix.values.T))
+    meta = _metadata_columns(matrix)
+    change_rates: List[Dict[str, object]] = [
+        {
+            "subject": matrix.subjects[i],
+            "age_group": meta["age_group"][i],
+            "age_bin": meta["age_bin"][i],
+            "sex": meta["sex"][i],
+            "tract": matrix.tracts[j],
+            "mean_fa": value,
+            "percent_change_from_group_mean": pct,
+        }
+        for i, j, value, pct in zip(
+            subj_idx.tolist(),
+            tract_idx.tolist(),
+            matrix.values[subj_idx, tract_idx].tolist(),
+            percent[subj_idx, tract_idx].tolist(),
+        )
+    ]
+
+    stem = "tract_fa_change_rates" if reference == "global" else f"tract_fa_change_rates_by_{reference}"
+    if wants_parquet(fmt):
+        write_long_table(
+            os.path.join(RESULTS_DIR, f"{stem}.parquet"),
+            melt_rows(
+                change_rates,
+                ["subject", "age_group", "age_bin", "sex", "tract"],
+                ["mean_fa", "percent_change_from_group_mean"],
+            ),
+        )
+    if not wants_csv(fmt):
+        return
 
-    change_csv = os.path.join(RESULTS_DIR, "tract_fa_change_rates.csv")
+    change_csv = os.path.join(RESULTS_DIR, f"{stem}.csv")
     fieldnames = [
         "subject",
         "age_group",
@@ -173,43 +246,87 @@ def compute_change_rates(subjects: List[str], table: Dict[str, Dict[str, float]]
             writer.writerow(row)
 
 
-def plot_bar_chart(subjects: List[str], table: Dict[str, Dict[str, float]]):
-    tracts = sorted(TARGET_LABELS)
-    x = range(len(subjects))
+def _render_bar_chart(out_path, subjects, tracts, values, xticklabels, dpi=300):
+    import matplotlib.pyplot as plt
+
+    x = np.arange(len(subjects))
     bar_width = 0.12
 
     plt.figure(figsize=(12, 5))
     for idx, tract in enumerate(tracts):
-        offsets = [pos + (idx - len(tracts) / 2) * bar_width + bar_width / 2 for pos in x]
-        values = [table.get(subject, {}).get(tract, 0.0) for subject in subjects]
-        plt.bar(offsets, values, width=bar_width, label=tract)
+        offsets = x + (idx - len(tracts) / 2) * bar_width + bar_width / 2
+        plt.bar(offsets, values[:, idx], width=bar_width, label=tract)
 
-    xticklabels = []
-    for subject in subjects:
-        meta = SUBJECT_METADATA.get(subject, {})
-        xticklabels.append(
-            f"{subject}\n{meta.get('age_group', '')} / {meta.get('sex', '')} / {meta.get('age_bin', '')}"
-        )
     plt.xticks(list(x), xticklabels, rotation=20, ha="right")
     plt.ylabel("Mean FA")
     plt.title("Mean FA per Subject and Tract")
     plt.legend(ncol=3, fontsize=8)
     plt.tight_layout()
-    plot_path = os.path.join(FIGURES_DIR, "tract_fa_barplot.png")
-    plt.savefig(plot_path, dpi=300)
+    plt.savefig(out_path, dpi=dpi)
     plt.close()
 
 
-def main() -> None:
-    metrics = collect_metrics()
-    if not metrics:
-        raise SystemExit("No tract metrics found.")
-
-    subjects, table = to_wide_table(metrics)
-    comparison_csv = os.path.join(RESULTS_DIR, "tract_fa_comparison.csv")
-    write_comparison_csv(comparison_csv, subjects, table)
-    compute_change_rates(subjects, table)
-    plot_bar_chart(subjects, table)
+def plot_bar_chart(matrix: TractMatrix, force: bool = False):
+    xticklabels = []
+    for subject in matrix.subjects:
+        meta = SUBJECT_METADATA.get(subject, {})
+        xticklabels.append(
+            f"{subject}\n{meta.get('age_group', '')} / {meta.get('sex', '')} / {meta.get('age_bin', '')}"
+        )
+    job = RenderJob(
+        _render_bar_chart,
+        Path(FIGURES_DIR) / "tract_fa_barplot.png",
+        kwargs={
+            "subjects": matrix.subjects,
+            "tracts": matrix.tracts,
+            "values": np.nan_to_num(matrix.values, nan=0.0),
+            "xticklabels": xticklabels,
+        },
+    )
+    report(render([job], force=force))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Parse every stat file instead of reading the stat cache.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Write CSV tables, tract/metric-partitioned Parquet datasets, or both.",
+    )
+    parser.add_argument(
+        "--reference",
+        choices=REFERENCES,
+        default="global",
+        help="Mean that percent change is measured against: all subjects or the subject's group.",
+    )
+    parser.add_argument("--force", action="store_true", help="Re-render figures even if unchanged.")
+    parser.add_argument("--no-plot", action="store_true", help="Write the tables only.")
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+    with profiling.session(args.profile, "fa-summary"):
+        cache = None if args.no_cache else StatCache()
+        metrics = collect_metrics(cache=cache)
+        if cache is not None:
+            cache.close()
+        if not metrics:
+            raise SystemExit("No tract metrics found.")
+
+        matrix = to_wide_table(metrics)
+        if wants_csv(args.format):
+            comparison_csv = os.path.join(RESULTS_DIR, "tract_fa_comparison.csv")
+            write_comparison_csv(comparison_csv, matrix)
+        if wants_parquet(args.format):
+            comparison_parquet = os.path.join(RESULTS_DIR, "tract_fa_comparison.parquet")
+            write_comparison_parquet(comparison_parquet, matrix)
+        compute_change_rates(matrix, reference=args.reference, fmt=args.format)
+        if not args.no_plot:
+            plot_bar_chart(matrix, force=args.force)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""Along-tract FA profiles from DSI Studio ``*.tt.gz`` streamline files.
+
+A ``.tt.gz`` file is a gzipped MATLAB v4 file. Its ``track`` matrix is a
+byte buffer of records, one per streamline::
+
+    uint32   n            number of coordinates (3 x points)
+    int32[3] first point  voxel coordinates x 32
+    int8[n-3] deltas      successive x/y/z steps, also x 32
+
+Records are decoded ``CHUNK_BYTES`` of buffer at a time, so memory stays
+bounded for 300k-streamline bundles. Each chunk is resampled to ``--nodes``
+equally spaced points per streamline, oriented so node 0 is the end with the
+lower coordinate along the bundle's dominant axis, and sampled from the
+subject's FA map with trilinear interpolation. Per-node mean/SD across
+streamlines are accumulated chunk by chunk (Chan et al. merge).
+
+    python analysis/tract_profiles.py --nodes 100 --jobs 4
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import gzip
+import math
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from columnar import OUTPUT_FORMATS, melt_rows, wants_csv, wants_parquet, write_long_table
+from compute_tract_stats import SUBJECTS, TRACT_GROUPS
+import profiling
+from results_index import ResultsIndex
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+
+DEFAULT_NODES = 100
+CHUNK_BYTES = 1 << 20
+# DSI Studio stores track coordinates in fixed point with 1/32 voxel steps.
+COORD_SCALE = 32.0
+
+# MATLAB v4 precision digit (MOPT "P") -> dtype.
+_MAT4_DTYPES = {
+    0: np.float64,
+    1: np.float32,
+    2: np.int32,
+    3: np.int16,
+    4: np.uint16,
+    5: np.uint8,
+}
+
+PROFILE_FIELDS = ["subject", "tract", "node", "mean_fa", "std_fa", "streamlines"]
+
+
+@dataclass
+class StreamlineChunk:
+    """Points of consecutive streamlines; streamline ``i`` is
+    ``points[offsets[i]:offsets[i + 1]]``."""
+
+    points: np.ndarray
+    offsets: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+def _read_exact(f: BinaryIO, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError("Truncated .tt.gz file")
+    return data
+
+
+def _decode_records(buf: bytes) -> Tuple[Optional[StreamlineChunk], int]:
+    """Decode every complete record in ``buf``; return the chunk and bytes used."""
+    starts: List[int] = []
+    sizes: List[int] = []
+    pos = 0
+    end = len(buf)
+    unpack = struct.Struct("<I").unpack_from
+    while pos + 16 <= end:
+        (size,) = unpack(buf, pos)
+        if size < 3 or size % 3:
+            raise ValueError(f"Malformed track record (n={size}) at byte {pos}")
+        if pos + size + 13 > end:
+            break
+        starts.append(pos)
+        sizes.append(size)
+        pos += size + 13
+    if not starts:
+        return None, 0
+
+    raw = np.frombuffer(buf, dtype=np.uint8, count=pos)
+    starts_a = np.asarray(starts, dtype=np.int64)
+    n_deltas = np.asarray(sizes, dtype=np.int64) - 3
+    n_points = n_deltas // 3 + 1
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(n_points, out=offsets[1:])
+
+    first = raw[starts_a[:, None] + 4 + np.arange(12)].view("<i4").reshape(-1, 3)
+    # Byte positions of all delta bytes, record after record.
+    delta_start = np.zeros(len(starts), dtype=np.int64)
+    np.cumsum(n_deltas[:-1], out=delta_start[1:])
+    idx = np.arange(int(n_deltas.sum()), dtype=np.int64)
+    idx += np.repeat(starts_a + 16 - delta_start, n_deltas)
+    deltas = raw[idx].view(np.int8).reshape(-1, 3)
+
+    steps = np.empty((int(offsets[-1]), 3), dtype=np.int64)
+    is_first = np.zeros(len(steps), dtype=bool)
+    is_first[offsets[:-1]] = True
+    steps[is_first] = first
+    steps[~is_first] = deltas
+    coords = np.cumsum(steps, axis=0)
+    # Undo the carry-over of the cumulative sum from earlier streamlines.
+    coords -= np.repeat(coords[offsets[:-1]] - first, n_points, axis=0)
+    points = (coords / COORD_SCALE).astype(np.float32)
+    return StreamlineChunk(points=points, offsets=offsets), pos
+
+
+class TtFile:
+    """Sequential reader of a ``.tt.gz`` file.
+
+    Matrices before ``track`` (``dimension``, ``voxel_size``, ...) are kept in
+    ``header``; ``track`` is streamed by ``chunks``.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header: Dict[str, np.ndarray] = {}
+
+    def _matrices(self, f: BinaryIO) -> Iterator[Tuple[str, np.dtype, int]]:
+        while True:
+            head = f.read(20)
+            if not head:
+                return
+            if len(head) != 20:
+                raise ValueError(f"Truncated matrix header in {self.path}")
+            mopt, mrows, ncols, imagf, namlen = struct.unpack("<5i", head)
+            precision = (mopt // 10) % 10
+            if mopt // 1000 != 0 or imagf or precision not in _MAT4_DTYPES:
+                raise ValueError(f"Unsupported MATLAB v4 matrix (type {mopt}) in {self.path}")
+            name = _read_exact(f, namlen).rstrip(b"\0").decode("ascii")
+            yield name, np.dtype(_MAT4_DTYPES[precision]), mrows * ncols
+
+    def chunks(self, chunk_bytes: int = CHUNK_BYTES) -> Iterator[StreamlineChunk]:
+        with gzip.open(self.path, "rb") as f:
+            for name, dtype, count in self._matrices(f):
+                nbytes = count * dtype.itemsize
+                if name != "track":
+                    self.header[name] = np.frombuffer(_read_exact(f, nbytes), dtype=dtype)
+                    continue
+                pending = b""
+                remaining = nbytes
+                while remaining:
+                    block = _read_exact(f, min(chunk_bytes, remaining))
+                    remaining -= len(block)
+                    chunk, used = _decode_records(pending + block)
+                    pending = (pending + block)[used:]
+                    if chunk is not None:
+                        yield chunk
+                if pending:
+                    raise ValueError(f"Incomplete track record at end of {self.path}")
+
+
+def grid_chunks(
+    path: str,
+    shape: Tuple[int, ...],
+    flip_xy: bool = True,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> Iterator[StreamlineChunk]:
+    """Chunks of ``path`` in the voxel order of a NIfTI grid of ``shape``.
+
+    ``flip_xy`` maps DSI Studio's internal (LPS) voxel order onto the x/y
+    flipped order of its NIfTI exports such as ``*.fib.gz.fa.nii.gz``.
+    """
+    shape = tuple(int(n) for n in shape[:3])
+    offset = np.array([shape[0] - 1, shape[1] - 1, 0], dtype=np.float32)
+    sign = np.array([-1, -1, 1], dtype=np.float32)
+    tt = TtFile(path)
+    for i, chunk in enumerate(tt.chunks(chunk_bytes)):
+        dim = tt.header.get("dimension")
+        if i == 0 and dim is not None and tuple(int(d) for d in dim[:3]) != shape:
+            raise ValueError(f"{path} grid {tuple(int(d) for d in dim[:3])} does not match {shape}")
+        if flip_xy:
+            chunk.points *= sign
+            chunk.points += offset
+        yield chunk
+
+
+def resample(chunk: StreamlineChunk, n_nodes: int = DEFAULT_NODES) -> np.ndarray:
+    """``(streamlines, n_nodes, 3)`` points equally spaced in arc length.
+
+    Streamlines with fewer than two distinct points are dropped.
+    """
+    points = chunk.points.astype(np.float64)
+    offsets = chunk.offsets
+    n_points = np.diff(offsets)
+    keep = n_points >= 2
+    seg = np.zeros(len(points), dtype=np.float64)
+    step = np.diff(points, axis=0)
+    seg[1:] = np.sqrt(np.einsum("ij,ij->i", step, step))
+    seg[offsets[:-1]] = 0.0  # no segment joins consecutive streamlines
+    arc = np.cumsum(seg)
+    arc -= np.repeat(arc[offsets[:-1]], n_points)
+    length = np.where(n_points > 0, arc[np.maximum(offsets[1:] - 1, 0)], 0.0)
+    keep &= length > 0
+    if not keep.any():
+        return np.empty((0, n_nodes, 3), dtype=np.float32)
+
+    # Within-streamline arc fraction in [0, 1], offset by 2 per streamline so
+    # one sorted key covers the whole chunk.
+    owner = np.repeat(np.arange(len(n_points)), n_points)
+    key = owner * 2.0 + arc / np.where(length > 0, length, 1.0)[owner]
+    rows = np.flatnonzero(keep)
+    u = np.linspace(0.0, 1.0, n_nodes)
+    target = (rows[:, None] * 2.0 + u[None, :]).ravel()
+    j = np.searchsorted(key, target, side="right") - 1
+    lo = np.repeat(offsets[rows], n_nodes)
+    hi = np.repeat(offsets[rows + 1] - 2, n_nodes)
+    j = np.clip(j, lo, hi)
+    span = key[j + 1] - key[j]
+    frac = np.divide(target - key[j], span, out=np.zeros_like(span), where=span > 0)
+    out = points[j] + frac[:, None] * (points[j + 1] - points[j])
+    return out.reshape(len(rows), n_nodes, 3).astype(np.float32)
+
+
+def dominant_axis(nodes: np.ndarray) -> int:
+    """Voxel axis along which the bundle's endpoints are furthest apart."""
+    return int(np.argmax(np.abs(nodes[:, -1] - nodes[:, 0]).mean(axis=0)))
+
+
+def orient(nodes: np.ndarray, axis: int) -> np.ndarray:
+    """Reverse streamlines whose last node is lower than the first along ``axis``."""
+    flip = nodes[:, -1, axis] < nodes[:, 0, axis]
+    nodes[flip] = nodes[flip, ::-1]
+    return nodes
+
+
+class TrilinearSampler:
+    """Trilinear interpolation of a 3-D volume at voxel coordinates.
+
+    The eight corner values of every interpolation cell are stored side by
+    side (``(cells, 8)``, about 8x the volume), so each sample is one
+    contiguous gather instead of eight scattered ones.
+    """
+
+    def __init__(self, volume: np.ndarray):
+        volume = np.asarray(volume, dtype=np.float32)
+        if volume.ndim != 3 or min(volume.shape) < 2:
+            raise ValueError(f"Expected a 3-D volume with every axis >= 2, got {volume.shape}")
+        self.shape = volume.shape
+        nx, ny, nz = (n - 1 for n in volume.shape)
+        self.corners = np.stack(
+            [
+                volume[dx : dx + nx, dy : dy + ny, dz : dz + nz]
+                for dx in (0, 1)
+                for dy in (0, 1)
+                for dz in (0, 1)
+            ],
+            axis=-1,
+        ).reshape(-1, 8)
+        self._strides = (ny * nz, nz)
+
+    def __call__(self, coords: np.ndarray) -> np.ndarray:
+        """Values at ``coords`` (``(..., 3)``); NaN outside the grid."""
+        flat = np.asarray(coords, dtype=np.float32).reshape(-1, 3)
+        x, y, z = flat[:, 0], flat[:, 1], flat[:, 2]
+        ux, uy, uz = (n - 1 for n in self.shape)
+        inside = (x >= 0) & (x <= ux) & (y >= 0) & (y <= uy) & (z >= 0) & (z <= uz)
+        # The far faces belong to the last cell, with a fraction of 1.
+        bx = np.clip(np.floor(x), 0, ux - 1)
+        by = np.clip(np.floor(y), 0, uy - 1)
+        bz = np.clip(np.floor(z), 0, uz - 1)
+        cell = (bx.astype(np.intp) * self._strides[0] + by.astype(np.intp) * self._strides[1]
+                + bz.astype(np.intp))
+        fx, fy, fz = x - bx, y - by, z - bz
+        gz = 1 - fz
+        weights = np.empty((len(flat), 8), dtype=np.float32)
+        k = 0
+        for wx in (1 - fx, fx):
+            for wy in (1 - fy, fy):
+                wxy = wx * wy
+                np.multiply(wxy, gz, out=weights[:, k])
+                np.multiply(wxy, fz, out=weights[:, k + 1])
+                k += 2
+        out = np.einsum("ij,ij->i", self.corners[cell], weights).astype(np.float64)
+        out[~inside] = np.nan
+        return out.reshape(np.shape(coords)[:-1])
+
+
+def trilinear(volume: np.ndarray, coords: np.ndarray) -> np.ndarray:
+    """Sample ``volume`` at voxel ``coords`` (``(..., 3)``); NaN outside the grid."""
+    return TrilinearSampler(volume)(coords)
+
+
+@dataclass
+class ProfileStats:
+    """Per-node count/mean/M2 over streamlines, mergeable across chunks."""
+
+    n_nodes: int
+    count: np.ndarray = field(init=False)
+    mean: np.ndarray = field(init=False)
+    m2: np.ndarray = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.count = np.zeros(self.n_nodes, dtype=np.int64)
+        self.mean = np.zeros(self.n_nodes, dtype=np.float64)
+        self.m2 = np.zeros(self.n_nodes, dtype=np.float64)
+
+    def update(self, values: np.ndarray) -> None:
+        """Fold in ``(streamlines, n_nodes)`` samples; NaNs are ignored."""
+        valid = ~np.isnan(values)
+        n_b = valid.sum(axis=0)
+        if not n_b.any():
+            return
+        filled = np.where(valid, values, 0.0)
+        mean_b = np.divide(filled.sum(axis=0), n_b, out=np.zeros(self.n_nodes), where=n_b > 0)
+        m2_b = (np.where(valid, values - mean_b, 0.0) ** 2).sum(axis=0)
+        n = self.count + n_b
+        delta = mean_b - self.mean
+        safe_n = np.maximum(n, 1)
+        self.mean = self.mean + delta * n_b / safe_n
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.count * n_b / safe_n
+        self.count = n
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(np.divide(self.m2, self.count - 1, out=np.full(self.n_nodes, np.nan),
+                                 where=self.count > 1))
+
+
+def tract_profile(
+    tt_paths: List[str],
+    fa,
+    n_nodes: int = DEFAULT_NODES,
+    flip_xy: bool = True,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> ProfileStats:
+    """FA profile over every streamline in ``tt_paths``, sampled from ``fa``.
+
+    ``fa`` is a volume or a ``TrilinearSampler`` built from one (reuse the
+    sampler across a subject's tracts). See ``grid_chunks`` for ``flip_xy``.
+    """
+    sampler = fa if isinstance(fa, TrilinearSampler) else TrilinearSampler(fa)
+    stats = ProfileStats(n_nodes)
+    axis: Optional[int] = None
+    for path in tt_paths:
+        for chunk in grid_chunks(path, sampler.shape, flip_xy, chunk_bytes):
+            nodes = resample(chunk, n_nodes)
+            if not len(nodes):
+                continue
+            if axis is None:
+                axis = dominant_axis(nodes)
+            stats.update(sampler(orient(nodes, axis)))
+    return stats
+
+
+def _subject_profiles(
+    subject: str, n_nodes: int, flip_xy: bool
+) -> Tuple[List[Dict[str, object]], Optional[str]]:
+    # Same contract as compute_tract_stats._safe_subject_rows: errors come back
+    # as values so one bad subject does not abort the pool.
+    import nibabel as nib
+
+    index = ResultsIndex(RESULTS_DIR)
+    rows: List[Dict[str, object]] = []
+    try:
+        fa_path = index.fa_map(subject)
+        if fa_path is None:
+            raise FileNotFoundError(f"Missing FA map for {subject}")
+        with profiling.span("load_fa", subject=subject):
+            fa = TrilinearSampler(nib.load(fa_path).get_fdata(dtype=np.float32))
+        for tract in (t for tracts in TRACT_GROUPS.values() for t in tracts):
+            tt_paths = index.tract_files(subject, tract)
+            if not tt_paths:
+                continue
+            with profiling.span("tract_profile", subject=subject, tract=tract):
+                stats = tract_profile(tt_paths, fa, n_nodes, flip_xy)
+            for node in range(n_nodes):
+                rows.append({
+                    "subject": subject,
+                    "tract": tract,
+                    "node": node,
+                    "mean_fa": float(stats.mean[node]) if stats.count[node] else math.nan,
+                    "std_fa": float(stats.std[node]),
+                    "streamlines": int(stats.count[node]),
+                })
+    except (OSError, ValueError) as exc:
+        return [], str(exc)
+    return rows, None
+
+
+def collect_profiles(
+    n_nodes: int = DEFAULT_NODES, jobs: int = 1, flip_xy: bool = True
+) -> Tuple[List[Dict[str, object]], Dict[str, str]]:
+    """Profiles for every ``SUBJECTS`` entry, in order, and failures by subject."""
+    ResultsIndex(RESULTS_DIR).refresh()
+    args = [(subject, n_nodes, flip_xy) for subject in SUBJECTS]
+    if jobs > 1 and len(SUBJECTS) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            if profiling.enabled():
+                results = []
+                for result, events in pool.map(partial(profiling.collect, _subject_profiles), *zip(*args)):
+                    profiling.merge(events)
+                    results.append(result)
+            else:
+                results = list(pool.map(_subject_profiles, *zip(*args)))
+    else:
+        results = [_subject_profiles(*a) for a in args]
+
+    rows: List[Dict[str, object]] = []
+    failures: Dict[str, str] = {}
+    for subject, (subject_rows, error) in zip(SUBJECTS, results):
+        if error is not None:
+            failures[subject] = error
+        rows.extend(subject_rows)
+    return rows, failures
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=DEFAULT_NODES, help="Samples per streamline.")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes (0 = all CPUs).")
+    parser.add_argument(
+        "--no-flip",
+        action="store_true",
+        help="Track and FA voxel orders already agree (no DSI Studio x/y flip).",
+    )
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv")
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    with profiling.session(args.profile, "tract-profiles"):
+        jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+        rows, failures = collect_profiles(args.nodes, jobs, flip_xy=not args.no_flip)
+        for subject, error in failures.items():
+            print(f"[skip] {subject}: {error}", file=sys.stderr)
+        if not rows:
+            raise SystemExit("No tract profiles computed.")
+
+        if wants_csv(args.format):
+            out_csv = os.path.join(RESULTS_DIR, "tract_profiles.csv")
+            with open(out_csv, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=PROFILE_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            print(f"Saved profiles to {out_csv}")
+        if wants_parquet(args.format):
+            out_parquet = os.path.join(RESULTS_DIR, "tract_profiles.parquet")
+            write_long_table(
+                out_parquet,
+                melt_rows(rows, ["subject", "tract", "node"], PROFILE_FIELDS[3:]),
+                sort_by=("subject", "node"),
+            )
+            print(f"Saved profiles to {out_parquet}")
+
+
+if __name__ == "__main__":
+    main()
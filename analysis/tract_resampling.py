@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""Bootstrap CIs and permutation p-values for tract-level group differences.
+
+Reads the per-subject tract table written by ``compute_tract_stats``
+(``results/tract_metrics.csv``) and, for each contrast (Older - Young by
+``age_group``, M - F by ``sex``), estimates the difference in group means of
+every tract x metric column at once:
+
+* bootstrap: subjects are redrawn with replacement within each group as
+  ``(resamples, group size)`` index matrices, and each block of resamples is
+  summed with one fancy-indexing gather. Percentile CIs are reported for the
+  difference and for the percent difference relative to the reference group.
+* permutation: group labels are reassigned as a ``(resamples, subjects)``
+  0/1 matrix, and group sums come out of one matrix product with the
+  NaN-zeroed value table. Permutation 0 is the observed labelling, and
+  every distinct labelling is used when there are no more than
+  ``--permutations`` of them.
+
+Resamples are split into fixed-size shards, each seeded from
+``SeedSequence(seed).spawn``. Results therefore do not depend on
+``--jobs``, which only sets how many processes evaluate the shards.
+
+    python analysis/tract_resampling.py --bootstrap 10000 --permutations 10000 --jobs 4
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import csv
+import math
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from columnar import OUTPUT_FORMATS, melt_rows, wants_csv, wants_parquet, write_long_table
+import profiling
+from tract_fa_summary import SUBJECT_METADATA
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+
+METRICS = ["streamlines", "mean_fa", "volume_mm3"]
+
+# contrast -> (metadata key, reference group, comparison group); the effect
+# is comparison - reference.
+CONTRASTS = {
+    "age_group": ("age_group", "Young", "Older"),
+    "sex": ("sex", "F", "M"),
+}
+
+DEFAULT_RESAMPLES = 10000
+SHARD_SIZE = 2500
+# Bootstrap resamples gathered at once within a shard.
+BLOCK_SIZE = 500
+
+RESULT_FIELDS = [
+    "contrast",
+    "tract",
+    "metric",
+    "reference",
+    "comparison",
+    "n_reference",
+    "n_comparison",
+    "mean_reference",
+    "mean_comparison",
+    "difference",
+    "percent_difference",
+    "ci_low",
+    "ci_high",
+    "percent_ci_low",
+    "percent_ci_high",
+    "p_permutation",
+    "bootstraps",
+    "permutations",
+]
+
+
+@dataclass
+class MetricTable:
+    """Subject x (tract, metric) values; NaN marks a missing measurement."""
+
+    subjects: List[str]
+    columns: List[Tuple[str, str]]
+    values: np.ndarray
+
+
+def read_tract_metrics(path: str, metrics: Sequence[str] = METRICS) -> MetricTable:
+    """Wide table from the long ``subject,tract,<metrics>`` CSV."""
+    cells: Dict[Tuple[str, Tuple[str, str]], float] = {}
+    subjects: Dict[str, None] = {}
+    columns: Dict[Tuple[str, str], None] = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            subjects.setdefault(row["subject"])
+            for metric in metrics:
+                column = (row["tract"], metric)
+                columns.setdefault(column)
+                raw = row.get(metric, "")
+                cells[row["subject"], column] = float(raw) if raw not in ("", None) else math.nan
+    subject_list = list(subjects)
+    column_list = list(columns)
+    values = np.full((len(subject_list), len(column_list)), np.nan)
+    s_index = {s: i for i, s in enumerate(subject_list)}
+    c_index = {c: j for j, c in enumerate(column_list)}
+    for (subject, column), value in cells.items():
+        values[s_index[subject], c_index[column]] = value
+    return MetricTable(subject_list, column_list, values)
+
+
+def _group_means(weights: np.ndarray, filled: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """NaN-aware weighted means: ``weights`` (r, n) over subject rows of the tables."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (weights @ filled) / (weights @ present)
+
+
+def _effects(mean_ref: np.ndarray, mean_cmp: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    diff = mean_cmp - mean_ref
+    with np.errstate(invalid="ignore", divide="ignore"):
+        percent = np.where(mean_ref != 0, diff / mean_ref * 100, np.nan)
+    return diff, percent
+
+
+def _bootstrap_shard(
+    values: np.ndarray, ref: np.ndarray, cmp: np.ndarray, n: int, seed
+) -> Tuple[np.ndarray, np.ndarray]:
+    """``(n, columns)`` bootstrap differences and percent differences."""
+    rng = np.random.default_rng(seed)
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    diffs = np.empty((n, values.shape[1]))
+    percents = np.empty_like(diffs)
+    for lo in range(0, n, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, n - lo)
+        means = []
+        for rows in (ref, cmp):
+            idx = rows[rng.integers(0, len(rows), size=(size, len(rows)))]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means.append(filled[idx].sum(axis=1) / present[idx].sum(axis=1))
+        diffs[lo:lo + size], percents[lo:lo + size] = _effects(*means)
+    return diffs, percents
+
+
+def _permutation_shard(
+    values: np.ndarray,
+    is_cmp: np.ndarray,
+    observed: np.ndarray,
+    n: int,
+    seed,
+    labels: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Per column, how many relabellings give ``|difference| >= |observed|``.
+
+    ``labels`` is a ``(k, subjects)`` 0/1 matrix (1 = comparison group);
+    without it ``n`` labellings are drawn by shuffling ``is_cmp``.
+    """
+    if labels is None:
+        rng = np.random.default_rng(seed)
+        labels = rng.permuted(np.tile(is_cmp, (n, 1)), axis=1)
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    cmp = labels.astype(np.float64)
+    diff = _group_means(cmp, filled, present) - _group_means(1.0 - cmp, filled, present)
+    # Relative tolerance so the observed labelling always counts itself.
+    return (np.abs(diff) >= np.abs(observed) * (1 - 1e-12)).sum(axis=0)
+
+
+def _all_labellings(is_cmp: np.ndarray) -> np.ndarray:
+    """Every assignment of ``is_cmp.sum()`` subjects to the comparison group, observed first."""
+    n = len(is_cmp)
+    observed = tuple(np.flatnonzero(is_cmp))
+    picks = [observed] + [c for c in combinations(range(n), len(observed)) if c != observed]
+    labels = np.zeros((len(picks), n), dtype=bool)
+    for i, pick in enumerate(picks):
+        labels[i, list(pick)] = True
+    return labels
+
+
+def _shards(total: int) -> List[int]:
+    return [min(SHARD_SIZE, total - lo) for lo in range(0, total, SHARD_SIZE)]
+
+
+def _run_shards(func, arg_lists: List[tuple], pool: Optional[ProcessPoolExecutor]) -> list:
+    if pool is not None and len(arg_lists) > 1:
+        futures = [pool.submit(func, *args) for args in arg_lists]
+        return [f.result() for f in futures]
+    return [func(*args) for args in arg_lists]
+
+
+def resample_contrast(
+    table: MetricTable,
+    contrast: str,
+    n_boot: int = DEFAULT_RESAMPLES,
+    n_perm: int = DEFAULT_RESAMPLES,
+    confidence: float = 0.95,
+    seed: int = 0,
+    pool: Optional[ProcessPoolExecutor] = None,
+) -> List[Dict[str, object]]:
+    """One result row per (tract, metric) column of ``table`` for ``contrast``.
+
+    Shards run on ``pool`` when given, otherwise in this process.
+    """
+    key, ref_name, cmp_name = CONTRASTS[contrast]
+    groups = [SUBJECT_METADATA.get(s, {}).get(key) for s in table.subjects]
+    keep = [i for i, g in enumerate(groups) if g in (ref_name, cmp_name)]
+    values = table.values[keep]
+    is_cmp = np.array([groups[i] == cmp_name for i in keep])
+    ref = np.flatnonzero(~is_cmp)
+    cmp = np.flatnonzero(is_cmp)
+    if not len(ref) or not len(cmp):
+        raise ValueError(f"{contrast}: need subjects in both {ref_name} and {cmp_name}")
+
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    weights = np.stack([~is_cmp, is_cmp]).astype(np.float64)
+    mean_ref, mean_cmp = _group_means(weights, filled, present)
+    diff, percent = _effects(mean_ref, mean_cmp)
+    counts = weights @ present
+
+    seeds = np.random.SeedSequence([seed, list(CONTRASTS).index(contrast)]).spawn(2)
+    with profiling.span("bootstrap", contrast=contrast, resamples=n_boot):
+        boot_sizes = _shards(n_boot)
+        boot_seeds = seeds[0].spawn(len(boot_sizes))
+        parts = _run_shards(
+            _bootstrap_shard,
+            [(values, ref, cmp, size, s) for size, s in zip(boot_sizes, boot_seeds)],
+            pool,
+        )
+        boot_diff = np.concatenate([d for d, _ in parts] or [np.empty((0, len(diff)))])
+        boot_pct = np.concatenate([p for _, p in parts] or [np.empty((0, len(diff)))])
+    alpha = (1 - confidence) / 2 * 100
+    with profiling.span("bootstrap_ci", contrast=contrast):
+        if n_boot:
+            # All-NaN columns (a tract missing in one group) give NaN limits.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                ci = np.nanpercentile(boot_diff, [alpha, 100 - alpha], axis=0)
+                pct_ci = np.nanpercentile(boot_pct, [alpha, 100 - alpha], axis=0)
+        else:
+            ci = pct_ci = np.full((2, len(diff)), np.nan)
+
+    with profiling.span("permutation", contrast=contrast, resamples=n_perm):
+        n_labellings = math.comb(len(is_cmp), int(is_cmp.sum()))
+        if n_labellings <= n_perm:
+            labels = _all_labellings(is_cmp)
+            label_shards = [labels[lo:lo + SHARD_SIZE] for lo in range(0, len(labels), SHARD_SIZE)]
+            args = [(values, is_cmp, diff, len(l), None, l) for l in label_shards]
+            total = len(labels)
+        else:
+            sizes = _shards(n_perm - 1)
+            perm_seeds = seeds[1].spawn(len(sizes))
+            args = [(values, is_cmp, diff, size, s) for size, s in zip(sizes, perm_seeds)]
+            total = n_perm
+        exceed = sum(_run_shards(_permutation_shard, args, pool), np.zeros(len(diff), dtype=np.int64))
+        if n_labellings > n_perm:
+            exceed += 1  # the observed labelling
+        p_values = np.where(np.isnan(diff), np.nan, exceed / total)
+
+    rows = []
+    for j, (tract, metric) in enumerate(table.columns):
+        rows.append({
+            "contrast": contrast,
+            "tract": tract,
+            "metric": metric,
+            "reference": ref_name,
+            "comparison": cmp_name,
+            "n_reference": int(counts[0, j]),
+            "n_comparison": int(counts[1, j]),
+            "mean_reference": float(mean_ref[j]),
+            "mean_comparison": float(mean_cmp[j]),
+            "difference": float(diff[j]),
+            "percent_difference": float(percent[j]),
+            "ci_low": float(ci[0, j]),
+            "ci_high": float(ci[1, j]),
+            "percent_ci_low": float(pct_ci[0, j]),
+            "percent_ci_high": float(pct_ci[1, j]),
+            "p_permutation": float(p_values[j]),
+            "bootstraps": n_boot,
+            "permutations": total,
+        })
+    return rows
+
+
+def write_parquet(rows: Sequence[Dict[str, object]], root: str) -> str:
+    """Result rows as a long table partitioned by contrast and tract metric.
+
+    The result columns go into a ``stat`` column, so ``metric`` stays the
+    tract metric (``mean_fa`` ...).
+    """
+    return write_long_table(
+        root,
+        melt_rows(rows, RESULT_FIELDS[:5], RESULT_FIELDS[5:], metric_name="stat"),
+        partition_by=("contrast", "metric"),
+        sort_by=("tract",),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--input",
+        default=os.path.join(RESULTS_DIR, "tract_metrics.csv"),
+        help="Per-subject tract table from compute_tract_stats.",
+    )
+    parser.add_argument("--contrasts", nargs="+", choices=list(CONTRASTS), default=list(CONTRASTS))
+    parser.add_argument("--bootstrap", type=int, default=DEFAULT_RESAMPLES, help="Bootstrap resamples.")
+    parser.add_argument(
+        "--permutations",
+        type=int,
+        default=DEFAULT_RESAMPLES,
+        help="Permutations including the observed labelling (all of them if fewer exist).",
+    )
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes (0 = all CPUs).")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv")
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    with profiling.session(args.profile, "tract-resampling"):
+        jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+        table = read_tract_metrics(args.input)
+        rows = []
+        with contextlib.ExitStack() as stack:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=jobs)) if jobs > 1 else None
+            for contrast in args.contrasts:
+                rows.extend(resample_contrast(
+                    table, contrast, args.bootstrap, args.permutations, args.confidence, args.seed, pool
+                ))
+
+        if wants_csv(args.format):
+            out_csv = os.path.join(RESULTS_DIR, "tract_group_resampling.csv")
+            with open(out_csv, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            print(f"Saved resampling results to {out_csv}")
+        if wants_parquet(args.format):
+            out_parquet = write_parquet(rows, os.path.join(RESULTS_DIR, "tract_group_resampling.parquet"))
+            print(f"Saved resampling results to {out_parquet}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Decoded NIfTI volumes in shared memory for process-pool workers.
+
+The parent owns a ``VolumeCache``: ``acquire(path)`` sizes a volume from its
+header and decompresses it once, slab by slab, into a
+``multiprocessing.shared_memory`` block and returns a small,
+picklable ``SharedVolume`` handle. Workers pass the handle to ``attach`` and
+get a read-only NumPy view of the same pages, so nothing is pickled or
+decompressed again. Each process maps a block at most once.
+
+Acquired volumes are reference counted and stay resident until released.
+Released volumes are kept for reuse and evicted least-recently-used first
+when a new volume would push the cache past its memory budget. ``close``
+(or leaving the ``with`` block) unlinks every block.
+
+    with VolumeCache(budget_mb=2048) as cache:
+        handle = cache.acquire(fa_path)
+        pool.submit(work, handle)   # work() calls attach(handle)
+        ...
+        cache.release(handle)
+"""
+from __future__ import annotations
+
+import contextlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_BUDGET_MB = 1024
+# Slices along the last (slowest-varying on disk) axis decoded at once.
+SLAB_SIZE = 8
+
+
+@dataclass(frozen=True)
+class SharedVolume:
+    """Picklable handle to a volume held in a shared-memory block."""
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    source: str
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+# Blocks mapped by this process, by shared-memory name.
+_ATTACHED: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def attach(volume: SharedVolume) -> np.ndarray:
+    """Read-only view of ``volume``; the block stays mapped until ``detach``."""
+    shm = _ATTACHED.get(volume.name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=volume.name)
+        _ATTACHED[volume.name] = shm
+    view = np.ndarray(volume.shape, dtype=volume.dtype, buffer=shm.buf)
+    view.flags.writeable = False
+    return view
+
+
+def detach(volume: Optional[SharedVolume] = None) -> None:
+    """Unmap ``volume`` (every block when None) in this process.
+
+    Views returned by ``attach`` must not be used afterwards.
+    """
+    names = list(_ATTACHED) if volume is None else [volume.name]
+    for name in names:
+        shm = _ATTACHED.pop(name, None)
+        if shm is not None:
+            shm.close()
+
+
+def _layout(img, dtype: Optional[str]) -> Tuple[Tuple[int, ...], np.dtype]:
+    """Shape and decoded dtype of ``img`` without reading the whole volume."""
+    shape = tuple(int(n) for n in img.shape)
+    if dtype is not None:
+        return shape, np.dtype(dtype)
+    # Native (scaled) dtype, e.g. integer label atlases: scaling may promote
+    # the on-disk dtype, so read one voxel through the proxy to find out.
+    probe = np.asanyarray(img.dataobj[tuple(slice(0, 1) for _ in shape)])
+    return shape, probe.dtype
+
+
+def _read_into(img, out: np.ndarray) -> None:
+    """Decode ``img`` into ``out`` ``SLAB_SIZE`` slices (last axis) at a time."""
+    if out.ndim == 0:
+        out[...] = np.asanyarray(img.dataobj)
+        return
+    for start in range(0, out.shape[-1], SLAB_SIZE):
+        stop = min(start + SLAB_SIZE, out.shape[-1])
+        out[..., start:stop] = img.dataobj[..., start:stop]
+
+
+@dataclass
+class _Entry:
+    shm: shared_memory.SharedMemory
+    volume: SharedVolume
+    refs: int = 0
+
+
+class VolumeCache:
+    """LRU cache of decoded volumes in shared memory, bounded by ``budget_mb``."""
+
+    def __init__(self, budget_mb: float = DEFAULT_BUDGET_MB):
+        self.budget = int(budget_mb * 2**20)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, Optional[str]], _Entry]" = OrderedDict()
+
+    def __enter__(self) -> "VolumeCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def acquire(self, path, dtype: Optional[str] = "float32") -> SharedVolume:
+        """Handle to ``path`` decoded as ``dtype`` (native dtype when None).
+
+        Raises ``MemoryError`` when the volume does not fit in the budget even
+        after evicting every released volume.
+        """
+        key = (os.path.abspath(str(path)), None if dtype is None else np.dtype(dtype).str)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            import nibabel as nib
+
+            self.misses += 1
+            # Size the block from the header and make room before decoding,
+            # then decode slab by slab straight into shared memory.
+            img = nib.load(key[0], keep_file_open=True)
+            shape, data_dtype = _layout(img, dtype)
+            nbytes = int(np.prod(shape)) * data_dtype.itemsize
+            self._make_room(nbytes, key[0])
+            # size=0 is rejected, so empty volumes still get one byte.
+            shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+            try:
+                _read_into(img, np.ndarray(shape, dtype=data_dtype, buffer=shm.buf))
+            except BaseException:
+                shm.close()
+                shm.unlink()
+                raise
+            volume = SharedVolume(shm.name, shape, data_dtype.str, key[0])
+            entry = _Entry(shm, volume)
+            self._entries[key] = entry
+            self.used += nbytes
+        entry.refs += 1
+        return entry.volume
+
+    def release(self, volume: SharedVolume) -> None:
+        """Drop one reference; the volume becomes evictable at zero."""
+        for entry in self._entries.values():
+            if entry.volume.name == volume.name:
+                if entry.refs <= 0:
+                    raise ValueError(f"{volume.source} released more often than acquired")
+                entry.refs -= 1
+                return
+        raise KeyError(f"{volume.source} is not in this cache")
+
+    @contextlib.contextmanager
+    def borrow(self, path, dtype: Optional[str] = "float32") -> Iterator[np.ndarray]:
+        """Acquire ``path`` and yield its view; release it afterwards."""
+        volume = self.acquire(path, dtype)
+        try:
+            yield attach(volume)
+        finally:
+            self.release(volume)
+
+    def _make_room(self, nbytes: int, source: str) -> None:
+        for key in list(self._entries):
+            if self.used + nbytes <= self.budget:
+                return
+            entry = self._entries[key]
+            if entry.refs == 0:
+                self._drop(key)
+                self.evictions += 1
+        if self.used + nbytes > self.budget:
+            raise MemoryError(
+                f"{source} needs {nbytes / 2**20:.1f} MB; {self.used / 2**20:.1f} of "
+                f"{self.budget / 2**20:.1f} MB are held by acquired volumes"
+            )
+
+    def _drop(self, key) -> None:
+        entry = self._entries.pop(key)
+        self.used -= entry.volume.nbytes
+        detach(entry.volume)
+        entry.shm.close()
+        entry.shm.unlink()
+
+    def close(self) -> None:
+        """Unlink every block, including ones still acquired."""
+        for key in list(self._entries):
+            self._drop(key)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Uncompressed, memory-mapped copies of NIfTI volumes for repeated reads.
+
+``load(path)`` is ``nibabel.load(path)`` unless the store is enabled, with
+``--volume-store [DIR]`` on the scripts that read FA maps or the
+``VOLUME_STORE`` environment variable (set by ``configure``, so pool workers
+inherit it). Each volume is then converted once into ``<name>.<dtype>.npy``
+plus a ``.json`` header (shape, dtype, affine, zooms, the NIfTI header block
+and the source's size and mtime) under ``DIR``, by default
+``.volume_store/`` next to the source. Later loads open the ``.npy`` with
+``np.load(mmap_mode="r")``: nothing is decompressed, and the OS page cache
+shares the pages across processes and runs. Entries whose source has
+changed are rebuilt.
+
+``dtype=None`` keeps the native (scaled) dtype; ``"float32"`` halves the
+size of float64 maps. ``load`` returns a ``StoredVolume`` with the parts of
+the nibabel image API the scripts use (``shape``, ``affine``, ``header``,
+``dataobj``, ``get_fdata``).
+
+    python analysis/plot_fa_cc.py --volume-store
+    python analysis/volume_store.py results/*_dti.fib.gz.fa.nii.gz
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Directory of the store; "" means ``STORE_DIRNAME`` next to each source.
+ENV_VAR = "VOLUME_STORE"
+STORE_DIRNAME = ".volume_store"
+
+FORMAT_VERSION = 1
+
+
+def add_argument(parser) -> None:
+    parser.add_argument(
+        "--volume-store",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help=(
+            "Read NIfTI volumes through uncompressed memory-mapped copies, converting "
+            f"each once (default: {STORE_DIRNAME}/ next to the source)."
+        ),
+    )
+
+
+def configure(store_dir: Optional[str]) -> None:
+    """Enable the store for this process and its children; None leaves it as is."""
+    if store_dir is not None:
+        os.environ[ENV_VAR] = str(store_dir)
+
+
+def enabled() -> bool:
+    return ENV_VAR in os.environ
+
+
+def _dtype_tag(dtype) -> str:
+    return "native" if dtype is None else np.dtype(dtype).name
+
+
+def store_paths(source, dtype=None, store_dir=None) -> Tuple[Path, Path]:
+    """``(array, header)`` paths of ``source``'s entry."""
+    source = Path(source)
+    if store_dir is None:
+        store_dir = os.environ.get(ENV_VAR, "")
+    directory = Path(store_dir) if store_dir else source.parent / STORE_DIRNAME
+    stem = source.name
+    for ext in (".gz", ".nii"):
+        if stem.endswith(ext):
+            stem = stem[: -len(ext)]
+    base = directory / f"{stem}.{_dtype_tag(dtype)}"
+    return base.with_name(base.name + ".npy"), base.with_name(base.name + ".json")
+
+
+def _source_stamp(source: Path) -> Dict[str, Any]:
+    st = source.stat()
+    return {"source": str(source.resolve()), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+@dataclass
+class StoredVolume:
+    """Memory-mapped volume with the nibabel image attributes used here."""
+
+    dataobj: np.ndarray
+    meta: Dict[str, Any]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.dataobj.shape
+
+    @property
+    def affine(self) -> np.ndarray:
+        return np.asarray(self.meta["affine"], dtype=np.float64)
+
+    @property
+    def header(self):
+        import nibabel as nib
+
+        header_class = getattr(nib, self.meta["header_class"])
+        return header_class(binaryblock=base64.b64decode(self.meta["header"]))
+
+    def get_filename(self) -> str:
+        return self.meta["source"]
+
+    def get_fdata(self, dtype=np.float64) -> np.ndarray:
+        """In-memory copy as ``dtype``, like ``nibabel``'s ``get_fdata``."""
+        return np.asarray(self.dataobj, dtype=dtype)
+
+
+def _read_meta(header_path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(header_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(source, dtype=None, store_dir=None) -> bool:
+    array_path, header_path = store_paths(source, dtype, store_dir)
+    meta = _read_meta(header_path)
+    if meta is None or meta.get("version") != FORMAT_VERSION or not array_path.exists():
+        return False
+    return all(meta.get(key) == value for key, value in _source_stamp(Path(source)).items())
+
+
+def convert(source, dtype=None, store_dir=None, force: bool = False) -> Path:
+    """Write ``source``'s entry unless it is current; returns the array path."""
+    import nibabel as nib
+
+    source = Path(source)
+    array_path, header_path = store_paths(source, dtype, store_dir)
+    if not force and is_current(source, dtype, store_dir):
+        return array_path
+
+    stamp = _source_stamp(source)
+    img = nib.load(str(source))
+    if dtype is None:
+        data = np.asanyarray(img.dataobj)
+    else:
+        data = img.get_fdata(dtype=np.dtype(dtype))
+    meta = {
+        "version": FORMAT_VERSION,
+        **stamp,
+        "shape": list(data.shape),
+        "dtype": data.dtype.str,
+        "affine": np.asarray(img.affine, dtype=np.float64).tolist(),
+        "zooms": [float(z) for z in img.header.get_zooms()],
+        "header_class": type(img.header).__name__,
+        "header": base64.b64encode(img.header.binaryblock).decode("ascii"),
+    }
+
+    # The header is replaced last: an entry is valid only once both exist.
+    array_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_array = array_path.with_name(f"{array_path.name}.tmp{os.getpid()}")
+    tmp_header = header_path.with_name(f"{header_path.name}.tmp{os.getpid()}")
+    with open(tmp_array, "wb") as f:
+        np.save(f, np.ascontiguousarray(data))
+    with open(tmp_header, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_array, array_path)
+    os.replace(tmp_header, header_path)
+    return array_path
+
+
+def open_volume(source, dtype=None, store_dir=None) -> StoredVolume:
+    """``source`` from the store, converting it first if needed."""
+    array_path = convert(source, dtype, store_dir)
+    meta = _read_meta(store_paths(source, dtype, store_dir)[1])
+    return StoredVolume(np.load(array_path, mmap_mode="r"), meta)
+
+
+def load(source, dtype=None):
+    """``StoredVolume`` when the store is enabled, else ``nibabel.load``."""
+    if enabled():
+        return open_volume(source, dtype)
+    import nibabel as nib
+
+    return nib.load(str(source))
+
+
+def flat_values(img, index: np.ndarray, dtype=np.float64) -> np.ndarray:
+    """Voxels of ``img`` at flat (C-order) ``index``, as ``dtype``.
+
+    A stored volume reads only the pages holding those voxels. A nibabel
+    image is decoded without filling its data cache, so the full volume is
+    freed on return even while ``img`` stays alive.
+    """
+    if isinstance(img, StoredVolume):
+        return np.asarray(img.dataobj.reshape(-1)[index], dtype=dtype)
+    return img.get_fdata(dtype=dtype, caching="unchanged").ravel()[index]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Convert NIfTI volumes into the memory-mapped store.")
+    parser.add_argument("paths", nargs="+", help="NIfTI files to convert.")
+    parser.add_argument("--dtype", choices=["native", "float32"], default="native")
+    parser.add_argument("--store-dir", default=None,
+                        help=f"Store directory (default: {STORE_DIRNAME}/ next to each source).")
+    parser.add_argument("--force", action="store_true", help="Convert even when the entry is current.")
+    args = parser.parse_args(argv)
+    dtype = None if args.dtype == "native" else args.dtype
+    for path in args.paths:
+        print(convert(path, dtype, args.store_dir or "", force=args.force))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Voxelwise Young vs Older GLM on FA maps with max-statistic permutation FWE.
+
+The design has an intercept, an ``Older`` indicator (the tested contrast,
+Older - Young) and optional covariates, built from
+``tract_fa_summary.SUBJECT_METADATA``. Voxels where every subject's FA is
+at least ``--min-fa`` are tested.
+
+FA maps are streamed ``SLAB_SIZE`` slices at a time along the last axis, and
+masked voxels are processed in chunks sized so the per-chunk permutation
+products stay under ``--max-batch-mb``. With ``Q, R`` the thin QR factors of
+the design, permuting the subjects by ``perm`` gives ``Z = Q.T[:, inv] @ Y``
+with ``inv = argsort(perm)``. Stacking ``Q.T[:, inv]`` over all permutations
+turns all of them into one matrix product per chunk, from which
+
+    contrast = w @ Z                 (w = R^-T c)
+    RSS      = |Y|^2 - |Z|^2
+    t        = contrast / sqrt(RSS / dof * |w|^2)
+
+Permutation 0 is the identity, so p-values are ``count(null >= |t|) / n``.
+All permutations are enumerated when there are no more than
+``--permutations`` of them. The maximum |t| over the mask, per permutation,
+gives the FWE-corrected p; the voxel's own permuted |t| gives the
+uncorrected p.
+
+Writes ``results/voxelwise/fa_age_group_{tstat,p_fwe,p_unc}.nii.gz`` and a
+JSON summary.
+
+    python analysis/voxel_glm.py --permutations 5000 --covariates sex
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+from dataclasses import dataclass
+from itertools import permutations as all_permutations
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+import profiling
+from results_index import ResultsIndex
+from tract_fa_summary import SUBJECT_METADATA
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "results")
+OUTPUT_DIR = os.path.join(RESULTS_DIR, "voxelwise")
+OUTPUT_STEM = "fa_age_group"
+
+DEFAULT_PERMUTATIONS = 5000
+DEFAULT_MIN_FA = 0.2
+# Batches that stay cache-resident are faster than large ones; this bounds
+# memory rather than trading it for speed.
+MAX_BATCH_MB = 16
+# Number of slices along the last (slowest-varying on disk) axis read at once.
+SLAB_SIZE = 8
+
+# Covariate name -> (metadata key, value coded as 1).
+COVARIATES = {"sex": ("sex", "M")}
+
+
+@dataclass
+class Design:
+    subjects: List[str]
+    columns: List[str]
+    matrix: np.ndarray
+    contrast: np.ndarray
+
+    @property
+    def dof(self) -> int:
+        return len(self.subjects) - self.matrix.shape[1]
+
+
+def design_matrix(subjects: Sequence[str], covariates: Sequence[str] = ()) -> Design:
+    """Intercept, Older indicator and 0/1 covariates for ``subjects``."""
+    columns = ["intercept", "older"] + list(covariates)
+    rows = []
+    for subject in subjects:
+        meta = SUBJECT_METADATA[subject]
+        row = [1.0, 1.0 if meta["age_group"] == "Older" else 0.0]
+        for name in covariates:
+            key, level = COVARIATES[name]
+            row.append(1.0 if meta[key] == level else 0.0)
+        rows.append(row)
+    matrix = np.array(rows, dtype=np.float64)
+    if np.linalg.matrix_rank(matrix) < matrix.shape[1]:
+        raise ValueError(f"Design {columns} is rank deficient for subjects {list(subjects)}")
+    if len(subjects) <= matrix.shape[1]:
+        raise ValueError(f"{len(subjects)} subjects leave no residual degrees of freedom")
+    contrast = np.zeros(matrix.shape[1])
+    contrast[1] = 1.0
+    return Design(list(subjects), columns, matrix, contrast)
+
+
+def permutation_indices(n: int, n_perm: int, seed: int = 0) -> np.ndarray:
+    """``(k, n)`` subject orders, identity first.
+
+    Every ordering is returned when there are at most ``n_perm`` of them;
+    otherwise ``n_perm - 1`` random ones follow the identity.
+    """
+    if math.factorial(n) <= n_perm:
+        return np.array(list(all_permutations(range(n))), dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    perms = np.empty((n_perm, n), dtype=np.int64)
+    perms[0] = np.arange(n)
+    perms[1:] = rng.permuted(np.tile(np.arange(n), (n_perm - 1, 1)), axis=1)
+    return perms
+
+
+class PermutationGLM:
+    """t-statistics of ``design``'s contrast under every permutation at once."""
+
+    def __init__(self, design: Design, perms: np.ndarray):
+        q, r = np.linalg.qr(design.matrix)
+        self.design = design
+        self.n_perm = len(perms)
+        self.rank = q.shape[1]
+        inverse = np.argsort(perms, axis=1)
+        # (p, k, n) -> (p * k, n): row block i holds basis vector i for every
+        # subject order, so each block of the product is contiguous.
+        self.projector = q.T[:, inverse].reshape(self.rank * self.n_perm, -1)
+        self.weights = np.linalg.solve(r.T, design.contrast)
+        self.scale = float(self.weights @ self.weights) / design.dof
+
+    def chunk_voxels(self, max_batch_mb: float = MAX_BATCH_MB) -> int:
+        """Voxels per chunk keeping the float64 products under ``max_batch_mb``."""
+        per_voxel = 8 * self.n_perm * (self.rank + 3)
+        return max(1, int(max_batch_mb * 2**20 // per_voxel))
+
+    def fit(self, data: np.ndarray):
+        """Contrast estimates and ``RSS * |w|^2 / dof`` under every permutation.
+
+        Both are ``(k, voxels)`` for subject-by-voxel ``data``; row 0 is
+        the unpermuted fit, and ``t = effect / sqrt(variance)``.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        z = (self.projector @ data).reshape(self.rank, self.n_perm, -1)
+        effect = self.weights[0] * z[0]
+        for weight, block in zip(self.weights[1:], z[1:]):
+            effect += weight * block
+        total = np.einsum("nv,nv->v", data, data)
+        z *= z
+        rss = total - z[0]
+        for block in z[1:]:
+            rss -= block
+        # Guard rounding on voxels the design fits exactly (e.g. constant ones).
+        rss[rss <= 1e-12 * total] = np.inf
+        rss *= self.scale
+        return effect, rss
+
+    def tstats(self, data: np.ndarray) -> np.ndarray:
+        """``(k, voxels)`` t for subject-by-voxel ``data``; row 0 is unpermuted."""
+        effect, variance = self.fit(data)
+        return effect / np.sqrt(variance)
+
+
+@dataclass
+class GlmResult:
+    tstat: np.ndarray
+    p_fwe: np.ndarray
+    p_unc: np.ndarray
+    mask: np.ndarray
+    max_null: np.ndarray
+
+
+def _fa_images(subjects: Sequence[str]):
+    import nibabel as nib
+
+    index = ResultsIndex(RESULTS_DIR)
+    images = []
+    for subject in subjects:
+        path = index.fa_map(subject)
+        if path is None:
+            raise FileNotFoundError(f"Missing FA map for {subject}")
+        images.append(nib.load(path, keep_file_open=True))
+    shape = images[0].shape[:3]
+    for subject, img in zip(subjects, images):
+        if img.shape[:3] != shape or not np.allclose(img.affine, images[0].affine, atol=1e-4):
+            raise ValueError(f"FA grid of {subject} differs from {subjects[0]}")
+    return images
+
+
+def run_glm(
+    design: Design,
+    images,
+    n_perm: int = DEFAULT_PERMUTATIONS,
+    min_fa: float = DEFAULT_MIN_FA,
+    seed: int = 0,
+    max_batch_mb: float = MAX_BATCH_MB,
+    slab_size: int = SLAB_SIZE,
+) -> GlmResult:
+    """Voxelwise t, FWE and uncorrected permutation p over ``images`` (one per subject)."""
+    glm = PermutationGLM(design, permutation_indices(len(design.subjects), n_perm, seed))
+    chunk = glm.chunk_voxels(max_batch_mb)
+    shape = tuple(images[0].shape[:3])
+    tstat = np.zeros(shape, dtype=np.float32)
+    exceed = np.zeros(shape, dtype=np.int32)
+    mask = np.zeros(shape, dtype=bool)
+    max_null = np.zeros(glm.n_perm)
+
+    for start in range(0, shape[2], slab_size):
+        stop = min(start + slab_size, shape[2])
+        with profiling.span("load_slab", start=start):
+            slab = np.stack([
+                np.asarray(img.dataobj[:, :, start:stop], dtype=np.float32) for img in images
+            ])
+        slab_mask = (slab >= min_fa).all(axis=0)
+        mask[:, :, start:stop] = slab_mask
+        data = slab[:, slab_mask]
+        del slab
+        slab_t = np.zeros(data.shape[1], dtype=np.float32)
+        slab_exceed = np.zeros(data.shape[1], dtype=np.int32)
+        with profiling.span("permute", start=start, voxels=data.shape[1]):
+            for lo in range(0, data.shape[1], chunk):
+                # Work with t^2 (same ordering as |t|) to skip the sqrt/abs
+                # over every permutation.
+                effect, variance = glm.fit(data[:, lo:lo + chunk])
+                slab_t[lo:lo + chunk] = effect[0] / np.sqrt(variance[0])
+                effect *= effect
+                effect /= variance
+                np.maximum(max_null, effect.max(axis=1), out=max_null)
+                slab_exceed[lo:lo + chunk] = (effect >= effect[0]).sum(axis=0)
+        tstat[:, :, start:stop][slab_mask] = slab_t
+        exceed[:, :, start:stop][slab_mask] = slab_exceed
+
+    np.sqrt(max_null, out=max_null)
+    # Compare in float32 like the stored t map, so the voxel holding the
+    # observed maximum always counts its own (identity) permutation.
+    null_sorted = np.sort(max_null.astype(np.float32))
+    observed = np.abs(tstat[mask])
+    p_fwe = np.ones(shape, dtype=np.float32)
+    p_fwe[mask] = (glm.n_perm - np.searchsorted(null_sorted, observed, side="left")) / glm.n_perm
+    p_unc = np.ones(shape, dtype=np.float32)
+    p_unc[mask] = exceed[mask] / glm.n_perm
+    return GlmResult(tstat=tstat, p_fwe=p_fwe, p_unc=p_unc, mask=mask, max_null=max_null)
+
+
+def write_result(result: GlmResult, design: Design, reference, out_dir: str = OUTPUT_DIR) -> Dict[str, str]:
+    """Save the maps on ``reference``'s grid plus a JSON summary; return their paths."""
+    import nibabel as nib
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for name in ("tstat", "p_fwe", "p_unc"):
+        path = os.path.join(out_dir, f"{OUTPUT_STEM}_{name}.nii.gz")
+        nib.save(nib.Nifti1Image(getattr(result, name), reference.affine), path)
+        paths[name] = path
+    summary = {
+        "subjects": design.subjects,
+        "design_columns": design.columns,
+        "design": design.matrix.tolist(),
+        "contrast": "older - young",
+        "dof": design.dof,
+        "permutations": len(result.max_null),
+        "mask_voxels": int(result.mask.sum()),
+        "max_abs_t": float(np.abs(result.tstat).max()),
+        "min_p_fwe": float(result.p_fwe.min()),
+        "fwe_05_threshold": float(np.quantile(result.max_null, 0.95)),
+    }
+    paths["summary"] = os.path.join(out_dir, f"{OUTPUT_STEM}.json")
+    with open(paths["summary"], "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return paths
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--permutations", type=int, default=DEFAULT_PERMUTATIONS,
+                        help="Permutations including the identity (all of them if fewer exist).")
+    parser.add_argument("--covariates", nargs="*", choices=sorted(COVARIATES), default=[])
+    parser.add_argument("--min-fa", type=float, default=DEFAULT_MIN_FA,
+                        help="Test voxels where every subject's FA is at least this.")
+    parser.add_argument("--max-batch-mb", type=float, default=MAX_BATCH_MB,
+                        help="Memory for one chunk's permutation products.")
+    parser.add_argument("--seed", type=int, default=0)
+    profiling.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    with profiling.session(args.profile, "voxel-glm"):
+        index = ResultsIndex(RESULTS_DIR).refresh()
+        subjects = [s for s in SUBJECT_METADATA if index.fa_map(s) is not None]
+        design = design_matrix(subjects, args.covariates)
+        images = _fa_images(subjects)
+        result = run_glm(
+            design, images, args.permutations, args.min_fa, args.seed, args.max_batch_mb
+        )
+        paths = write_result(result, design, images[0])
+        print(
+            f"{len(subjects)} subjects, {len(result.max_null)} permutations, "
+            f"{int(result.mask.sum())} voxels; min FWE p = {float(result.p_fwe.min()):.4g}"
+        )
+        for path in paths.values():
+            print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+
+import cohort_stack
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    rng = np.random.default_rng(0)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    paths, volumes = [], []
+    for i in range(3):
+        volume = rng.random((20, 18, 11)).astype(np.float32)
+        path = tmp_path / f"sub-{i:02d}_fa.nii.gz"
+        nib.save(nib.Nifti1Image(volume, affine), str(path))
+        paths.append(str(path))
+        volumes.append(volume)
+    return [f"sub-{i:02d}" for i in range(3)], paths, np.stack(volumes, axis=-1)
+
+
+def test_rebuilds_when_chunk_shape_changes(cohort, tmp_path):
+    subjects, paths, reference = cohort
+    out = str(tmp_path / "stack")
+    assert cohort_stack.build_stack(subjects, paths, out, chunk_shape=(16, 16, 16)) == out
+    assert cohort_stack.build_stack(subjects, paths, out, chunk_shape=(16, 16, 16)) is None
+
+    assert cohort_stack.build_stack(subjects, paths, out, chunk_shape=(8, 8, 8)) == out
+    stack = cohort_stack.CohortStack(out)
+    assert stack.chunk_shape == (8, 8, 8)
+    mask = np.zeros(reference.shape[:3], dtype=bool)
+    mask[3:17, 5:9, 2:10] = True
+    np.testing.assert_array_equal(stack.mask(mask), reference[mask])
+    np.testing.assert_array_equal(stack.voxel((19, 17, 10)), reference[19, 17, 10])
+
+
+def test_grid_change_is_not_current(cohort, tmp_path):
+    subjects, paths, _ = cohort
+    out = str(tmp_path / "stack")
+    cohort_stack.build_stack(subjects, paths, out)
+    assert cohort_stack.is_current(subjects, paths, out, shape=(20, 18, 11), affine=np.diag([2.0, 2.0, 2.0, 1.0]))
+    assert not cohort_stack.is_current(subjects, paths, out, shape=(20, 18, 12))
+    assert not cohort_stack.is_current(subjects, paths, out, affine=np.eye(4))
@@ -0,0 +1,44 @@
+import csv
+import json
+
+import compute_tract_stats as cts
+
+
+ROWS = [
+    {"subject": "sub-01", "tract": "SLF_L", "streamlines": 120.0, "mean_fa": 0.45, "volume_mm3": 900.0},
+    {"subject": "sub-02", "tract": "SLF_L", "streamlines": 80.0, "mean_fa": 0.41, "volume_mm3": 700.0},
+    {"subject": "sub-01", "tract": "CST_R", "streamlines": 300.0, "mean_fa": 0.52, "volume_mm3": 1500.0},
+    {"subject": "sub-02", "tract": "CST_R", "streamlines": 260.0, "mean_fa": 0.50, "volume_mm3": 1400.0},
+]
+
+
+def _read(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def test_rerun_with_summary_state_does_not_refold_subjects(tmp_path, monkeypatch):
+    monkeypatch.setattr(cts, "RESULTS_DIR", str(tmp_path))
+    rows = [dict(row) for row in ROWS]
+    monkeypatch.setattr(cts, "_collect_subject_metrics", lambda **kwargs: ([dict(r) for r in rows], {}))
+    state = tmp_path / "state.json"
+    args = cts._parse_args(["--summary-state", str(state)])
+
+    cts._run(args)
+    first_state = json.loads(state.read_text())
+    first_summary = _read(tmp_path / "tract_metrics_summary.csv")
+    cts._run(args)
+
+    second_state = json.loads(state.read_text())
+    assert second_state == first_state
+    assert _read(tmp_path / "tract_metrics_summary.csv") == first_summary
+    for states in second_state["states"].values():
+        assert all(s["count"] == 2 for s in states.values())
+
+    # A genuinely new subject is still folded in.
+    rows.append({"subject": "sub-03", "tract": "SLF_L", "streamlines": 100.0,
+                 "mean_fa": 0.43, "volume_mm3": 800.0})
+    cts._run(args)
+    third_state = json.loads(state.read_text())
+    assert third_state["states"]["SLF_L"]["mean_fa"]["count"] == 3
+    assert third_state["states"]["CST_R"]["mean_fa"]["count"] == 2
@@ -0,0 +1,30 @@
+import os
+
+import pipeline
+from pipeline import Stage
+
+
+def test_signature_covers_imported_helper_modules(tmp_path, monkeypatch):
+    analysis = tmp_path / "analysis"
+    analysis.mkdir()
+    (analysis / "stage_script.py").write_text("import helper\n\ndef main():\n    from lazy_helper import f\n")
+    (analysis / "helper.py").write_text("import numpy\nimport nested\n")
+    (analysis / "nested.py").write_text("X = 1\n")
+    (analysis / "lazy_helper.py").write_text("def f():\n    pass\n")
+    (analysis / "unrelated.py").write_text("Y = 2\n")
+    monkeypatch.setattr(pipeline, "PROJECT_ROOT", str(tmp_path))
+
+    assert pipeline.script_modules("stage_script.py") == [
+        "helper.py", "lazy_helper.py", "nested.py", "stage_script.py",
+    ]
+    stage = Stage("demo", inputs=[], outputs=[], script="stage_script.py")
+    before, count = pipeline.input_signature(stage)
+    assert count == 4
+
+    (analysis / "unrelated.py").write_text("Y = 3\n")
+    assert pipeline.input_signature(stage)[0] == before
+
+    nested = analysis / "nested.py"
+    nested.write_text("X = 10\n")
+    os.utime(nested, ns=(1, 1))
+    assert pipeline.input_signature(stage)[0] != before
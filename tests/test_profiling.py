@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+import profiling
+
+
+def test_files_opened_counts_opens_from_threads(tmp_path):
+    path = tmp_path / "f.txt"
+    path.write_text("x")
+    n_threads, per_thread = 8, 200
+
+    def work():
+        for _ in range(per_thread):
+            with open(path):
+                pass
+
+    profiling.enable()
+    try:
+        with profiling.span("threads"):
+            threads = [threading.Thread(target=work) for _ in range(n_threads)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        events = profiling.disable()
+    finally:
+        profiling.disable()
+    (event,) = [e for e in events if e["name"] == "threads"]
+    assert event["args"]["files_opened"] == n_threads * per_thread
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def test_maxrss_growth_is_per_span():
+    np = pytest.importorskip("numpy")
+    # Enough to push the process peak past whatever earlier tests reached.
+    size_mb = profiling._max_rss_mb() - _rss_mb() + 64
+    profiling.enable()
+    try:
+        with profiling.span("big"):
+            block = np.ones(int(size_mb * 2**20) // 8)
+            del block
+        with profiling.span("small"):
+            block = np.ones(8 * 2**20 // 8)
+            del block
+        events = profiling.disable()
+    finally:
+        profiling.disable()
+    growth = {e["name"]: e["args"]["maxrss_growth_mb"] for e in events}
+    assert growth["big"] >= 48
+    # Below the peak "big" set, so it must not inherit that spike.
+    assert growth["small"] == 0
+    (row,) = [r for r in profiling.summary_rows(events) if r["span"] == "small"]
+    assert row["maxrss_growth_mb"] == 0
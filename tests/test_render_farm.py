@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import render_farm
+from render_farm import RenderJob
+
+
+def _draw(out_path, title="a"):
+    Path(out_path).write_text(title)
+
+
+def _job(module, tmp_path):
+    return RenderJob(module.draw, tmp_path / "fig.png", kwargs={"title": "a"})
+
+
+def test_digest_changes_when_a_helper_is_edited(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "fig_module.py").write_text(
+        "def scale(v):\n    return v\n\n"
+        "def draw(out_path, title='a'):\n    from fig_helper import project\n    project(scale(1))\n"
+    )
+    helper = src / "fig_helper.py"
+    helper.write_text("def project(v):\n    return v\n")
+    (src / "unrelated.py").write_text("X = 1\n")
+    monkeypatch.syspath_prepend(str(src))
+    import fig_module
+
+    before = _job(fig_module, tmp_path).digest
+    (src / "unrelated.py").write_text("X = 2\n")
+    assert _job(fig_module, tmp_path).digest == before
+
+    helper.write_text("def project(v):\n    return 2 * v\n")
+    after_helper = _job(fig_module, tmp_path).digest
+    assert after_helper != before
+
+    # A helper in the render function's own module.
+    (src / "fig_module.py").write_text((src / "fig_module.py").read_text().replace("return v", "return -v"))
+    assert _job(fig_module, tmp_path).digest != after_helper
+
+
+def test_digest_changes_when_render_function_is_edited(tmp_path):
+    # exec'd functions have no source file, so this also covers the bytecode fallback.
+    namespace = {}
+    exec("def _draw(out_path, title='a'):\n    pass\n", namespace)
+    before = RenderJob(namespace["_draw"], tmp_path / "fig.png", kwargs={"title": "a"}).digest
+    exec("def _draw(out_path, title='a'):\n    print('edited')\n", namespace)
+    after = RenderJob(namespace["_draw"], tmp_path / "fig.png", kwargs={"title": "a"}).digest
+    assert before != after
+
+
+def test_unchanged_job_is_skipped(tmp_path):
+    job = RenderJob(_draw, tmp_path / "fig.txt", kwargs={"title": "b"})
+    assert not job.is_current()
+    render_farm.render([job])
+    assert RenderJob(_draw, tmp_path / "fig.txt", kwargs={"title": "b"}).is_current()
+    assert not RenderJob(_draw, tmp_path / "fig.txt", kwargs={"title": "c"}).is_current()
@@ -0,0 +1,49 @@
+import pytest
+
+from stat_parser import parse_many, parse_stat_file
+
+
+def _reference(path):
+    # The line loop that tract_fa_summary used before the shared parser.
+    metrics = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if "\t" not in line:
+                continue
+            key, value = line.strip().split("\t", 1)
+            try:
+                metrics[key] = float(value)
+            except ValueError:
+                continue
+    return metrics
+
+
+CASES = {
+    "duplicates": "fa\t0.1\nmd\t0.7\nfa\t0.2\n",
+    "indented": "  fa\t0.3\n\tmd\t0.8\nqa \t0.9\n",
+    "crlf": "fa\t0.4\r\nmd\t0.6\r\n",
+    "bare-cr": "fa\t0.5\rmd\t0.5\r",
+    "non-numeric-last": "fa\t0.45\nfa\tn/a\n",
+    "non-numeric-first": "fa\tn/a\nfa\t0.55\n",
+    "no-newline": "md\t1\nfa\t0.65",
+    "prefix-key": "xfa\t9\nfa_mean\t8\nfa\t0.75\n",
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_matches_line_loop(tmp_path, name):
+    path = tmp_path / f"{name}.stat.txt"
+    path.write_bytes(CASES[name].encode())
+    expected = _reference(str(path))
+    assert parse_stat_file(str(path)) == expected
+    keys = ["fa", "md", "qa"]
+    assert parse_stat_file(str(path), keys) == {k: v for k, v in expected.items() if k in keys}
+
+
+def test_parse_many_uses_last_value(tmp_path):
+    paths = []
+    for name in ("duplicates", "indented", "non-numeric-last"):
+        paths.append(str(tmp_path / f"{name}.stat.txt"))
+        (tmp_path / f"{name}.stat.txt").write_bytes(CASES[name].encode())
+    table = parse_many(paths, ["fa"], workers=2)
+    assert list(table.column("fa")) == [0.2, 0.3, 0.45]
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+
+import synthetic_cohort
+from results_index import ResultsIndex
+from tdi_builder import build_tdi, tdi_volume
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    (subject,) = synthetic_cohort.generate(tmp_path, n_subjects=1, shape=(16, 18, 14), streamlines=30)
+    tract = synthetic_cohort.SLF_TRACTS[0]
+    tract_dir = tmp_path / "results" / f"{subject}_tracts" / tract
+    tt_path = tract_dir / f"{subject}_ses-01_dti.{tract}.tt.gz"
+    fa_path = tmp_path / "results" / f"{subject}_ses-01_dti.fib.gz.fa.nii.gz"
+    return tmp_path / "results", subject, tract, str(tt_path), str(fa_path)
+
+
+def test_built_map_leaves_export_alone(cohort):
+    results, subject, tract, tt_path, fa_path = cohort
+    export = tt_path + ".tdi.nii.gz"
+    with open(export, "rb") as f:
+        original = f.read()
+    # An export older than its .tt.gz, e.g. after re-copying the tracts.
+    past = os.stat(tt_path).st_mtime_ns - 10**10
+    os.utime(export, ns=(past, past))
+
+    for force in (False, True):
+        out_path = build_tdi(tt_path, fa_path, force=force) or out_path
+        assert out_path == tt_path + ".tdi_built.nii.gz"
+    assert build_tdi(tt_path, fa_path) is None
+    with open(export, "rb") as f:
+        assert f.read() == original
+
+    built = nib.load(out_path)
+    np.testing.assert_array_equal(built.get_fdata(), tdi_volume([tt_path], nib.load(fa_path).shape))
+    assert not [name for name in os.listdir(os.path.dirname(tt_path)) if ".tmp" in name]
+
+    index = ResultsIndex(str(results)).refresh(save=False)
+    assert index.tdi_files(subject, tract) == [export]
+
+
+def test_upsampled_map_name(cohort):
+    _, _, _, tt_path, fa_path = cohort
+    out_path = build_tdi(tt_path, fa_path, upsample=2)
+    assert out_path == tt_path + ".tdi_built2x.nii.gz"
+    assert nib.load(out_path).shape == tuple(2 * n for n in nib.load(fa_path).shape)
@@ -0,0 +1,135 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+import tract_resampling as tr
+from tract_resampling import MetricTable, resample_contrast
+
+SUBJECTS = [f"sub-{i:02d}" for i in range(9)]
+METADATA = {
+    s: {"age_group": "Older" if i % 2 else "Young", "sex": "M" if i < 4 else "F"}
+    for i, s in enumerate(SUBJECTS)
+}
+
+
+@pytest.fixture
+def table(monkeypatch):
+    monkeypatch.setattr(tr, "SUBJECT_METADATA", METADATA)
+    # Small shards and blocks so the tests cross shard and block boundaries.
+    monkeypatch.setattr(tr, "SHARD_SIZE", 70)
+    monkeypatch.setattr(tr, "BLOCK_SIZE", 16)
+    rng = np.random.default_rng(4)
+    values = rng.normal(0.45, 0.05, size=(len(SUBJECTS), 3))
+    values[:, 2] += 0.08 * np.array([i % 2 for i in range(len(SUBJECTS))])
+    values[1, 0] = np.nan
+    values[6, 1] = np.nan
+    return MetricTable(SUBJECTS, [("SLF_L", "mean_fa"), ("CST_R", "mean_fa"), ("CC", "mean_fa")], values)
+
+
+def _groups(contrast):
+    key, ref_name, cmp_name = tr.CONTRASTS[contrast]
+    is_cmp = np.array([METADATA[s][key] == cmp_name for s in SUBJECTS])
+    return is_cmp
+
+
+def _naive_diff(values, is_cmp):
+    return np.nanmean(values[is_cmp], axis=0) - np.nanmean(values[~is_cmp], axis=0)
+
+
+def _naive_bootstrap(values, is_cmp, n_boot, seed, contrast):
+    ref, cmp = np.flatnonzero(~is_cmp), np.flatnonzero(is_cmp)
+    boot_seed = np.random.SeedSequence([seed, list(tr.CONTRASTS).index(contrast)]).spawn(2)[0]
+    sizes = [min(tr.SHARD_SIZE, n_boot - lo) for lo in range(0, n_boot, tr.SHARD_SIZE)]
+    diffs = []
+    for size, shard_seed in zip(sizes, boot_seed.spawn(len(sizes))):
+        rng = np.random.default_rng(shard_seed)
+        for lo in range(0, size, tr.BLOCK_SIZE):
+            block = min(tr.BLOCK_SIZE, size - lo)
+            draws = [rows[rng.integers(0, len(rows), size=(block, len(rows)))] for rows in (ref, cmp)]
+            for r in range(block):
+                diffs.append(np.nanmean(values[draws[1][r]], axis=0) - np.nanmean(values[draws[0][r]], axis=0))
+    return np.array(diffs)
+
+
+def test_bootstrap_matches_naive_loop(table):
+    contrast, n_boot = "age_group", 300
+    rows = resample_contrast(table, contrast, n_boot=n_boot, n_perm=10, seed=7)
+    boot = _naive_bootstrap(table.values, _groups(contrast), n_boot, 7, contrast)
+    assert boot.shape == (n_boot, 3)
+    low, high = np.percentile(boot, [2.5, 97.5], axis=0)
+    for j, row in enumerate(rows):
+        assert row["difference"] == pytest.approx(_naive_diff(table.values, _groups(contrast))[j])
+        assert row["ci_low"] == pytest.approx(low[j], rel=1e-12)
+        assert row["ci_high"] == pytest.approx(high[j], rel=1e-12)
+
+
+def test_exhaustive_permutation_matches_naive_loop(table):
+    contrast = "age_group"
+    is_cmp = _groups(contrast)
+    n_labellings = math.comb(len(is_cmp), int(is_cmp.sum()))
+    rows = resample_contrast(table, contrast, n_boot=0, n_perm=n_labellings, seed=0)
+
+    observed = _naive_diff(table.values, is_cmp)
+    exceed = np.zeros(3)
+    for pick in combinations(range(len(is_cmp)), int(is_cmp.sum())):
+        labels = np.zeros(len(is_cmp), dtype=bool)
+        labels[list(pick)] = True
+        exceed += np.abs(_naive_diff(table.values, labels)) >= np.abs(observed) * (1 - 1e-12)
+    for j, row in enumerate(rows):
+        assert row["permutations"] == n_labellings
+        assert row["p_permutation"] == pytest.approx(exceed[j] / n_labellings)
+
+
+def test_random_permutation_matches_naive_loop(table):
+    contrast, n_perm, seed = "sex", 100, 3
+    is_cmp = _groups(contrast)
+    rows = resample_contrast(table, contrast, n_boot=0, n_perm=n_perm, seed=seed)
+
+    observed = _naive_diff(table.values, is_cmp)
+    perm_seed = np.random.SeedSequence([seed, list(tr.CONTRASTS).index(contrast)]).spawn(2)[1]
+    sizes = [min(tr.SHARD_SIZE, n_perm - 1 - lo) for lo in range(0, n_perm - 1, tr.SHARD_SIZE)]
+    exceed = np.ones(3)  # the observed labelling
+    for size, shard_seed in zip(sizes, perm_seed.spawn(len(sizes))):
+        labels = np.random.default_rng(shard_seed).permuted(np.tile(is_cmp, (size, 1)), axis=1)
+        for row in labels:
+            exceed += np.abs(_naive_diff(table.values, row)) >= np.abs(observed) * (1 - 1e-12)
+    for j, row in enumerate(rows):
+        assert row["permutations"] == n_perm
+        assert row["p_permutation"] == pytest.approx(exceed[j] / n_perm)
+
+
+def _same(a, b):
+    return all(
+        x == y or (isinstance(x, float) and isinstance(y, float) and math.isnan(x) and math.isnan(y))
+        for ra, rb in zip(a, b)
+        for x, y in zip(ra.values(), rb.values())
+    ) and len(a) == len(b)
+
+
+def test_pool_gives_identical_results(table):
+    # 100 permutations are drawn at random, 300 enumerate all 126 labellings.
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        for contrast in tr.CONTRASTS:
+            for n_perm in (100, 300):
+                serial = resample_contrast(table, contrast, n_boot=400, n_perm=n_perm, seed=11)
+                pooled = resample_contrast(table, contrast, n_boot=400, n_perm=n_perm, seed=11, pool=pool)
+                assert _same(serial, pooled)
+
+
+def test_parquet_round_trip(table, tmp_path):
+    pytest.importorskip("pyarrow")
+    from columnar import read_long_table
+
+    rows = [r for c in tr.CONTRASTS for r in resample_contrast(table, c, n_boot=50, n_perm=20, seed=3)]
+    root = tr.write_parquet(rows, str(tmp_path / "resampling.parquet"))
+
+    stats = tr.RESULT_FIELDS[5:]
+    assert read_long_table(root).num_rows == len(rows) * len(stats)
+    got = read_long_table(root, metric=["mean_fa"], stat=["difference", "p_permutation"]).to_pylist()
+    assert len(got) == 2 * len(rows)
+    expected = {(r["contrast"], r["tract"], r["metric"], s): r[s] for r in rows for s in ("difference", "p_permutation")}
+    for rec in got:
+        assert rec["value"] == pytest.approx(expected[(rec["contrast"], rec["tract"], rec["metric"], rec["stat"])])
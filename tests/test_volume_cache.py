@@ -0,0 +1,74 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+
+import volume_cache
+from volume_cache import VolumeCache, attach
+
+
+def _sum(volume):
+    return float(attach(volume).sum(dtype=np.float64))
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    fa = rng.random((9, 7, 19)).astype(np.float32)
+    fa_path = tmp_path / "fa.nii.gz"
+    nib.save(nib.Nifti1Image(fa, np.eye(4)), str(fa_path))
+    labels = rng.integers(0, 300, size=(9, 7, 19)).astype(np.int16)
+    labels_path = tmp_path / "labels.nii.gz"
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), str(labels_path))
+    scaled = nib.Nifti1Image(rng.random((9, 7, 19)) * 50, np.eye(4))
+    scaled.set_data_dtype(np.int16)
+    scaled_path = tmp_path / "scaled.nii.gz"
+    nib.save(scaled, str(scaled_path))
+    return fa_path, labels_path, scaled_path
+
+
+def test_acquire_decodes_like_nibabel(images, monkeypatch):
+    # Slabs smaller than the last axis, with a partial final slab.
+    monkeypatch.setattr(volume_cache, "SLAB_SIZE", 4)
+    fa_path, labels_path, scaled_path = images
+    with VolumeCache(budget_mb=4) as cache:
+        fa = cache.acquire(fa_path)
+        np.testing.assert_array_equal(attach(fa), nib.load(str(fa_path)).get_fdata(dtype=np.float32))
+        labels = cache.acquire(labels_path, dtype=None)
+        native = np.asanyarray(nib.load(str(labels_path)).dataobj)
+        assert attach(labels).dtype == native.dtype
+        np.testing.assert_array_equal(attach(labels), native)
+        scaled = cache.acquire(scaled_path, dtype=None)
+        expected = np.asanyarray(nib.load(str(scaled_path)).dataobj)
+        assert attach(scaled).dtype == expected.dtype
+        np.testing.assert_array_equal(attach(scaled), expected)
+
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            assert list(pool.map(_sum, [fa, fa])) == [_sum(fa)] * 2
+
+
+def test_over_budget_volume_is_rejected_before_decoding(images, monkeypatch):
+    fa_path = images[0]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("volume decoded before the budget check")
+
+    monkeypatch.setattr(volume_cache, "_read_into", fail)
+    with VolumeCache(budget_mb=0.001) as cache:
+        with pytest.raises(MemoryError):
+            cache.acquire(fa_path)
+        assert len(cache) == 0 and cache.used == 0
+
+
+def test_released_volumes_are_evicted_lru(images):
+    fa_path, labels_path, _ = images
+    nbytes = 9 * 7 * 19 * 4
+    with VolumeCache(budget_mb=1.5 * nbytes / 2**20) as cache:
+        fa = cache.acquire(fa_path)
+        with pytest.raises(MemoryError):
+            cache.acquire(labels_path)
+        cache.release(fa)
+        cache.acquire(labels_path)
+        assert cache.evictions == 1 and len(cache) == 1
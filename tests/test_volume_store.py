@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+
+import volume_store
+
+
+def test_flat_values_leaves_image_uncached(tmp_path):
+    data = np.random.default_rng(0).random((6, 5, 4)).astype(np.float32)
+    path = tmp_path / "fa.nii.gz"
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(path))
+    index = np.array([0, 7, 119])
+
+    img = nib.load(str(path))
+    np.testing.assert_array_equal(volume_store.flat_values(img, index), data.ravel()[index])
+    assert not img.in_memory
+
+    stored = volume_store.open_volume(path, store_dir=str(tmp_path / "store"))
+    np.testing.assert_array_equal(volume_store.flat_values(stored, index), data.ravel()[index])
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from voxel_glm import Design, PermutationGLM, permutation_indices, run_glm
+
+
+def _design(n, seed=1):
+    rng = np.random.default_rng(seed)
+    older = np.array([0.0] * (n // 2) + [1.0] * (n - n // 2))
+    # A continuous covariate keeps every design row distinct, so no two
+    # permutations give mathematically tied t values.
+    age = rng.normal(size=n)
+    matrix = np.column_stack([np.ones(n), older, age])
+    return Design([f"sub-{i:02d}" for i in range(n)], ["intercept", "older", "age"], matrix,
+                  np.array([0.0, 1.0, 0.0]))
+
+
+def _naive_t(design, perms, data):
+    """Per-permutation lstsq fits of subject-permuted ``data`` (subjects x voxels)."""
+    x = design.matrix
+    xtx_inv = np.linalg.inv(x.T @ x)
+    c = design.contrast
+    out = np.empty((len(perms), data.shape[1]))
+    for k, perm in enumerate(perms):
+        y = data[perm]
+        beta = np.linalg.lstsq(x, y, rcond=None)[0]
+        rss = ((y - x @ beta) ** 2).sum(axis=0)
+        out[k] = (c @ beta) / np.sqrt(rss / design.dof * (c @ xtx_inv @ c))
+    return out
+
+
+def test_run_glm_matches_per_permutation_lstsq():
+    n_subjects, n_perm, seed, min_fa = 10, 200, 3, 0.1
+    shape = (6, 5, 7)
+    rng = np.random.default_rng(0)
+    volumes = rng.uniform(0.15, 0.9, size=(n_subjects,) + shape)
+    volumes[:, 0, 0, :] = 0.05  # fails the mask in every slab
+    volumes[:, 1:3, 1:3, 2:5] += 0.2 * _design(n_subjects).matrix[:, 1, None, None, None]
+    images = [SimpleNamespace(shape=shape, dataobj=v.astype(np.float32)) for v in volumes]
+    design = _design(n_subjects)
+
+    perms = permutation_indices(n_subjects, n_perm, seed)
+    glm = PermutationGLM(design, perms)
+    max_batch_mb = 7 * 8 * glm.n_perm * (glm.rank + 3) / 2**20
+    assert glm.chunk_voxels(max_batch_mb) == 7
+
+    result = run_glm(design, images, n_perm=n_perm, min_fa=min_fa, seed=seed,
+                     max_batch_mb=max_batch_mb, slab_size=3)
+
+    stacked = np.stack([img.dataobj for img in images])
+    mask = (stacked >= min_fa).all(axis=0)
+    np.testing.assert_array_equal(result.mask, mask)
+    t = _naive_t(design, perms, stacked[:, mask].astype(np.float64))
+
+    np.testing.assert_allclose(result.tstat[mask], t[0], rtol=1e-5, atol=1e-6)
+    assert (result.tstat[~mask] == 0).all()
+
+    null = np.abs(t).max(axis=1)
+    np.testing.assert_allclose(result.max_null, null, rtol=1e-10)
+    observed = np.abs(result.tstat[mask])
+    p_fwe = (null.astype(np.float32)[None, :] >= observed[:, None]).mean(axis=1)
+    np.testing.assert_allclose(result.p_fwe[mask], p_fwe, atol=1e-7)
+    p_unc = (np.abs(t) >= np.abs(t[0])).mean(axis=0)
+    np.testing.assert_allclose(result.p_unc[mask], p_unc, atol=1e-7)
+    assert (result.p_fwe[~mask] == 1).all() and (result.p_unc[~mask] == 1).all()
+    assert result.p_unc[mask].min() < 0.05
+
+
+def test_all_permutations_enumerated_when_few():
+    perms = permutation_indices(4, 100)
+    assert len(perms) == 24
+    np.testing.assert_array_equal(perms[0], np.arange(4))
+    assert len({tuple(p) for p in perms}) == 24